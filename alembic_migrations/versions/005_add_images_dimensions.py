@@ -0,0 +1,24 @@
+"""add images dimensions
+
+Revision ID: 005
+Revises: 004
+Create Date: 2026-10-16
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '005'
+down_revision = '004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('images', sa.Column('width', sa.Integer(), nullable=True))
+    op.add_column('images', sa.Column('height', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('images', 'height')
+    op.drop_column('images', 'width')
@@ -0,0 +1,22 @@
+"""add images priority
+
+Revision ID: 008
+Revises: 007
+Create Date: 2026-10-16
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '008'
+down_revision = '007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('images', sa.Column('priority', sa.String(length=20), nullable=False, server_default='interactive'))
+
+
+def downgrade() -> None:
+    op.drop_column('images', 'priority')
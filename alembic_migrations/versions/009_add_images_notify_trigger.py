@@ -0,0 +1,44 @@
+"""add images notify trigger
+
+Revision ID: 009
+Revises: 008
+Create Date: 2026-10-16
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '009'
+down_revision = '008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Уведомление уходит в канал image_events при commit транзакции,
+    # изменившей статус или миниатюры записи
+    op.execute("""
+        CREATE FUNCTION images_notify_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify(
+                'image_events',
+                json_build_object('id', NEW.id, 'status', NEW.status)::text
+            );
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER images_notify_change
+        AFTER UPDATE ON images
+        FOR EACH ROW
+        WHEN (
+            OLD.status IS DISTINCT FROM NEW.status
+            OR OLD.thumbnails::jsonb IS DISTINCT FROM NEW.thumbnails::jsonb
+        )
+        EXECUTE FUNCTION images_notify_change()
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER images_notify_change ON images")
+    op.execute("DROP FUNCTION images_notify_change()")
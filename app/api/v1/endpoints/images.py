@@ -1,87 +1,466 @@
-from fastapi import APIRouter, UploadFile, File, Depends, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import (
+    APIRouter, UploadFile, File, Depends, Header, HTTPException, Query,
+    Response,
+)
+from fastapi.responses import RedirectResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from uuid import UUID, uuid4
+from uuid import UUID
 from pathlib import Path
-import json
-import aiofiles
-import aio_pika
-from typing import Optional
+from contextlib import nullcontext
+from functools import partial
+from typing import Dict, List, Literal, Optional, Tuple
+import hashlib
 import os
 
-from app.dependencies import get_db
-from app.crud import create_image, update_image_status, get_image
+from app.dependencies import (
+    get_db, get_image_events, get_outbox_relay, get_storage,
+    get_thumbnail_cache,
+)
+from app.crud import (
+    NewImage, create_image_with_job, create_images_with_jobs, get_image
+)
 from app.schemas import TaskResponse, ImageResponse
 from app.core.config import settings
+from app.image_events import ImageEventListener, wait_changed
+from app.imaging import (
+    DEFAULT_ENCODING, ENCODINGS, FIT_MODES, THUMBNAIL_SIZES, Size,
+    encoding_available, nearest_rendition, parse_thumbnail_key, render_fit, thumbnail_key,
+)
+from app.models import Image
+from app.outbox import OutboxRelay
+from app.responses import RangeFileResponse
+from app.storage import UploadTooLargeError, store_content_addressed
+from app.storage_backends import StorageBackend, thumbnail_storage_key
+from app.thumbnail_cache import ThumbnailCache
+from app.validation import ImageHeaderValidator, InvalidImageError
 
 router = APIRouter()
 
 
+# interactive - загрузки пользователей, bulk - массовая обработка,
+# которая уступает им worker'ов
+Priority = Literal["interactive", "bulk"]
+
+# Допустимые типы и расширение, под которым хранится оригинал
+ALLOWED_CONTENT_TYPES = {"image/jpeg": ".jpg", "image/png": ".png"}
+
+
+def _check_content_type(file: UploadFile) -> None:
+    if file.content_type not in ALLOWED_CONTENT_TYPES:
+        raise HTTPException(status_code=400, detail="Only JPEG/PNG allowed")
+
+
+async def _store_original(
+    file: UploadFile, storage: StorageBackend
+) -> NewImage:
+    """Потоково сохраняет оригинал в хранилище по хешу содержимого
+
+    Сигнатура и заголовок изображения проверяются по первым блокам,
+    поэтому не-изображения и слишком большие картинки отклоняются до
+    того, как тело будет сохранено.
+    """
+    validator = ImageHeaderValidator(expected_content_type=file.content_type)
+    try:
+        key, content_hash = await store_content_addressed(
+            file,
+            Path(settings.STORAGE_PATH) / ".tmp",
+            storage,
+            extension=ALLOWED_CONTENT_TYPES[file.content_type],
+            max_size=settings.MAX_UPLOAD_SIZE,
+            chunk_size=settings.UPLOAD_CHUNK_SIZE,
+            validator=validator,
+        )
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    info = validator.finish()
+    return NewImage(key, content_hash, info.width, info.height)
+
+
 @router.post("/images", response_model=TaskResponse)
 async def upload_image(
     file: UploadFile = File(...),
+    priority: Priority = "interactive",
     db: AsyncSession = Depends(get_db),
+    relay: OutboxRelay = Depends(get_outbox_relay),
+    storage: StorageBackend = Depends(get_storage),
 ):
-    if file.content_type not in ["image/jpeg", "image/png"]:
-        raise HTTPException(status_code=400, detail="Only JPEG/PNG allowed")
+    _check_content_type(file)
 
     # Сохранить файл
-    file_extension = Path(file.filename).suffix if file.filename else '.jpg'
-    file_id = uuid4()
-    file_path = (Path(settings.STORAGE_PATH) / "original" /
-                 f"{file_id}{file_extension}")
-    file_path.parent.mkdir(parents=True, exist_ok=True)
+    original = await _store_original(file, storage)
 
-    async with aiofiles.open(file_path, "wb") as f:
-        content = await file.read()
-        await f.write(content)
+    # Запись и задача на обработку сохраняются одним commit,
+    # в RabbitMQ задачу отправит релей outbox. Повторно загруженное
+    # содержимое получает готовые миниатюры без обработки
+    image = await create_image_with_job(db, original, priority=priority)
+    if image.status != "DONE":
+        relay.notify()
 
-    original_url = str(file_path)
-    image = await create_image(db, original_url)
+    return TaskResponse(task_id=image.id, status=image.status)
 
-    # Отправить в RabbitMQ
-    connection = await aio_pika.connect_robust(settings.RABBITMQ_URL)
-    async with connection:
-        channel = await connection.channel()
-        await channel.declare_queue("images", durable=True)
 
-        message_body = json.dumps({
-            "image_id": str(image.id),
-            "original_path": original_url
-        })
+@router.post("/images/batch", response_model=List[TaskResponse])
+async def upload_images_batch(
+    files: List[UploadFile] = File(...),
+    priority: Priority = "interactive",
+    db: AsyncSession = Depends(get_db),
+    relay: OutboxRelay = Depends(get_outbox_relay),
+    storage: StorageBackend = Depends(get_storage),
+):
+    """Загрузка нескольких изображений одним запросом
 
-        await channel.default_exchange.publish(
-            aio_pika.Message(body=message_body.encode()),
-            routing_key="images"
+    Все файлы сохраняются потоково, записи создаются одним INSERT, а
+    задачи уходят в брокер одной подтвержденной пачкой через outbox.
+    """
+    if len(files) > settings.MAX_BATCH_FILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many files. Maximum: {settings.MAX_BATCH_FILES}"
         )
+    for file in files:
+        _check_content_type(file)
+
+    # Оригиналы адресуются по содержимому и могут принадлежать другим
+    # записям, поэтому при ошибке они не удаляются
+    originals = [await _store_original(file, storage) for file in files]
+    images = await create_images_with_jobs(db, originals, priority=priority)
+    relay.notify()
 
-    await update_image_status(db, image.id, "PROCESSING")
+    return [
+        TaskResponse(task_id=image.id, status=image.status)
+        for image in images
+    ]
 
-    return TaskResponse(task_id=image.id, status="PROCESSING")
+
+# Статусы, после которых запись не меняется сама
+FINAL_STATUSES = ("DONE", "ERROR")
 
 
 @router.get("/images/{image_id}", response_model=ImageResponse)
 async def get_image_info(
     image_id: str,
-    db: AsyncSession = Depends(get_db)
+    wait: float = Query(0, ge=0, le=30),
+    db: AsyncSession = Depends(get_db),
+    events: ImageEventListener = Depends(get_image_events),
 ):
+    """Информация об изображении
+
+    Если задан wait и изображение еще обрабатывается, ответ задерживается
+    до следующего изменения записи (новый статус или готовая миниатюра),
+    но не дольше wait секунд. Так клиенту не нужно часто опрашивать API.
+    """
     try:
         uuid_image_id = UUID(image_id)
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid UUID")
 
-    image = await get_image(db, uuid_image_id)
-    if not image:
-        raise HTTPException(status_code=404, detail="Image not found")
+    # Ожидание регистрируется до чтения, чтобы не пропустить изменение,
+    # пришедшее между чтением и ожиданием
+    watch = events.watch(uuid_image_id) if wait else nullcontext()
+    with watch as changed:
+        image = await get_image(db, uuid_image_id)
+        if not image:
+            raise HTTPException(status_code=404, detail="Image not found")
+
+        if wait and image.status not in FINAL_STATUSES:
+            # Соединение с БД не держим на время ожидания
+            await db.rollback()
+            await wait_changed(changed, wait)
+            image = await get_image(db, uuid_image_id)
 
     return ImageResponse.model_validate(image)
 
 
+def _requested_box(
+    w: Optional[int], h: Optional[int], fit: str
+) -> Size:
+    """Проверяет параметры миниатюры по запросу и возвращает рамку
+
+    Стороны округляются вверх до THUMBNAIL_SIZE_STEP: произвольные w и h
+    давали бы миллионы вариантов, каждый со своей отрисовкой и файлом
+    в кеше.
+    """
+    max_dimension = _on_demand_max_dimension()
+    if fit not in FIT_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid fit. Available: {', '.join(FIT_MODES)}"
+        )
+    if fit == "cover" and (w is None or h is None):
+        raise HTTPException(
+            status_code=400, detail="Both w and h are required for cover"
+        )
+    for value in (w, h):
+        if value is not None and not 1 <= value <= max_dimension:
+            raise HTTPException(
+                status_code=400,
+                detail=f"w and h must be between 1 and {max_dimension}"
+            )
+    # Не заданная сторона не ограничивает миниатюру
+    return (
+        _round_dimension(w or max_dimension, max_dimension),
+        _round_dimension(h or max_dimension, max_dimension),
+    )
+
+
+def _on_demand_max_dimension() -> int:
+    """Наибольшая сторона миниатюры по запросу
+
+    Не больше наибольшей сохраненной миниатюры: рамки крупнее нее
+    строились бы декодированием полного оригинала в потоке API, без
+    бюджета пикселей worker.
+    """
+    largest = max(max(size) for size in THUMBNAIL_SIZES)
+    return min(settings.THUMBNAIL_MAX_DIMENSION, largest)
+
+
+def _round_dimension(value: int, max_dimension: int) -> int:
+    step = settings.THUMBNAIL_SIZE_STEP
+    return min(-(-value // step) * step, max_dimension)
+
+
+# Форматы, которые отдаются вместо JPEG, если клиент их принимает;
+# при равном q предпочтение у более позднего в списке
+NEGOTIATED_ENCODINGS = ["webp", "avif"]
+
+
+def _accepted_media_types(accept: Optional[str]) -> Dict[str, float]:
+    """Разбирает заголовок Accept в {тип: q}"""
+    accepted = {}
+    for part in (accept or "").split(","):
+        media_type, *params = part.split(";")
+        media_type = media_type.strip().lower()
+        if not media_type:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[media_type] = q
+    return accepted
+
+
+def _negotiate_encoding(accept: Optional[str], available) -> str:
+    """Выбирает формат миниатюры по заголовку Accept
+
+    WebP и AVIF отдаются только клиентам, явно перечислившим их тип:
+    */* и image/* не гарантируют поддержку новых форматов. Иначе JPEG.
+    """
+    accepted = _accepted_media_types(accept)
+    best, best_score = DEFAULT_ENCODING, (
+        accepted.get(ENCODINGS[DEFAULT_ENCODING].media_type, 0.0), 0
+    )
+    for rank, name in enumerate(NEGOTIATED_ENCODINGS, start=1):
+        q = accepted.get(ENCODINGS[name].media_type, 0.0)
+        if name in available and q > 0 and (q, rank) > best_score:
+            best, best_score = name, (q, rank)
+    return best
+
+
+def _stored_renditions(
+    thumbnails: Dict[str, str], size: Optional[Size] = None
+) -> Dict[Size, Dict[str, str]]:
+    """Сохраненные миниатюры: {рамка: {формат: путь}}"""
+    renditions: Dict[Size, Dict[str, str]] = {}
+    for key, path in thumbnails.items():
+        parsed = parse_thumbnail_key(key)
+        if parsed is not None and (size is None or parsed[0] == size):
+            renditions.setdefault(parsed[0], {})[parsed[1]] = path
+    return renditions
+
+
+# Статусы, в которых у изображения есть хотя бы одна миниатюра
+READY_STATUSES = ("DONE", "PARTIAL")
+
+
+def _check_ready(image: Image) -> None:
+    if image.status not in READY_STATUSES:
+        raise HTTPException(
+            status_code=409, 
+            detail=f"Image is not ready. Status: {image.status}"
+        )
+
+
+def _check_size(size: str) -> None:
+    if size not in ["100x100", "300x300", "1200x1200"]:
+        raise HTTPException(
+            status_code=400, 
+            detail="Invalid size. Available: 100x100, 300x300, 1200x1200"
+        )
+
+
+def _stored_thumbnail(
+    image: Image, size: str, accept: Optional[str]
+) -> Tuple[str, str]:
+    """Ключ сохраненной миниатюры size в лучшем для клиента формате"""
+    _check_size(size)
+
+    box = parse_thumbnail_key(size)[0]
+    encodings = _stored_renditions(image.thumbnails, box).get(box, {})
+    if DEFAULT_ENCODING not in encodings:
+        if image.status != "DONE":
+            # Размер еще обрабатывается
+            raise HTTPException(
+                status_code=409,
+                detail=f"Thumbnail {size} is not ready. "
+                       f"Status: {image.status}"
+            )
+        raise HTTPException(
+            status_code=404, 
+            detail=f"Thumbnail {size} not found"
+        )
+
+    encoding = _negotiate_encoding(accept, encodings)
+    return encodings[encoding], encoding
+
+
+def _render_stored(
+    storage: StorageBackend, key: str, box: Size, fit: str
+):
+    with storage.local_copy(key) as path:
+        return render_fit(str(path), box, fit)
+
+
+async def _render_on_demand(
+    image: Image,
+    box: Size,
+    fit: str,
+    encoding: str,
+    cache: ThumbnailCache,
+    storage: StorageBackend,
+) -> Path:
+    """Миниатюра произвольного размера из ближайшей большей сохраненной
+
+    Если размеры оригинала неизвестны или ни одна сохраненная миниатюра
+    не подходит, миниатюра строится из оригинала. Результат кешируется
+    по хешу содержимого, так что дубликаты используют одну запись кеша.
+    """
+    source = image.original_url
+    if image.width and image.height:
+        # Источником служат JPEG-миниатюры: их декодирование самое быстрое
+        renditions = {
+            rendition: encodings[DEFAULT_ENCODING]
+            for rendition, encodings in _stored_renditions(
+                image.thumbnails
+            ).items()
+            if DEFAULT_ENCODING in encodings
+        }
+        best = nearest_rendition(
+            (image.width, image.height), renditions, box, fit
+        )
+        if best is not None:
+            source = renditions[best]
+
+    key = f"{image.content_hash or image.id}_{box[0]}x{box[1]}_{fit}"
+    try:
+        return await cache.get_or_render(
+            key, partial(_render_stored, storage, source, box, fit), encoding
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found on disk")
+
+
+def _etag(image: Image, rendition: str) -> str:
+    """Сильный ETag файла изображения
+
+    Файл определяется изображением, вариантом (оригинал, размер и
+    формат миниатюры) и содержимым оригинала; для сохраненных миниатюр
+    в rendition входят и параметры кодирования. Вычисляется без
+    обращения к диску.
+    """
+    return _strong_etag(
+        f"{image.id}:{rendition}:{image.content_hash or ''}"
+    )
+
+
+def _strong_etag(source: str) -> str:
+    digest = hashlib.blake2b(source.encode(), digest_size=16).hexdigest()
+    return f'"{digest}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Совпадение с If-None-Match (слабое сравнение, RFC 9110)"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def _cache_headers(etag: str) -> Dict[str, str]:
+    # Оригинал адресуется хешем содержимого, а миниатюра по запросу -
+    # хешем и параметрами, поэтому по URL всегда отдается тот же файл и
+    # клиенты и CDN могут не перепроверять его до истечения max-age
+    return {
+        "ETag": etag,
+        "Cache-Control": (
+            f"public, max-age={settings.FILE_CACHE_MAX_AGE}, immutable"
+        ),
+    }
+
+
+def _revalidate_headers(etag: str) -> Dict[str, str]:
+    # Сохраненные миниатюры лежат по детерминированным ключам и
+    # перезаписываются при повторной обработке: по тому же URL может
+    # отдаваться новый файл, поэтому клиенты и CDN каждый раз сверяют ETag
+    return {"ETag": etag, "Cache-Control": "public, no-cache"}
+
+
+def _stored_rendition(image: Image, size: str, encoding: str) -> str:
+    """Вариант сохраненной миниатюры для ETag"""
+    key = thumbnail_key(parse_thumbnail_key(size)[0], encoding)
+    meta = (image.thumbnail_meta or {}).get(key) or {}
+    return f"{key}:{meta.get('quality', '')}:{meta.get('bytes', '')}"
+
+
+def _stored_file_response(
+    storage: StorageBackend,
+    key: str,
+    media_type: str,
+    filename: str,
+    headers: Dict[str, str],
+    cache_headers: Dict[str, str],
+    attachment: bool = False,
+):
+    """Файл из хранилища: с диска или редиректом на ссылку хранилища
+
+    Подписанная ссылка временная, поэтому редирект не кешируется.
+    """
+    path = storage.local_path(key)
+    if path is None:
+        return RedirectResponse(
+            storage.url(key, filename, attachment), headers=headers
+        )
+    if not path.exists():
+        raise HTTPException(status_code=404, detail="File not found on disk")
+
+    disposition = "attachment" if attachment else "inline"
+    headers["Content-Disposition"] = f"{disposition}; filename={filename}"
+    headers.update(cache_headers)
+    return RangeFileResponse(path, media_type=media_type, headers=headers)
+
+
 @router.get("/images/{image_id}/file")
 async def view_image_file(
     image_id: str,
     size: Optional[str] = None,
-    db: AsyncSession = Depends(get_db)
+    w: Optional[int] = None,
+    h: Optional[int] = None,
+    fit: str = "contain",
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+    cache: ThumbnailCache = Depends(get_thumbnail_cache),
+    storage: StorageBackend = Depends(get_storage),
 ):
     """Просмотр файла изображения в браузере
     
@@ -89,6 +468,14 @@ async def view_image_file(
         image_id: UUID изображения
         size: Размер миниатюры (100x100, 300x300, 1200x1200)
               или None для оригинала
+        w, h: Размер миниатюры по запросу (вместо size); можно задать
+              одну сторону
+        fit: contain - вписать в рамку, cover - заполнить с обрезкой
+
+    Формат миниатюры (JPEG, WebP, AVIF) выбирается по заголовку Accept.
+    Если хранилище не локальное, файл отдается редиректом на временную
+    ссылку хранилища. Запрос с совпавшим If-None-Match получает 304 без
+    обращения к файлу.
     """
     try:
         uuid_image_id = UUID(image_id)
@@ -99,40 +486,62 @@ async def view_image_file(
     if not image:
         raise HTTPException(status_code=404, detail="Image not found")
 
-    if image.status != "DONE":
-        raise HTTPException(
-            status_code=409, 
-            detail=f"Image is not ready. Status: {image.status}"
-        )
+    # Готовые миниатюры отдаются и до окончания обработки
+    if not size:
+        _check_ready(image)
 
-    # Определяем путь к файлу
-    if size:
-        if size not in ["100x100", "300x300", "1200x1200"]:
+    # Определяем файл
+    headers = {}
+    media_type = "image/jpeg"
+    if w is not None or h is not None:
+        if size:
             raise HTTPException(
-                status_code=400, 
-                detail="Invalid size. Available: 100x100, 300x300, 1200x1200"
+                status_code=400, detail="Use either size or w/h"
             )
-        
-        if size not in image.thumbnails:
-            raise HTTPException(
-                status_code=404, 
-                detail=f"Thumbnail {size} not found"
+        box = _requested_box(w, h, fit)
+        encoding = _negotiate_encoding(
+            accept, [name for name in ENCODINGS if encoding_available(name)]
+        )
+        headers["Vary"] = "Accept"
+        cache_headers = _cache_headers(
+            _etag(image, f"{box[0]}x{box[1]}_{fit}.{encoding}")
+        )
+        if _etag_matches(if_none_match, cache_headers["ETag"]):
+            return Response(
+                status_code=304, headers={**headers, **cache_headers}
             )
-        
-        file_path = Path(image.thumbnails[size])
+
+        # Миниатюры по запросу всегда лежат в локальном кеше
+        file_path = await _render_on_demand(
+            image, box, fit, encoding, cache, storage
+        )
+        headers["Content-Disposition"] = f"inline; filename={file_path.name}"
+        headers.update(cache_headers)
+        return RangeFileResponse(
+            file_path,
+            media_type=ENCODINGS[encoding].media_type,
+            headers=headers,
+        )
+
+    if size:
+        key, encoding = _stored_thumbnail(image, size, accept)
+        media_type = ENCODINGS[encoding].media_type
+        headers["Vary"] = "Accept"
+        cache_headers = _revalidate_headers(
+            _etag(image, _stored_rendition(image, size, encoding))
+        )
     else:
-        file_path = Path(image.original_url)
+        key = image.original_url
+        cache_headers = _cache_headers(_etag(image, "original"))
 
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="File not found on disk")
+    if _etag_matches(if_none_match, cache_headers["ETag"]):
+        return Response(
+            status_code=304, headers={**headers, **cache_headers}
+        )
 
     # Возвращаем файл для просмотра в браузере
-    return FileResponse(
-        file_path,
-        media_type="image/jpeg",
-        headers={
-            "Content-Disposition": f"inline; filename={file_path.name}"
-        }
+    return _stored_file_response(
+        storage, key, media_type, Path(key).name, headers, cache_headers
     )
 
 
@@ -140,7 +549,10 @@ async def view_image_file(
 async def download_image_file(
     image_id: str,
     size: Optional[str] = None,
-    db: AsyncSession = Depends(get_db)
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+    storage: StorageBackend = Depends(get_storage),
 ):
     """Скачивание файла изображения
     
@@ -158,43 +570,139 @@ async def download_image_file(
     if not image:
         raise HTTPException(status_code=404, detail="Image not found")
 
-    if image.status != "DONE":
-        raise HTTPException(
-            status_code=409, 
-            detail=f"Image is not ready. Status: {image.status}"
-        )
+    # Готовые миниатюры отдаются и до окончания обработки
+    if not size:
+        _check_ready(image)
 
-    # Определяем путь к файлу и имя для скачивания
+    # Определяем файл и имя для скачивания
+    headers = {}
     if size:
-        if size not in ["100x100", "300x300", "1200x1200"]:
-            raise HTTPException(
-                status_code=400, 
-                detail="Invalid size. Available: 100x100, 300x300, 1200x1200"
-            )
-        
-        if size not in image.thumbnails:
-            raise HTTPException(
-                status_code=404, 
-                detail=f"Thumbnail {size} not found"
-            )
-        
-        file_path = Path(image.thumbnails[size])
+        key, encoding = _stored_thumbnail(image, size, accept)
+        headers["Vary"] = "Accept"
         # Создаем красивое имя файла для скачивания
         original_name = os.path.splitext(Path(image.original_url).name)[0]
-        download_filename = f"{original_name}_{size}.jpg"
+        extension = ENCODINGS[encoding].extension
+        download_filename = f"{original_name}_{size}{extension}"
+        cache_headers = _revalidate_headers(
+            _etag(image, _stored_rendition(image, size, encoding))
+        )
     else:
-        file_path = Path(image.original_url)
-        download_filename = file_path.name
+        key = image.original_url
+        download_filename = Path(key).name
+        cache_headers = _cache_headers(_etag(image, "original"))
 
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="File not found on disk")
+    if _etag_matches(if_none_match, cache_headers["ETag"]):
+        return Response(
+            status_code=304, headers={**headers, **cache_headers}
+        )
 
     # Возвращаем файл для скачивания
-    return FileResponse(
-        file_path,
-        media_type="application/octet-stream",
-        filename=download_filename,
-        headers={
-            "Content-Disposition": f"attachment; filename={download_filename}"
-        }
+    return _stored_file_response(
+        storage,
+        key,
+        "application/octet-stream",
+        download_filename,
+        headers,
+        cache_headers,
+        attachment=True,
+    )
+
+
+def _deterministic_thumbnail(
+    storage: StorageBackend,
+    image_id: UUID,
+    box: Size,
+    accept: Optional[str],
+) -> Optional[Tuple[Path, os.stat_result, str]]:
+    """Ищет миниатюру по ключу, который строит worker, без запроса к БД
+
+    Форматы перебираются в порядке предпочтения клиента, JPEG - последним:
+    он сохраняется всегда, поэтому его отсутствие означает промах.
+
+    Returns:
+        Путь, stat файла и формат или None при промахе
+    """
+    candidates = list(ENCODINGS)
+    while True:
+        encoding = _negotiate_encoding(accept, candidates)
+        path = storage.local_path(thumbnail_storage_key(
+            image_id, box[0], box[1], ENCODINGS[encoding].extension
+        ))
+        if path is None:
+            return None
+        try:
+            return path, path.stat(), encoding
+        except FileNotFoundError:
+            if encoding == DEFAULT_ENCODING:
+                return None
+            candidates.remove(encoding)
+
+
+@router.get("/images/{image_id}/thumbnails/{size}")
+async def view_thumbnail(
+    image_id: str,
+    size: str,
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+    storage: StorageBackend = Depends(get_storage),
+):
+    """Быстрая отдача сохраненной миниатюры
+
+    Путь миниатюры однозначно следует из id и размера, поэтому готовый
+    файл отдается без обращения к БД. Только если файла нет (миниатюра
+    еще не готова, запись старая, хранилище не локальное или запись -
+    дубликат, ссылающийся на миниатюры исходного изображения), запись
+    читается из БД и ответ такой же, как у /file?size=: файл, 404 или
+    409. URL не меняется при повторной обработке, поэтому ответ не
+    immutable: кеш перепроверяет его по ETag и получает 304.
+    """
+    try:
+        uuid_image_id = UUID(image_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid UUID")
+    _check_size(size)
+
+    box = parse_thumbnail_key(size)[0]
+    headers = {"Vary": "Accept"}
+    found = _deterministic_thumbnail(storage, uuid_image_id, box, accept)
+    if found is not None:
+        path, stat_result, encoding = found
+        # Файл не перезаписывается на месте: новая версия пишется во
+        # временный файл и подменяет старую, меняя mtime
+        rendition = (
+            f"{thumbnail_key(box, encoding)}:"
+            f"{stat_result.st_mtime_ns}:{stat_result.st_size}"
+        )
+        headers.update(
+            _revalidate_headers(_strong_etag(f"{uuid_image_id}:{rendition}"))
+        )
+        if _etag_matches(if_none_match, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        headers["Content-Disposition"] = f"inline; filename={path.name}"
+        return RangeFileResponse(
+            path,
+            media_type=ENCODINGS[encoding].media_type,
+            headers=headers,
+            stat_result=stat_result,
+        )
+
+    image = await get_image(db, uuid_image_id)
+    if not image:
+        raise HTTPException(status_code=404, detail="Image not found")
+    key, encoding = _stored_thumbnail(image, size, accept)
+    cache_headers = _revalidate_headers(
+        _etag(image, _stored_rendition(image, size, encoding))
+    )
+    if _etag_matches(if_none_match, cache_headers["ETag"]):
+        return Response(
+            status_code=304, headers={**headers, **cache_headers}
+        )
+    return _stored_file_response(
+        storage,
+        key,
+        ENCODINGS[encoding].media_type,
+        Path(key).name,
+        headers,
+        cache_headers,
     )
@@ -0,0 +1,268 @@
+import asyncio
+import re
+from pathlib import Path
+from typing import Tuple
+from uuid import UUID
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.api.v1.endpoints.images import ALLOWED_CONTENT_TYPES, Priority
+from app.core.config import settings
+from app.crud import NewImage, create_image_with_job
+from app.dependencies import get_db, get_outbox_relay, get_storage
+from app.models import UploadSession
+from app.outbox import OutboxRelay
+from app.schemas import (
+    TaskResponse, UploadSessionCreate, UploadSessionResponse
+)
+from app.storage import (
+    UploadLockedError,
+    UploadOffsetMismatchError,
+    UploadTooLargeError,
+    append_stream,
+    commit_content_addressed,
+    hash_file,
+    restore_upload_part,
+    upload_part_path,
+)
+from app.storage_backends import StorageBackend
+from app.validation import (
+    ImageHeaderValidator, InvalidImageError, validate_image_file
+)
+
+router = APIRouter()
+
+CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+def _part_path(upload_id: UUID) -> Path:
+    return upload_part_path(Path(settings.STORAGE_PATH) / "uploads", upload_id)
+
+
+def _current_offset(upload_id: UUID) -> int:
+    try:
+        return _part_path(upload_id).stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+def _parse_content_range(content_range: str) -> Tuple[int, int, int]:
+    match = CONTENT_RANGE_RE.fullmatch(content_range.strip())
+    if not match:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid Content-Range. Expected: bytes start-end/total"
+        )
+    start, end, total = (int(value) for value in match.groups())
+    if end < start:
+        raise HTTPException(status_code=400, detail="Invalid Content-Range")
+    return start, end, total
+
+
+async def _get_session(db: AsyncSession, upload_id: str) -> UploadSession:
+    try:
+        uuid_upload_id = UUID(upload_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid UUID")
+
+    session = await db.get(UploadSession, uuid_upload_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return session
+
+
+def _session_response(session: UploadSession) -> UploadSessionResponse:
+    return UploadSessionResponse(
+        upload_id=session.id,
+        offset=_current_offset(session.id),
+        size=session.total_size,
+    )
+
+
+@router.post("/uploads", response_model=UploadSessionResponse)
+async def create_upload(
+    upload: UploadSessionCreate,
+    db: AsyncSession = Depends(get_db),
+):
+    """Создание сессии возобновляемой загрузки
+
+    Дальше файл передается блоками через PUT /uploads/{id} с заголовком
+    Content-Range, а после последнего блока загрузка завершается через
+    POST /uploads/{id}/complete.
+    """
+    if upload.content_type not in ALLOWED_CONTENT_TYPES:
+        raise HTTPException(status_code=400, detail="Only JPEG/PNG allowed")
+    if not 0 < upload.size <= settings.MAX_RESUMABLE_UPLOAD_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=(
+                "File exceeds maximum upload size of "
+                f"{settings.MAX_RESUMABLE_UPLOAD_SIZE} bytes"
+            )
+        )
+
+    session = UploadSession(
+        filename=upload.filename,
+        content_type=upload.content_type,
+        total_size=upload.size,
+    )
+    db.add(session)
+    await db.commit()
+
+    part_path = _part_path(session.id)
+    part_path.parent.mkdir(parents=True, exist_ok=True)
+    part_path.touch()
+
+    return UploadSessionResponse(
+        upload_id=session.id, offset=0, size=session.total_size
+    )
+
+
+@router.get("/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def get_upload(
+    upload_id: str,
+    response: Response,
+    db: AsyncSession = Depends(get_db),
+):
+    """Текущее смещение загрузки, с которого нужно продолжать передачу"""
+    session = await _get_session(db, upload_id)
+    result = _session_response(session)
+    response.headers["Upload-Offset"] = str(result.offset)
+    return result
+
+
+@router.put("/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    response: Response,
+    content_range: str = Header(...),
+    db: AsyncSession = Depends(get_db),
+):
+    """Прием блока байт, который дописывается прямо в хранилище
+
+    Первый блок проверяется по сигнатуре и заголовку изображения, как
+    при обычной загрузке: не-изображение или слишком большая картинка
+    отклоняются сразу, и загрузка удаляется.
+    """
+    session = await _get_session(db, upload_id)
+    start, end, total = _parse_content_range(content_range)
+    if total != session.total_size:
+        raise HTTPException(
+            status_code=400, detail="Content-Range total does not match upload size"
+        )
+
+    validator = None
+    if start == 0:
+        validator = ImageHeaderValidator(
+            expected_content_type=session.content_type
+        )
+    try:
+        offset = await append_stream(
+            _part_path(session.id),
+            request.stream(),
+            start=start,
+            max_size=min(end + 1, session.total_size),
+            chunk_size=settings.UPLOAD_CHUNK_SIZE,
+            validator=validator,
+        )
+    except InvalidImageError as e:
+        await db.delete(session)
+        await db.commit()
+        _part_path(session.id).unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail=str(e))
+    except UploadOffsetMismatchError as e:
+        raise HTTPException(
+            status_code=409,
+            detail=str(e),
+            headers={"Upload-Offset": str(e.offset)},
+        )
+    except UploadLockedError:
+        raise HTTPException(
+            status_code=409, detail="Another chunk is being uploaded"
+        )
+    except UploadTooLargeError:
+        raise HTTPException(
+            status_code=400, detail="Chunk is larger than its Content-Range"
+        )
+
+    response.headers["Upload-Offset"] = str(offset)
+    return UploadSessionResponse(
+        upload_id=session.id, offset=offset, size=session.total_size
+    )
+
+
+@router.post("/uploads/{upload_id}/complete", response_model=TaskResponse)
+async def complete_upload(
+    upload_id: str,
+    priority: Priority = "interactive",
+    db: AsyncSession = Depends(get_db),
+    relay: OutboxRelay = Depends(get_outbox_relay),
+    storage: StorageBackend = Depends(get_storage),
+):
+    """Завершение загрузки: файл переносится в хранилище оригиналов и
+    ставится в очередь на обработку так же, как при POST /images"""
+    session = await _get_session(db, upload_id)
+    part_path = _part_path(session.id)
+    offset = _current_offset(session.id)
+    if offset != session.total_size:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Upload is incomplete: {offset} of {session.total_size} bytes",
+            headers={"Upload-Offset": str(offset)},
+        )
+
+    # Заголовок проверяется до переноса файла в хранилище оригиналов
+    validator = ImageHeaderValidator(expected_content_type=session.content_type)
+    try:
+        info = await asyncio.to_thread(
+            validate_image_file, part_path, validator, settings.UPLOAD_CHUNK_SIZE
+        )
+    except InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    content_hash = await asyncio.to_thread(
+        hash_file, part_path, settings.UPLOAD_CHUNK_SIZE
+    )
+    key = await asyncio.to_thread(
+        commit_content_addressed,
+        part_path,
+        storage,
+        content_hash,
+        ALLOWED_CONTENT_TYPES[session.content_type],
+    )
+
+    # Удаление сессии фиксируется тем же commit, что и запись изображения.
+    # Если commit не прошел, байты возвращаются в .part и завершение
+    # можно повторить
+    try:
+        await db.execute(
+            delete(UploadSession).where(UploadSession.id == session.id)
+        )
+        image = await create_image_with_job(
+            db,
+            NewImage(key, content_hash, info.width, info.height),
+            priority=priority,
+        )
+    except BaseException:
+        await asyncio.to_thread(restore_upload_part, storage, key, part_path)
+        raise
+    if image.status != "DONE":
+        relay.notify()
+
+    return TaskResponse(task_id=image.id, status=image.status)
+
+
+@router.delete("/uploads/{upload_id}", status_code=204)
+async def abort_upload(
+    upload_id: str,
+    db: AsyncSession = Depends(get_db),
+):
+    """Отмена загрузки и удаление принятых байт"""
+    session = await _get_session(db, upload_id)
+    await db.delete(session)
+    await db.commit()
+    _part_path(session.id).unlink(missing_ok=True)
+    return Response(status_code=204)
@@ -0,0 +1,145 @@
+import asyncio
+import json
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import aio_pika
+from aio_pika.abc import AbstractChannel, AbstractRobustConnection
+from aio_pika.pool import Pool
+
+IMAGES_QUEUE = "images"
+# Отдельная очередь для массовых задач (бэкфиллов), чтобы они не
+# задерживали загрузки пользователей
+BULK_QUEUE = "images.bulk"
+DEAD_LETTER_QUEUE = "images.dead"
+# Заголовок с номером уже выполненных попыток обработки
+ATTEMPT_HEADER = "x-attempt"
+
+DEFAULT_PRIORITY = "interactive"
+PRIORITY_QUEUES = {"interactive": IMAGES_QUEUE, "bulk": BULK_QUEUE}
+
+
+def queue_for(priority: Optional[str]) -> str:
+    """Рабочая очередь для задачи с приоритетом priority"""
+    return PRIORITY_QUEUES.get(priority or DEFAULT_PRIORITY, IMAGES_QUEUE)
+
+
+def retry_delay(attempt: int, base_delay: float) -> float:
+    """Экспоненциальная задержка перед попыткой attempt + 1 (секунды)"""
+    return base_delay * 2 ** (attempt - 1)
+
+
+def retry_ttl_ms(delay: float) -> int:
+    return int(delay * 1000)
+
+
+def retry_queue_name(delay: float, queue: str = IMAGES_QUEUE) -> str:
+    """Очередь повтора с задержкой delay секунд
+
+    Задержка входит в имя: аргументы очереди в RabbitMQ менять нельзя, и
+    при новом WORKER_RETRY_BASE_DELAY объявляются новые очереди, а не
+    переобъявляются старые с другим x-message-ttl (PRECONDITION_FAILED).
+    """
+    return f"{queue}.retry.{retry_ttl_ms(delay)}ms"
+
+
+async def declare_topology(
+    channel: AbstractChannel, max_attempts: int, base_delay: float
+) -> None:
+    """Объявляет рабочие очереди, очереди отложенных повторов и dead-letter
+
+    У каждой рабочей очереди свои очереди повтора
+    <очередь>.retry.<задержка>ms. Они не имеют потребителей: сообщение
+    лежит в такой очереди retry_delay(N) секунд, после чего брокер по TTL
+    перекладывает его обратно в ту рабочую очередь, из которой оно пришло.
+    """
+    await channel.declare_queue(DEAD_LETTER_QUEUE, durable=True)
+    for queue in PRIORITY_QUEUES.values():
+        await channel.declare_queue(queue, durable=True)
+        for attempt in range(1, max_attempts):
+            delay = retry_delay(attempt, base_delay)
+            await channel.declare_queue(
+                retry_queue_name(delay, queue),
+                durable=True,
+                arguments={
+                    "x-message-ttl": retry_ttl_ms(delay),
+                    "x-dead-letter-exchange": "",
+                    "x-dead-letter-routing-key": queue,
+                },
+            )
+
+
+class RabbitMQPublisher:
+    """Долгоживущий издатель сообщений с пулом каналов
+
+    Соединение открывается один раз при старте приложения, очередь
+    объявляется один раз, а каналы переиспользуются между запросами.
+    """
+
+    def __init__(self, url: str, pool_size: int = 10):
+        self.url = url
+        self.pool_size = pool_size
+        self._connection: Optional[AbstractRobustConnection] = None
+        self._channel_pool: Optional[Pool[AbstractChannel]] = None
+
+    async def _get_channel(self) -> AbstractChannel:
+        assert self._connection is not None
+        return await self._connection.channel(publisher_confirms=True)
+
+    @property
+    def started(self) -> bool:
+        return self._channel_pool is not None
+
+    async def start(self) -> None:
+        connection = await aio_pika.connect_robust(self.url)
+        pool = Pool(self._get_channel, max_size=self.pool_size)
+        self._connection = connection
+        try:
+            async with pool.acquire() as channel:
+                for queue in PRIORITY_QUEUES.values():
+                    await channel.declare_queue(queue, durable=True)
+        except BaseException:
+            await pool.close()
+            await connection.close()
+            self._connection = None
+            raise
+        self._channel_pool = pool
+
+    async def close(self) -> None:
+        if self._channel_pool is not None:
+            await self._channel_pool.close()
+            self._channel_pool = None
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def publish(
+        self,
+        payload: Dict[str, Any],
+        routing_key: str = IMAGES_QUEUE,
+    ) -> None:
+        await self.publish_batch([(routing_key, payload)])
+
+    async def publish_batch(
+        self,
+        messages: Iterable[Tuple[str, Dict[str, Any]]],
+    ) -> None:
+        """Публикует пачку сообщений и дожидается подтверждений брокера
+
+        Каналы открываются с publisher confirms, публикации в пачке идут
+        конвейером, а метод возвращается только после того, как брокер
+        подтвердил все сообщения.
+        """
+        if self._channel_pool is None:
+            raise RuntimeError("Publisher is not started")
+
+        async with self._channel_pool.acquire() as channel:
+            await asyncio.gather(*(
+                channel.default_exchange.publish(
+                    aio_pika.Message(
+                        body=json.dumps(payload).encode(),
+                        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                    ),
+                    routing_key=routing_key,
+                )
+                for routing_key, payload in messages
+            ))
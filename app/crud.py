@@ -1,22 +1,132 @@
-from sqlalchemy import select
+from datetime import datetime, timedelta
+from sqlalchemy import (
+    JSON, and_, cast, delete, func, insert, or_, select, text, update
+)
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import Optional, Dict
+from typing import Optional, Dict, Iterable, List, NamedTuple
 from uuid import UUID
 
-from app.models import Image
+from app.broker import DEFAULT_PRIORITY, queue_for
+from app.image_cache import image_cache
+from app.models import Image, OutboxMessage, UploadSession
 
+# Статусы задачи, которую обрабатывает worker: запись под арендой.
+# PARTIAL - часть миниатюр уже готова и доступна
+IN_PROGRESS_STATUSES = ("PROCESSING", "PARTIAL")
 
-async def create_image(db: AsyncSession, original_url: str) -> Image:
-    image = Image(status="NEW", original_url=original_url)
-    db.add(image)
+
+class NewImage(NamedTuple):
+    """Сохраненный оригинал, для которого создается запись"""
+
+    original_url: str
+    content_hash: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+
+async def _find_done_thumbnails(
+    db: AsyncSession, content_hashes: Iterable[str]
+) -> Dict[str, dict]:
+    """Миниатюры уже обработанных изображений с заданными хешами
+
+    Returns:
+        {хеш: значения thumbnails и thumbnail_meta для новой записи}
+    """
+    result = await db.execute(
+        select(Image.content_hash, Image.thumbnails, Image.thumbnail_meta)
+        .where(Image.content_hash.in_(set(content_hashes)))
+        .where(Image.status == "DONE")
+    )
+    return {
+        content_hash: {"thumbnails": thumbnails, "thumbnail_meta": meta or {}}
+        for content_hash, thumbnails, meta in result
+    }
+
+
+def _job(image: Image) -> dict:
+    """Строка outbox с задачей на обработку изображения"""
+    return {
+        "routing_key": queue_for(image.priority),
+        "payload": {
+            "image_id": str(image.id),
+            "original_path": image.original_url,
+            "width": image.width,
+            "height": image.height,
+            "priority": image.priority,
+        },
+    }
+
+
+async def create_images_with_jobs(
+    db: AsyncSession,
+    originals: List[NewImage],
+    status: str = "QUEUED",
+    priority: str = DEFAULT_PRIORITY,
+) -> List[Image]:
+    """Создает записи изображений и задачи на обработку в одной транзакции
+
+    Задачи попадают в таблицу outbox и публикуются в брокер отдельным
+    релеем, поэтому запрос делает ровно один commit и не ждет RabbitMQ.
+    Все записи вставляются одним INSERT ... RETURNING. Если изображение
+    с тем же содержимым уже обработано, новая запись сразу получает
+    статус DONE и его миниатюры, а задача не создается.
+
+    priority выбирает рабочую очередь: interactive для загрузок
+    пользователей, bulk для массовой обработки.
+    """
+    done = await _find_done_thumbnails(
+        db, (original.content_hash for original in originals)
+    )
+    rows = []
+    for original in originals:
+        row = {
+            "status": status,
+            "thumbnails": {},
+            "thumbnail_meta": {},
+            "priority": priority,
+            **original._asdict(),
+        }
+        if original.content_hash in done:
+            row.update(status="DONE", **done[original.content_hash])
+        rows.append(row)
+
+    result = await db.execute(
+        insert(Image).returning(Image, sort_by_parameter_order=True), rows
+    )
+    images = list(result.scalars().all())
+
+    jobs = [_job(image) for image in images if image.status != "DONE"]
+    if jobs:
+        await db.execute(insert(OutboxMessage), jobs)
     await db.commit()
-    await db.refresh(image)
-    return image
+    return images
+
+
+async def create_image_with_job(
+    db: AsyncSession,
+    original: NewImage,
+    status: str = "QUEUED",
+    priority: str = DEFAULT_PRIORITY,
+) -> Image:
+    images = await create_images_with_jobs(db, [original], status, priority)
+    return images[0]
 
 
 async def get_image(db: AsyncSession, image_id: UUID) -> Optional[Image]:
+    """Запись изображения, по возможности из image_cache
+
+    Закешированная запись - копия, не привязанная к сессии db; ее
+    нельзя изменять.
+    """
+    image = image_cache.get(image_id)
+    if image is not None:
+        return image
     result = await db.execute(select(Image).filter(Image.id == image_id))
-    return result.scalar_one_or_none()
+    image = result.scalar_one_or_none()
+    if image is not None:
+        image_cache.put(image)
+    return image
 
 
 async def update_image_status(
@@ -25,14 +135,256 @@ async def update_image_status(
     status: str,
     thumbnails: Optional[Dict[str, str]] = None,
     error: Optional[str] = None,
+    expected_status: Optional[str] = None,
+    thumbnail_meta: Optional[Dict[str, dict]] = None,
+) -> Optional[Image]:
+    """Меняет статус одним UPDATE ... RETURNING
+
+    При переходе из PROCESSING/PARTIAL в любой другой статус аренда
+    задачи снимается. Если передан expected_status, запись меняется только из
+    этого статуса (compare-and-set).
+
+    Returns:
+        Обновленная запись или None, если изображение не найдено
+        или его статус не совпал с expected_status
+    """
+    values = {"status": status}
+    if status not in IN_PROGRESS_STATUSES:
+        values["lease_expires_at"] = None
+    if thumbnails is not None:
+        values["thumbnails"] = thumbnails
+    if thumbnail_meta is not None:
+        values["thumbnail_meta"] = thumbnail_meta
+    if error is not None:
+        values["error_message"] = error
+
+    statement = update(Image).where(Image.id == image_id)
+    if expected_status is not None:
+        statement = statement.where(Image.status == expected_status)
+
+    result = await db.execute(
+        statement
+        .values(**values)
+        .returning(Image)
+        .execution_options(populate_existing=True)
+    )
+    image = result.scalar_one_or_none()
+    await db.commit()
+    image_cache.invalidate(image_id)
+    return image
+
+
+def _merge_json(column, values: dict):
+    # Слияние JSON-объектов на стороне БД: ключи из values дописываются
+    # к уже сохраненным, поэтому параллельные записи не затирают друг друга
+    stored = func.coalesce(cast(column, JSONB), text("'{}'::jsonb"))
+    return cast(stored.op("||")(cast(values, JSONB)), JSON)
+
+
+async def add_thumbnails(
+    db: AsyncSession,
+    image_id: UUID,
+    thumbnails: Dict[str, str],
+    thumbnail_meta: Dict[str, dict],
+    status: str = "PARTIAL",
 ) -> Optional[Image]:
-    image = await get_image(db, image_id)
-    if image:
-        image.status = status
-        if thumbnails is not None:
-            image.thumbnails = thumbnails
-        if error is not None:
-            image.error_message = error
-        await db.commit()
-        await db.refresh(image)
+    """Дописывает готовые миниатюры в запись одним UPDATE ... RETURNING
+
+    Запись переходит в status (PARTIAL, пока готовы не все размеры, и
+    DONE с последним), только если она все еще в обработке у worker'а.
+
+    Returns:
+        Обновленная запись или None, если задача уже не в обработке
+    """
+    values = {
+        "status": status,
+        "thumbnails": _merge_json(Image.thumbnails, thumbnails),
+        "thumbnail_meta": _merge_json(Image.thumbnail_meta, thumbnail_meta),
+    }
+    if status not in IN_PROGRESS_STATUSES:
+        values["lease_expires_at"] = None
+    result = await db.execute(
+        update(Image)
+        .where(Image.id == image_id)
+        .where(Image.status.in_(IN_PROGRESS_STATUSES))
+        .values(**values)
+        .returning(Image)
+        .execution_options(populate_existing=True)
+    )
+    image = result.scalar_one_or_none()
+    await db.commit()
+    image_cache.invalidate(image_id)
     return image
+
+
+async def claim_image(
+    db: AsyncSession, image_id: UUID, lease_seconds: float
+) -> Optional[Image]:
+    """Атомарно забирает задачу в работу
+
+    Запись переходит в PROCESSING с арендой на lease_seconds, только если
+    она еще ждет обработки (NEW/QUEUED) или предыдущий worker не продлил
+    аренду вовремя (PROCESSING/PARTIAL). Для уже обработанных или занятых задач возвращает
+    None, так что повторная доставка стоит одного UPDATE по первичному
+    ключу.
+    """
+    claimable = or_(
+        Image.status.in_(["NEW", "QUEUED"]),
+        and_(
+            Image.status.in_(IN_PROGRESS_STATUSES),
+            or_(
+                Image.lease_expires_at.is_(None),
+                Image.lease_expires_at < func.now(),
+            ),
+        ),
+    )
+    result = await db.execute(
+        update(Image)
+        .where(Image.id == image_id)
+        .where(claimable)
+        .values(
+            status="PROCESSING",
+            lease_expires_at=func.now() + timedelta(seconds=lease_seconds),
+        )
+        .returning(Image)
+        .execution_options(populate_existing=True)
+    )
+    image = result.scalar_one_or_none()
+    await db.commit()
+    image_cache.invalidate(image_id)
+    return image
+
+
+async def extend_lease(
+    db: AsyncSession,
+    image_id: UUID,
+    lease_expires_at: datetime,
+    lease_seconds: float,
+) -> Optional[datetime]:
+    """Продлевает аренду задачи, пока worker ее обрабатывает
+
+    Срок аренды, полученный при claim_image или прошлом продлении,
+    служит маркером владения: если задачу забрал другой worker, срок
+    уже другой и запись не меняется.
+
+    Returns:
+        Новый срок аренды или None, если аренда потеряна
+    """
+    result = await db.execute(
+        update(Image)
+        .where(Image.id == image_id)
+        .where(Image.status.in_(IN_PROGRESS_STATUSES))
+        .where(Image.lease_expires_at == lease_expires_at)
+        .values(lease_expires_at=func.now() + timedelta(seconds=lease_seconds))
+        .returning(Image.lease_expires_at)
+    )
+    expires_at = result.scalar_one_or_none()
+    await db.commit()
+    return expires_at
+
+
+async def release_image(
+    db: AsyncSession,
+    image_id: UUID,
+    lease_expires_at: datetime,
+    status: str,
+    error: Optional[str] = None,
+) -> Optional[Image]:
+    """Снимает аренду после неудачной попытки (QUEUED или ERROR)
+
+    Запись меняется, только если она все еще в обработке под той же
+    арендой, так что задачу, которую уже забрал другой worker или
+    reaper, неудачная попытка не трогает.
+
+    Returns:
+        Обновленная запись или None, если аренда потеряна
+    """
+    result = await db.execute(
+        update(Image)
+        .where(Image.id == image_id)
+        .where(Image.status.in_(IN_PROGRESS_STATUSES))
+        .where(Image.lease_expires_at == lease_expires_at)
+        .values(status=status, lease_expires_at=None, error_message=error)
+        .returning(Image)
+        .execution_options(populate_existing=True)
+    )
+    image = result.scalar_one_or_none()
+    await db.commit()
+    image_cache.invalidate(image_id)
+    return image
+
+
+async def requeue_stale_images(db: AsyncSession, limit: int) -> List[Image]:
+    """Возвращает в очередь задачи, чья аренда истекла
+
+    Worker, упавший посреди обработки, оставляет запись в PROCESSING
+    или PARTIAL.
+    Такие записи (по ix_images_status) переводятся в QUEUED, и для них в
+    той же транзакции создаются задачи в outbox. Строки блокируются с
+    SKIP LOCKED, поэтому несколько экземпляров не возьмут одну пачку.
+    Если исходное сообщение все же будет доставлено повторно, лишнюю
+    задачу отсеет claim_image.
+    """
+    stale = (
+        select(Image.id)
+        .where(Image.status.in_(IN_PROGRESS_STATUSES))
+        .where(
+            or_(
+                Image.lease_expires_at.is_(None),
+                Image.lease_expires_at < func.now(),
+            )
+        )
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    result = await db.execute(
+        update(Image)
+        .where(Image.id.in_(stale))
+        .values(status="QUEUED", lease_expires_at=None)
+        .returning(Image)
+        .execution_options(populate_existing=True)
+    )
+    images = list(result.scalars().all())
+    if images:
+        await db.execute(
+            insert(OutboxMessage), [_job(image) for image in images]
+        )
+    await db.commit()
+    for image in images:
+        image_cache.invalidate(image.id)
+    return images
+
+
+async def find_old_upload_sessions(
+    db: AsyncSession,
+    age_seconds: float,
+    limit: int,
+    after: Optional[UUID] = None,
+) -> List[UUID]:
+    """id сессий загрузки, созданных больше age_seconds секунд назад
+
+    Сессии перебираются по id, начиная после after.
+    """
+    query = (
+        select(UploadSession.id)
+        .where(
+            UploadSession.created_at
+            < func.now() - timedelta(seconds=age_seconds)
+        )
+        .order_by(UploadSession.id)
+        .limit(limit)
+    )
+    if after is not None:
+        query = query.where(UploadSession.id > after)
+    result = await db.execute(query)
+    return list(result.scalars().all())
+
+
+async def delete_upload_sessions(
+    db: AsyncSession, upload_ids: Iterable[UUID]
+) -> None:
+    await db.execute(
+        delete(UploadSession).where(UploadSession.id.in_(list(upload_ids)))
+    )
+    await db.commit()
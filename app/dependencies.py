@@ -1,13 +1,15 @@
-from contextlib import asynccontextmanager
-
+from fastapi import Request
 from sqlalchemy.ext.asyncio import (
     AsyncSession,
     async_sessionmaker,
     create_async_engine
 )
-from aio_pika import connect_robust
 
 from app.core.config import settings
+from app.image_events import ImageEventListener
+from app.outbox import OutboxRelay
+from app.storage_backends import StorageBackend, default_storage
+from app.thumbnail_cache import ThumbnailCache
 
 engine = create_async_engine(settings.DATABASE_URL, echo=True)
 AsyncSessionLocal = async_sessionmaker(
@@ -25,11 +27,21 @@ async def get_db():
             await session.close()
 
 
-@asynccontextmanager
-async def get_rabbitmq():
-    connection = await connect_robust(settings.RABBITMQ_URL)
-    channel = await connection.channel()
-    try:
-        yield connection, channel
-    finally:
-        await connection.close()
+async def get_outbox_relay(request: Request) -> OutboxRelay:
+    """Релей outbox, запущенный при старте приложения"""
+    return request.app.state.outbox_relay
+
+
+async def get_image_events(request: Request) -> ImageEventListener:
+    """Слушатель изменений записей images, запущенный при старте"""
+    return request.app.state.image_events
+
+
+async def get_thumbnail_cache(request: Request) -> ThumbnailCache:
+    """Кеш миниатюр по запросу, загруженный при старте приложения"""
+    return request.app.state.thumbnail_cache
+
+
+def get_storage() -> StorageBackend:
+    """Хранилище оригиналов и миниатюр из STORAGE_BACKEND"""
+    return default_storage()
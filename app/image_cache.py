@@ -0,0 +1,103 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+from uuid import UUID
+
+from sqlalchemy import inspect
+
+from app.core.config import settings
+from app.models import Image
+
+# Статусы, после которых запись не меняется без повторной обработки
+STABLE_STATUSES = ("DONE",)
+
+
+class ImageCache:
+    """Кеш записей images в памяти процесса с TTL и LRU-вытеснением
+
+    Готовые (DONE) записи живут done_ttl секунд, остальные - active_ttl:
+    статус обрабатываемого изображения меняет worker в другом процессе,
+    и короткий TTL ограничивает, насколько устаревшим может быть ответ.
+    Изменения, сделанные через crud в этом процессе, сбрасывают запись
+    сразу.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        done_ttl: float,
+        active_ttl: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.done_ttl = done_ttl
+        self.active_ttl = active_ttl
+        self._clock = clock
+        self._entries: "OrderedDict[UUID, Tuple[float, Image]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, image_id: UUID) -> Optional[Image]:
+        entry = self._entries.get(image_id)
+        if entry is not None:
+            expires_at, image = entry
+            if expires_at > self._clock():
+                self._entries.move_to_end(image_id)
+                self.hits += 1
+                return image
+            del self._entries[image_id]
+        self.misses += 1
+        return None
+
+    def put(self, image: Image) -> None:
+        if self.max_entries <= 0:
+            return
+        ttl = (
+            self.done_ttl if image.status in STABLE_STATUSES
+            else self.active_ttl
+        )
+        if ttl <= 0:
+            return
+        self._entries[image.id] = (self._clock() + ttl, _snapshot(image))
+        self._entries.move_to_end(image.id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, image_id: UUID) -> None:
+        if self._entries.pop(image_id, None) is not None:
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+def _snapshot(image: Image) -> Image:
+    """Копия записи, не привязанная к сессии
+
+    Кешированный объект переживает сессию запроса и читается из многих
+    запросов, поэтому он не должен ни подгружать атрибуты, ни попадать
+    в чужую сессию.
+    """
+    return Image(**{
+        attr.key: getattr(image, attr.key)
+        for attr in inspect(Image).column_attrs
+    })
+
+
+image_cache = ImageCache(
+    settings.IMAGE_CACHE_SIZE,
+    settings.IMAGE_CACHE_DONE_TTL,
+    settings.IMAGE_CACHE_ACTIVE_TTL,
+)
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Set
+from uuid import UUID
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+# Канал, в который триггер images_notify_change (миграция 009) шлет
+# {"id": ..., "status": ...} при изменении статуса или миниатюр
+CHANNEL = "image_events"
+
+Subscriber = Callable[[UUID, str], None]
+
+
+def asyncpg_dsn(database_url: str) -> str:
+    """DSN для asyncpg из URL SQLAlchemy (postgresql+asyncpg://...)"""
+    scheme, sep, rest = database_url.partition("://")
+    return f"{scheme.split('+')[0]}{sep}{rest}"
+
+
+async def wait_changed(changed: asyncio.Future,
+                       timeout: float) -> Optional[str]:
+    """Ждет future из ImageEventListener.watch не дольше timeout секунд
+
+    Returns:
+        Новый статус или None по таймауту
+    """
+    try:
+        return await asyncio.wait_for(changed, timeout)
+    except asyncio.TimeoutError:
+        return None
+
+
+class ImageEventListener:
+    """Слушает изменения записей images через LISTEN/NOTIFY
+
+    Одно соединение на процесс API. События раздаются подписчикам
+    (локальным кешам) и ожидающим запросам. Пока соединения нет,
+    события могут быть потеряны, поэтому при разрыве подписчики
+    получают reset и сбрасывают кеши целиком.
+    """
+
+    def __init__(
+        self,
+        dsn: str,
+        reconnect_delay: float = 1.0,
+        liveness_interval: float = 30.0,
+        liveness_timeout: float = 5.0,
+    ):
+        self.dsn = dsn
+        self.reconnect_delay = reconnect_delay
+        self.liveness_interval = liveness_interval
+        self.liveness_timeout = liveness_timeout
+        self.connected = False
+        self.events_total = 0
+        self._subscribers: List[Subscriber] = []
+        self._resets: List[Callable[[], None]] = []
+        self._waiters: Dict[UUID, Set[asyncio.Future]] = {}
+
+    def subscribe(
+        self,
+        callback: Subscriber,
+        reset: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """callback(id, status) на каждое событие, reset() при разрыве"""
+        self._subscribers.append(callback)
+        if reset is not None:
+            self._resets.append(reset)
+
+    @contextmanager
+    def watch(self, image_id: UUID) -> Iterator[asyncio.Future]:
+        """Регистрирует ожидание следующего изменения записи
+
+        Future получает новый статус. Регистрировать ожидание нужно до
+        чтения записи: изменение между чтением и ожиданием иначе было бы
+        пропущено.
+        """
+        future = asyncio.get_running_loop().create_future()
+        waiters = self._waiters.setdefault(image_id, set())
+        waiters.add(future)
+        try:
+            yield future
+        finally:
+            future.cancel()
+            waiters.discard(future)
+            if not waiters:
+                self._waiters.pop(image_id, None)
+
+    def dispatch(self, image_id: UUID, status: str) -> None:
+        self.events_total += 1
+        for callback in self._subscribers:
+            try:
+                callback(image_id, status)
+            except Exception as e:
+                logger.error(f"Image event subscriber error: {e}")
+        for future in self._waiters.get(image_id, ()):
+            if not future.done():
+                future.set_result(status)
+
+    def _on_notification(self, connection, pid, channel, payload) -> None:
+        try:
+            event = json.loads(payload)
+            image_id, status = UUID(event["id"]), event["status"]
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Malformed image event: {payload}")
+            return
+        self.dispatch(image_id, status)
+
+    def _reset(self) -> None:
+        for reset in self._resets:
+            reset()
+
+    async def listen_once(self) -> None:
+        """Слушает до разрыва соединения
+
+        Разрыв без закрытия TCP (падение сервера, смена NAT, failover)
+        сам не обнаруживается, поэтому раз в liveness_interval секунд
+        соединение проверяется запросом SELECT 1. Если ответа нет за
+        liveness_timeout секунд, соединение считается потерянным.
+        """
+        connection = await asyncpg.connect(self.dsn)
+        closed = asyncio.Event()
+        connection.add_termination_listener(lambda _: closed.set())
+        try:
+            await connection.add_listener(CHANNEL, self._on_notification)
+            # События до подписки могли быть пропущены
+            self._reset()
+            self.connected = True
+            logger.info(f"Listening for {CHANNEL} notifications")
+            while not closed.is_set():
+                try:
+                    await asyncio.wait_for(
+                        closed.wait(), self.liveness_interval
+                    )
+                except asyncio.TimeoutError:
+                    await connection.fetchval(
+                        "SELECT 1", timeout=self.liveness_timeout
+                    )
+        finally:
+            self.connected = False
+            self._reset()
+            if not connection.is_closed():
+                # Соединение может не отвечать, поэтому без ожидания
+                connection.terminate()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.listen_once()
+                logger.warning("Image events connection closed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Image events listener error: {e}")
+            await asyncio.sleep(self.reconnect_delay)
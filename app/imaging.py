@@ -0,0 +1,329 @@
+import io
+import math
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Tuple
+
+from PIL import Image, ImageChops, ImageOps, ImageStat, features
+from PIL.Image import Resampling
+
+Size = Tuple[int, int]
+
+THUMBNAIL_SIZES = [(100, 100), (300, 300), (1200, 1200)]
+
+# Как в Image.thumbnail: сначала быстрое уменьшение в целое число раз
+# (reduce), затем LANCZOS на оставшемся множителе
+REDUCING_GAP = 2.0
+
+
+class Encoding(NamedTuple):
+    """Формат, в котором сохраняются миниатюры"""
+
+    pil_format: str
+    extension: str
+    media_type: str
+    options: Dict[str, Any]
+    # Модуль Pillow, без которого формат недоступен
+    feature: Optional[str] = None
+    # Замены options на время подбора качества по PSNR: только те, что
+    # ускоряют кодирование, почти не меняя пиксели
+    search_options: Dict[str, Any] = {}
+
+
+# JPEG сохраняется всегда и под ключом "WxH" в thumbnails, остальные
+# форматы - дополнительно под ключом "WxH.<формат>"
+DEFAULT_ENCODING = "jpeg"
+ENCODINGS = {
+    # optimize только пересчитывает таблицы Хаффмана: пиксели те же, поэтому
+    # при поиске по PSNR его можно пропустить
+    "jpeg": Encoding("JPEG", ".jpg", "image/jpeg",
+                     {"quality": 85, "optimize": True},
+                     search_options={"optimize": False}),
+    "webp": Encoding("WEBP", ".webp", "image/webp",
+                     {"quality": 80, "method": 4}, feature="webp",
+                     search_options={"method": 2}),
+    "avif": Encoding("AVIF", ".avif", "image/avif",
+                     {"quality": 60, "speed": 6}, feature="avif"),
+}
+
+
+def encoding_available(name: str) -> bool:
+    encoding = ENCODINGS.get(name)
+    if encoding is None:
+        return False
+    return encoding.feature is None or bool(features.check(encoding.feature))
+
+
+def thumbnail_key(box: Size, encoding: str = DEFAULT_ENCODING) -> str:
+    """Ключ миниатюры в словаре thumbnails записи изображения"""
+    key = f"{box[0]}x{box[1]}"
+    return key if encoding == DEFAULT_ENCODING else f"{key}.{encoding}"
+
+
+def parse_thumbnail_key(key: str) -> Optional[Tuple[Size, str]]:
+    """Обратное к thumbnail_key; None для нераспознанных ключей"""
+    name, _, encoding = key.partition(".")
+    width, _, height = name.partition("x")
+    if not (width.isdigit() and height.isdigit()):
+        return None
+    return (int(width), int(height)), encoding or DEFAULT_ENCODING
+
+
+def save_image(image: Image.Image, fp, encoding: str) -> None:
+    spec = ENCODINGS[encoding]
+    image.save(fp, spec.pil_format, **spec.options)
+
+
+class QualityPolicy(NamedTuple):
+    """Как подбирать качество кодирования миниатюры
+
+    Ищется наименьшее качество, при котором PSNR не ниже min_psnr, но
+    не выше того, при котором файл укладывается в max_bytes: бюджет по
+    размеру важнее. Без обоих ограничений используется качество формата
+    по умолчанию. Каждый из двух поисков делает не больше max_steps
+    кодирований и, не сойдясь, берет ближайшее качество, про которое
+    известно, что оно подходит.
+    """
+
+    max_bytes: Optional[int] = None
+    min_psnr: Optional[float] = None
+    min_quality: int = 40
+    max_quality: int = 90
+    max_steps: int = 4
+
+
+# Политики по форматам: шкалы качества у кодеков разные, а WebP и AVIF
+# при том же PSNR дают файл меньше JPEG. Маленькие миниатюры смотрят
+# мельком - им хватает меньшего PSNR. AVIF кодируется на порядок
+# медленнее, поэтому и шагов поиска у него меньше
+QUALITY_POLICIES = {
+    "jpeg": {
+        (100, 100): QualityPolicy(max_bytes=8 * 1024, min_psnr=34.0),
+        (300, 300): QualityPolicy(max_bytes=40 * 1024, min_psnr=36.0),
+        (1200, 1200): QualityPolicy(max_bytes=300 * 1024, min_psnr=38.0),
+    },
+    "webp": {
+        (100, 100): QualityPolicy(max_bytes=6 * 1024, min_psnr=33.0),
+        (300, 300): QualityPolicy(max_bytes=30 * 1024, min_psnr=35.0),
+        (1200, 1200): QualityPolicy(max_bytes=220 * 1024, min_psnr=37.0),
+    },
+    "avif": {
+        (100, 100): QualityPolicy(
+            max_bytes=5 * 1024, min_psnr=32.0, min_quality=30,
+            max_quality=75, max_steps=3,
+        ),
+        (300, 300): QualityPolicy(
+            max_bytes=24 * 1024, min_psnr=34.0, min_quality=30,
+            max_quality=75, max_steps=3,
+        ),
+        (1200, 1200): QualityPolicy(
+            max_bytes=160 * 1024, min_psnr=36.0, min_quality=30,
+            max_quality=75, max_steps=3,
+        ),
+    },
+}
+
+
+def quality_policy(encoding: str, box: Size) -> QualityPolicy:
+    """Политика подбора качества для формата encoding и размера box"""
+    return QUALITY_POLICIES.get(encoding, {}).get(box, QualityPolicy())
+
+
+class EncodedImage(NamedTuple):
+    data: bytes
+    quality: int
+
+
+def psnr(reference: Image.Image, data: bytes) -> float:
+    """PSNR (дБ) закодированного изображения относительно исходного"""
+    with Image.open(io.BytesIO(data)) as decoded:
+        decoded = decoded.convert(reference.mode)
+    stat = ImageStat.Stat(ImageChops.difference(reference, decoded))
+    pixels = reference.width * reference.height
+    mse = sum(stat.sum2) / (pixels * len(stat.sum2))
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+class _Encoder:
+    """Кодирования одного изображения в память, каждое не больше раза
+
+    Неточное кодирование использует search_options формата и годится
+    для оценки PSNR; размер файла сравнивается только у точного.
+    """
+
+    def __init__(self, image: Image.Image, encoding: str):
+        self.image = image
+        self.spec = ENCODINGS[encoding]
+        self._encoded: Dict[Tuple[int, bool], bytes] = {}
+
+    def encode(self, quality: int, exact: bool = False) -> bytes:
+        exact = exact or not self.spec.search_options
+        if (quality, exact) not in self._encoded:
+            options = self.spec.options
+            if not exact:
+                options = {**options, **self.spec.search_options}
+            buffer = io.BytesIO()
+            self.image.save(
+                buffer, self.spec.pil_format, **{**options, "quality": quality}
+            )
+            self._encoded[quality, exact] = buffer.getvalue()
+        return self._encoded[quality, exact]
+
+
+def _lowest(low: int, high: int, accept, max_steps: int) -> Tuple[int, int]:
+    """Сужает [low, high] к наименьшему качеству, для которого accept
+    истинно: ниже low оно ложно, на high истинно (или high - верхняя
+    граница). Останавливается по исчерпании max_steps шагов"""
+    for _ in range(max_steps):
+        if low >= high:
+            break
+        middle = (low + high) // 2
+        if accept(middle):
+            high = middle
+        else:
+            low = middle + 1
+    return low, high
+
+
+def encode_adaptive(
+    image: Image.Image, encoding: str, policy: QualityPolicy
+) -> EncodedImage:
+    """Кодирует изображение, подбирая качество бинарным поиском
+
+    Каждый шаг поиска - кодирование в память, не больше policy.max_steps
+    шагов на поиск. Поиск по PSNR кодирует с search_options формата
+    (например, JPEG без optimize), поиск по бюджету и результат - с
+    полными options.
+    """
+    encoder = _Encoder(image, encoding)
+    if policy.max_bytes is None and policy.min_psnr is None:
+        quality = encoder.spec.options["quality"]
+        return EncodedImage(encoder.encode(quality, exact=True), quality)
+
+    low, high = policy.min_quality, policy.max_quality
+    if policy.min_psnr is not None:
+        def sharp_enough(quality: int) -> bool:
+            return psnr(image, encoder.encode(quality)) >= policy.min_psnr
+
+        # Цель, недостижимая и на верхней границе, поиска не требует
+        if sharp_enough(high):
+            _, high = _lowest(low, high, sharp_enough, policy.max_steps)
+    quality = high
+    if policy.max_bytes is not None:
+        def too_big(quality: int) -> bool:
+            data = encoder.encode(quality, exact=True)
+            return len(data) > policy.max_bytes
+
+        if too_big(high):
+            # Наибольшее качество, про которое известно, что оно
+            # укладывается в бюджет: на единицу меньше нижней границы
+            # поиска качеств, в него уже не укладывающихся
+            fits, _ = _lowest(low, high, too_big, policy.max_steps)
+            quality = max(low, fits - 1)
+    return EncodedImage(encoder.encode(quality, exact=True), quality)
+
+
+# Режимы вписывания для миниатюр по запросу: contain - целиком внутри
+# рамки, cover - заполняет рамку целиком с обрезкой краев
+FIT_MODES = ("contain", "cover")
+
+
+def fit_size(size: Size, box: Size) -> Size:
+    """Размер, вписанный в box с сохранением пропорций, без увеличения"""
+    width, height = size
+    scale = min(box[0] / width, box[1] / height, 1.0)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def render_thumbnails(
+    path: str, sizes: Iterable[Size] = THUMBNAIL_SIZES
+) -> Dict[Size, Image.Image]:
+    """Строит миниатюры всех размеров за одно декодирование оригинала
+
+    JPEG декодируется сразу в уменьшенном масштабе DCT (Image.draft),
+    ближайшем сверху к самой большой миниатюре. Размеры строятся
+    каскадом от большего к меньшему: каждая следующая миниатюра
+    получается из предыдущей, а не из полного кадра.
+
+    Returns:
+        Словарь {запрошенный размер: миниатюра в режиме RGB}
+    """
+    boxes = sorted(set(sizes), key=lambda box: box[0] * box[1], reverse=True)
+    thumbnails: Dict[Size, Image.Image] = {}
+    if not boxes:
+        return thumbnails
+
+    with Image.open(path) as img:
+        img.draft("RGB", fit_size(img.size, boxes[0]))
+        current = img.convert("RGB") if img.mode != "RGB" else img.copy()
+
+    for box in boxes:
+        target = fit_size(current.size, box)
+        if target != current.size:
+            current = current.resize(
+                target, Resampling.LANCZOS, reducing_gap=REDUCING_GAP
+            )
+        thumbnails[box] = current
+    return thumbnails
+
+
+def required_size(size: Size, box: Size, fit: str = "contain") -> Size:
+    """Минимальный размер источника, из которого получится миниатюра box
+
+    Для contain это сама вписанная миниатюра, для cover - изображение,
+    уменьшенное так, чтобы покрыть рамку по обеим сторонам. Увеличение
+    не выполняется, поэтому результат не больше size.
+    """
+    if fit == "contain":
+        return fit_size(size, box)
+    width, height = size
+    scale = min(max(box[0] / width, box[1] / height), 1.0)
+    return (
+        min(width, math.ceil(width * scale)),
+        min(height, math.ceil(height * scale)),
+    )
+
+
+def nearest_rendition(
+    size: Size, renditions: Iterable[Size], box: Size, fit: str = "contain"
+) -> Optional[Size]:
+    """Выбирает наименьшую сохраненную миниатюру, пригодную для box
+
+    renditions - рамки сохраненных миниатюр; каждая вписана в свою рамку
+    с сохранением пропорций оригинала размера size. Возвращает None,
+    если ни одна не подходит и строить нужно из оригинала.
+    """
+    need = required_size(size, box, fit)
+    candidates = [
+        fit_size(size, rendition) + (rendition,)
+        for rendition in renditions
+    ]
+    suitable = [
+        (width * height, rendition)
+        for width, height, rendition in candidates
+        if width >= need[0] and height >= need[1]
+    ]
+    return min(suitable)[1] if suitable else None
+
+
+def render_fit(path: str, box: Size, fit: str = "contain") -> Image.Image:
+    """Строит одну миниатюру box из файла path в режиме fit
+
+    JPEG декодируется сразу в уменьшенном масштабе, как и в
+    render_thumbnails. Миниатюра не бывает больше источника.
+    """
+    with Image.open(path) as img:
+        need = required_size(img.size, box, fit)
+        img.draft("RGB", need)
+        current = img.convert("RGB") if img.mode != "RGB" else img.copy()
+
+    if fit == "contain":
+        target = fit_size(current.size, box)
+        if target == current.size:
+            return current
+        return current.resize(
+            target, Resampling.LANCZOS, reducing_gap=REDUCING_GAP
+        )
+    # Обрезка до пропорций рамки, не больше самого источника
+    target = (min(box[0], current.width), min(box[1], current.height))
+    return ImageOps.fit(current, target, Resampling.LANCZOS)
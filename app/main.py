@@ -1,11 +1,85 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+from pathlib import Path
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.api.v1.endpoints import images
+from app.api.v1.endpoints import images, uploads
+from app.broker import RabbitMQPublisher
 from app.core.config import settings
-from app.schemas import HealthResponse
+from app.dependencies import AsyncSessionLocal
+from app.image_cache import image_cache
+from app.image_events import ImageEventListener, asyncpg_dsn
+from app.middleware import MaxBodySizeMiddleware
+from app.outbox import OutboxRelay
+from app.reaper import StaleJobReaper
+from app.schemas import (
+    HealthResponse,
+    ImageCacheStats,
+    ImageEventsStats,
+    ReaperStats,
+    StatsResponse,
+)
+from app.thumbnail_cache import ThumbnailCache
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    publisher = RabbitMQPublisher(
+        settings.RABBITMQ_URL, pool_size=settings.RABBITMQ_CHANNEL_POOL_SIZE
+    )
+    # Подключение к брокеру выполняет релей: без брокера API все равно
+    # принимает загрузки, задачи ждут в outbox
+    app.state.publisher = publisher
 
-app = FastAPI(title=settings.PROJECT_NAME)
+    relay = OutboxRelay(
+        AsyncSessionLocal,
+        publisher,
+        batch_size=settings.OUTBOX_BATCH_SIZE,
+        poll_interval=settings.OUTBOX_POLL_INTERVAL,
+    )
+    app.state.outbox_relay = relay
+    relay_task = asyncio.create_task(relay.run())
+
+    reaper = StaleJobReaper(
+        AsyncSessionLocal,
+        relay,
+        batch_size=settings.REAPER_BATCH_SIZE,
+        interval=settings.REAPER_INTERVAL,
+        upload_dir=Path(settings.STORAGE_PATH) / "uploads",
+        upload_ttl=settings.UPLOAD_SESSION_TTL,
+    )
+    app.state.reaper = reaper
+    reaper_task = asyncio.create_task(reaper.run())
+
+    thumbnail_cache = ThumbnailCache(
+        Path(settings.STORAGE_PATH) / "cache",
+        settings.THUMBNAIL_CACHE_SIZE,
+    )
+    await asyncio.to_thread(thumbnail_cache.load)
+    app.state.thumbnail_cache = thumbnail_cache
+
+    # Изменения записей, сделанные worker'ом и другими репликами API,
+    # сбрасывают локальный кеш записей
+    image_events = ImageEventListener(asyncpg_dsn(settings.DATABASE_URL))
+    image_events.subscribe(
+        lambda image_id, status: image_cache.invalidate(image_id),
+        reset=image_cache.clear,
+    )
+    app.state.image_events = image_events
+    events_task = asyncio.create_task(image_events.run())
+    try:
+        yield
+    finally:
+        for task in (events_task, reaper_task, relay_task):
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+        await publisher.close()
+
+
+app = FastAPI(title=settings.PROJECT_NAME, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -14,8 +88,14 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    MaxBodySizeMiddleware,
+    max_body_size=settings.MAX_REQUEST_SIZE,
+    path_limits={"/api/v1/images/batch": settings.MAX_BATCH_REQUEST_SIZE},
+)
 
 app.include_router(images.router, prefix="/api/v1", tags=["images"])
+app.include_router(uploads.router, prefix="/api/v1", tags=["uploads"])
 
 
 @app.get("/")
@@ -36,3 +116,21 @@ async def health_check():
         db="connected",
         rabbitmq="connected"
     )
+
+
+@app.get("/stats", response_model=StatsResponse)
+async def stats():
+    reaper = app.state.reaper
+    image_events = app.state.image_events
+    return StatsResponse(
+        reaper=ReaperStats(
+            recovered_total=reaper.recovered_total,
+            last_recovered=reaper.last_recovered,
+            expired_uploads_total=reaper.expired_uploads_total,
+        ),
+        image_cache=ImageCacheStats(**image_cache.stats()),
+        image_events=ImageEventsStats(
+            connected=image_events.connected,
+            events_total=image_events.events_total,
+        ),
+    )
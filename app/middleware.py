@@ -0,0 +1,55 @@
+from fastapi import HTTPException
+from typing import Dict, Optional
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+class MaxBodySizeMiddleware:
+    """Ограничивает размер тела запроса
+
+    Запросы с заведомо большим Content-Length отклоняются сразу, а
+    потоковые тела (chunked) прерываются, как только прочитано больше
+    max_body_size байт, не дожидаясь окончания передачи. Для отдельных
+    путей лимит можно переопределить через path_limits.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        max_body_size: int,
+        path_limits: Optional[Dict[str, int]] = None,
+    ):
+        self.app = app
+        self.max_body_size = max_body_size
+        self.path_limits = path_limits or {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        max_body_size = self.path_limits.get(scope["path"], self.max_body_size)
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length and int(content_length) > max_body_size:
+            response = JSONResponse(
+                {"detail": "Request body too large"}, status_code=413
+            )
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_body_size:
+                    raise HTTPException(
+                        status_code=413, detail="Request body too large"
+                    )
+            return message
+
+        await self.app(scope, limited_receive, send)
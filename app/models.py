@@ -1,4 +1,6 @@
-from sqlalchemy import Column, String, DateTime, JSON, func, Index
+from sqlalchemy import (
+    BigInteger, Column, Integer, String, DateTime, JSON, func, Index
+)
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -16,7 +18,18 @@ class Image(Base):
     status = Column(String(20), nullable=False)
     original_url = Column(String, nullable=False)
     thumbnails = Column(JSON, default=dict)
+    # Качество и размер каждой миниатюры: {ключ из thumbnails: {...}}
+    thumbnail_meta = Column(JSON, default=dict)
     error_message = Column(String)
+    # SHA-256 содержимого оригинала для дедупликации
+    content_hash = Column(String(64))
+    # Размеры оригинала, прочитанные из заголовка при загрузке
+    width = Column(Integer)
+    height = Column(Integer)
+    # Очередь обработки: interactive или bulk
+    priority = Column(String(20), nullable=False, server_default="interactive")
+    # До какого момента задача закреплена за worker'ом в статусе PROCESSING
+    lease_expires_at = Column(DateTime(timezone=True))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(
         DateTime(timezone=True),
@@ -27,4 +40,36 @@ class Image(Base):
     __table_args__ = (
         Index('ix_images_status', 'status'),
         Index('ix_images_created_at', 'created_at'),
+        Index('ix_images_content_hash', 'content_hash'),
     )
+
+
+class OutboxMessage(Base):
+    """Сообщение для брокера, записанное в одной транзакции с данными"""
+
+    __tablename__ = "outbox"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    routing_key = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class UploadSession(Base):
+    """Сессия возобновляемой загрузки
+
+    Уже принятые байты лежат в файле STORAGE_PATH/uploads/<id>.part,
+    текущее смещение равно его размеру.
+    """
+
+    __tablename__ = "upload_sessions"
+
+    id = Column(
+        UUID(as_uuid=True),
+        primary_key=True,
+        server_default=func.gen_random_uuid()
+    )
+    filename = Column(String)
+    content_type = Column(String, nullable=False)
+    total_size = Column(BigInteger, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.broker import RabbitMQPublisher
+from app.models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxRelay:
+    """Переносит сообщения из таблицы outbox в RabbitMQ пачками
+
+    Строки выбираются с FOR UPDATE SKIP LOCKED, поэтому несколько
+    экземпляров API могут работать одновременно. Строки удаляются
+    только после подтверждения брокером, так что при сбое брокера
+    задачи не теряются, а будут отправлены повторно.
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker[AsyncSession],
+        publisher: RabbitMQPublisher,
+        batch_size: int = 100,
+        poll_interval: float = 1.0,
+        max_connect_delay: float = 30.0,
+    ):
+        self.session_factory = session_factory
+        self.publisher = publisher
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_connect_delay = max_connect_delay
+        self._wakeup = asyncio.Event()
+
+    def notify(self) -> None:
+        """Разбудить релей сразу после записи новой задачи"""
+        self._wakeup.set()
+
+    async def drain_once(self) -> int:
+        """Отправить одну пачку сообщений
+
+        Returns:
+            Количество отправленных сообщений
+        """
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(OutboxMessage)
+                .order_by(OutboxMessage.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            messages = result.scalars().all()
+            if not messages:
+                return 0
+
+            await self.publisher.publish_batch(
+                (message.routing_key, message.payload) for message in messages
+            )
+            await db.execute(
+                delete(OutboxMessage).where(
+                    OutboxMessage.id.in_([message.id for message in messages])
+                )
+            )
+            await db.commit()
+            return len(messages)
+
+    async def connect(self) -> None:
+        """Подключает издатель, повторяя попытки с растущей паузой
+
+        API стартует и без брокера: задачи копятся в outbox и уходят,
+        когда брокер станет доступен.
+        """
+        delay = self.poll_interval
+        while not self.publisher.started:
+            try:
+                await self.publisher.start()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(
+                    f"Cannot connect to RabbitMQ, retrying in {delay}s: {e}"
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_connect_delay)
+
+    async def run(self) -> None:
+        await self.connect()
+        while True:
+            self._wakeup.clear()
+            try:
+                while await self.drain_once() == self.batch_size:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox relay error: {e}")
+
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), timeout=self.poll_interval
+                )
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from pathlib import Path
+from typing import List, Optional
+from uuid import UUID
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.crud import (
+    delete_upload_sessions, find_old_upload_sessions, requeue_stale_images
+)
+from app.outbox import OutboxRelay
+from app.storage import upload_part_path
+
+logger = logging.getLogger(__name__)
+
+
+class StaleJobReaper:
+    """Периодически возвращает в очередь задачи упавших worker'ов
+
+    Записи в PROCESSING с истекшей арендой переводятся в QUEUED пачками,
+    а новые задачи уходят в брокер через outbox. Счетчики восстановленных
+    задач доступны через /stats.
+
+    Заодно удаляются брошенные возобновляемые загрузки: сессии, в
+    которые не приходило блоков дольше upload_ttl секунд, и их .part
+    файлы в upload_dir.
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker[AsyncSession],
+        relay: OutboxRelay,
+        batch_size: int = 100,
+        interval: float = 60.0,
+        upload_dir: Optional[Path] = None,
+        upload_ttl: float = 24 * 60 * 60,
+    ):
+        self.session_factory = session_factory
+        self.relay = relay
+        self.batch_size = batch_size
+        self.interval = interval
+        self.upload_dir = upload_dir
+        self.upload_ttl = upload_ttl
+        self.recovered_total = 0
+        self.last_recovered = 0
+        self.expired_uploads_total = 0
+
+    async def sweep_once(self) -> int:
+        """Вернуть в очередь одну пачку задач
+
+        Returns:
+            Количество восстановленных задач
+        """
+        async with self.session_factory() as db:
+            images = await requeue_stale_images(db, self.batch_size)
+        if images:
+            self.recovered_total += len(images)
+            self.relay.notify()
+        return len(images)
+
+    async def sweep(self) -> int:
+        """Вернуть в очередь все задачи с истекшей арендой"""
+        recovered = 0
+        while True:
+            count = await self.sweep_once()
+            recovered += count
+            if count < self.batch_size:
+                break
+        self.last_recovered = recovered
+        if recovered:
+            logger.warning(f"Requeued {recovered} stale jobs")
+        return recovered
+
+    def _idle_uploads(self, upload_ids: List[UUID]) -> List[UUID]:
+        """Загрузки, .part файл которых не менялся дольше upload_ttl"""
+        deadline = time.time() - self.upload_ttl
+        idle = []
+        for upload_id in upload_ids:
+            try:
+                mtime = upload_part_path(
+                    self.upload_dir, upload_id
+                ).stat().st_mtime
+            except FileNotFoundError:
+                mtime = 0.0
+            if mtime < deadline:
+                idle.append(upload_id)
+        return idle
+
+    async def expire_uploads(self) -> int:
+        """Удалить брошенные сессии загрузки и принятые байты
+
+        Returns:
+            Количество удаленных сессий
+        """
+        if self.upload_dir is None:
+            return 0
+        expired = 0
+        last_id = None
+        while True:
+            async with self.session_factory() as db:
+                upload_ids = await find_old_upload_sessions(
+                    db, self.upload_ttl, self.batch_size, after=last_id
+                )
+                if not upload_ids:
+                    break
+                last_id = upload_ids[-1]
+                # Сессия старше TTL еще жива, если в нее недавно писали
+                idle = await asyncio.to_thread(self._idle_uploads, upload_ids)
+                if idle:
+                    await delete_upload_sessions(db, idle)
+            # Файлы удаляются после commit: сессии без файла не остается
+            for upload_id in idle:
+                upload_part_path(self.upload_dir, upload_id).unlink(
+                    missing_ok=True
+                )
+            expired += len(idle)
+            if len(upload_ids) < self.batch_size:
+                break
+        self.expired_uploads_total += expired
+        if expired:
+            logger.warning(f"Removed {expired} abandoned uploads")
+        return expired
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+                await self.expire_uploads()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Stale job reaper error: {e}")
+            await asyncio.sleep(self.interval)
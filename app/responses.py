@@ -0,0 +1,260 @@
+"""Ответы с поддержкой HTTP Range (RFC 9110, раздел 14)"""
+import os
+from email.utils import parsedate_to_datetime
+from typing import List, Optional, Tuple
+from uuid import uuid4
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.types import Receive, Scope, Send
+
+# Больше диапазонов в одном запросе не обслуживается: отдается весь файл
+MAX_RANGES = 16
+
+# Включительный диапазон байт (first, last)
+ByteRange = Tuple[int, int]
+
+
+class RangeNotSatisfiable(Exception):
+    """Ни один из запрошенных диапазонов не пересекается с файлом"""
+
+
+class _InvalidRange(Exception):
+    """Синтаксическая ошибка в заголовке Range"""
+
+
+def parse_range(header: str, size: int) -> Optional[List[ByteRange]]:
+    """Разбирает заголовок Range для файла размером size
+
+    Returns:
+        Отсортированные непересекающиеся диапазоны или None, если
+        заголовок нужно проигнорировать и отдать файл целиком
+        (не байты, синтаксическая ошибка, слишком много диапазонов)
+
+    Raises:
+        RangeNotSatisfiable: все диапазоны за пределами файла
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs.strip():
+        return None
+    specs = specs.split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+
+    try:
+        ranges = [_parse_spec(spec, size) for spec in specs]
+    except _InvalidRange:
+        return None
+    ranges = [byte_range for byte_range in ranges if byte_range is not None]
+    if not ranges:
+        raise RangeNotSatisfiable()
+    return _merge_ranges(ranges)
+
+
+def _parse_spec(spec: str, size: int) -> Optional[ByteRange]:
+    """Один диапазон first-last, first- или -suffix
+
+    Returns:
+        Диапазон, обрезанный по размеру файла, или None, если он не
+        пересекается с файлом
+
+    Raises:
+        _InvalidRange: синтаксическая ошибка
+    """
+    first, dash, last = spec.strip().partition("-")
+    if not dash:
+        raise _InvalidRange()
+    try:
+        if not first:
+            return _suffix_range(int(last), size)
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        raise _InvalidRange()
+    if last and end < start:
+        raise _InvalidRange()
+    if start < 0 or start >= size:
+        return None
+    return start, min(end, size - 1)
+
+
+def _suffix_range(suffix: int, size: int) -> Optional[ByteRange]:
+    """Последние suffix байт файла"""
+    if suffix <= 0 or size == 0:
+        return None
+    return max(size - suffix, 0), size - 1
+
+
+def _merge_ranges(ranges: List[ByteRange]) -> List[ByteRange]:
+    """Объединяет пересекающиеся и смежные диапазоны, чтобы один
+    запрос не заставлял читать одни и те же байты многократно"""
+    ranges = sorted(ranges)
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(if_range: str, etag: Optional[str],
+                     last_modified: Optional[str]) -> bool:
+    """Проверка If-Range: диапазон отдается, только если файл не менялся
+
+    Сравнение ETag строгое, слабые ETag не совпадают никогда.
+    """
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return etag is not None and if_range == etag
+    if last_modified is None:
+        return False
+    try:
+        return (
+            parsedate_to_datetime(if_range)
+            == parsedate_to_datetime(last_modified)
+        )
+    except (TypeError, ValueError):
+        return False
+
+
+class RangeFileResponse(FileResponse):
+    """FileResponse, отдающий части файла по заголовку Range
+
+    Один диапазон отдается как 206 с Content-Range, несколько - как
+    multipart/byteranges. Файл читается блоками с нужного смещения и
+    целиком в память не загружается.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if self.stat_result is None:
+            self.stat_result = await anyio.to_thread.run_sync(
+                os.stat, self.path
+            )
+            self.set_stat_headers(self.stat_result)
+        size = self.stat_result.st_size
+        self.headers["accept-ranges"] = "bytes"
+
+        request_headers = Headers(scope=scope)
+        range_header = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        ranges = None
+        if range_header and (
+            if_range is None or if_range_matches(
+                if_range,
+                self.headers.get("etag"),
+                self.headers.get("last-modified"),
+            )
+        ):
+            try:
+                ranges = parse_range(range_header, size)
+            except RangeNotSatisfiable:
+                await self._send_not_satisfiable(size, send)
+                return
+
+        if not ranges:
+            await self._send(send, [], size)
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.status_code = 206
+            self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+            self.headers["content-length"] = str(end - start + 1)
+            await self._send(send, [(b"", start, end, b"")], size)
+        else:
+            await self._send_multipart(send, ranges, size)
+
+        if self.background is not None:
+            await self.background()
+
+    async def _send_not_satisfiable(self, size: int, send: Send) -> None:
+        self.status_code = 416
+        # Ошибка относится к запросу, а не к файлу: ее не кешируют
+        if "cache-control" in self.headers:
+            del self.headers["cache-control"]
+        self.headers["content-range"] = f"bytes */{size}"
+        self.headers["content-length"] = "0"
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        await send({"type": "http.response.body", "body": b""})
+
+    async def _send_multipart(
+        self, send: Send, ranges: List[ByteRange], size: int
+    ) -> None:
+        boundary = uuid4().hex
+        content_type = self.headers.get(
+            "content-type", "application/octet-stream"
+        )
+        parts = []
+        length = 0
+        for start, end in ranges:
+            head = (
+                f"--{boundary}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+            ).encode("latin-1")
+            parts.append((head, start, end, b"\r\n"))
+            length += len(head) + end - start + 1 + 2
+        tail = f"--{boundary}--\r\n".encode("latin-1")
+        length += len(tail)
+
+        self.status_code = 206
+        self.headers["content-type"] = (
+            f"multipart/byteranges; boundary={boundary}"
+        )
+        self.headers["content-length"] = str(length)
+        await self._send(send, parts, size, tail)
+
+    async def _send(
+        self,
+        send: Send,
+        parts: List[Tuple[bytes, int, int, bytes]],
+        size: int,
+        tail: bytes = b"",
+    ) -> None:
+        """Отправляет заголовки и части файла (префикс, first, last, суффикс)
+
+        Пустой parts - весь файл.
+        """
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if self.send_header_only:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if not parts:
+            parts = [(b"", 0, size - 1, b"")]
+
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            for head, start, end, trailer in parts:
+                if head:
+                    await send({
+                        "type": "http.response.body",
+                        "body": head,
+                        "more_body": True,
+                    })
+                await file.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = await file.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": True,
+                    })
+                if trailer:
+                    await send({
+                        "type": "http.response.body",
+                        "body": trailer,
+                        "more_body": True,
+                    })
+        await send({"type": "http.response.body", "body": tail})
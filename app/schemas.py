@@ -17,7 +17,10 @@ class ImageResponse(BaseModel):
     status: str
     original_url: str
     thumbnails: Dict[str, str]
+    thumbnail_meta: Optional[Dict[str, Dict[str, int]]] = None
     error_message: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
     created_at: datetime
     updated_at: datetime
 
@@ -30,7 +33,43 @@ class TaskResponse(BaseModel):
     status: str
 
 
+class UploadSessionCreate(BaseModel):
+    filename: Optional[str] = None
+    content_type: str
+    size: int
+
+
+class UploadSessionResponse(BaseModel):
+    upload_id: UUID
+    offset: int
+    size: int
+
+
 class HealthResponse(BaseModel):
     status: str
     db: str
     rabbitmq: str
+
+
+class ReaperStats(BaseModel):
+    recovered_total: int
+    last_recovered: int
+    expired_uploads_total: int
+
+
+class ImageCacheStats(BaseModel):
+    size: int
+    hits: int
+    misses: int
+    invalidations: int
+
+
+class ImageEventsStats(BaseModel):
+    connected: bool
+    events_total: int
+
+
+class StatsResponse(BaseModel):
+    reaper: ReaperStats
+    image_cache: ImageCacheStats
+    image_events: ImageEventsStats
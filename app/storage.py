@@ -0,0 +1,212 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from typing import AsyncIterator, Optional, Protocol, Tuple
+from uuid import UUID, uuid4
+
+import aiofiles
+from fastapi import UploadFile
+
+from app.storage_backends import StorageBackend, original_key
+
+
+class UploadTooLargeError(Exception):
+    """Загружаемый файл превышает допустимый размер"""
+
+    def __init__(self, max_size: int):
+        super().__init__(f"File exceeds maximum upload size of {max_size} bytes")
+        self.max_size = max_size
+
+
+class StreamValidator(Protocol):
+    """Проверка содержимого, которая видит каждый блок до его записи"""
+
+    def feed(self, chunk: bytes) -> None:
+        ...
+
+    def finish(self) -> object:
+        ...
+
+
+class UploadOffsetMismatchError(Exception):
+    """Блок возобновляемой загрузки начинается не с текущего смещения"""
+
+    def __init__(self, offset: int):
+        super().__init__(f"Chunk must start at offset {offset}")
+        self.offset = offset
+
+
+class UploadLockedError(Exception):
+    """В файл загрузки уже пишет другой запрос"""
+
+
+async def save_upload_file(
+    upload: UploadFile,
+    destination: Path,
+    max_size: int,
+    chunk_size: int,
+    validator: Optional[StreamValidator] = None,
+) -> Tuple[int, str]:
+    """Потоково копирует загруженный файл на диск блоками фиксированного размера
+
+    В памяти одновременно находится не больше одного блока, поэтому
+    потребление памяти не зависит от размера файла. При превышении
+    max_size запись прерывается, а частично записанный файл удаляется.
+    Попутно считается SHA-256 содержимого.
+
+    Returns:
+        Количество записанных байт и SHA-256 в hex
+    """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    written = 0
+    try:
+        async with aiofiles.open(destination, "wb") as out:
+            while chunk := await upload.read(chunk_size):
+                written += len(chunk)
+                if written > max_size:
+                    raise UploadTooLargeError(max_size)
+                if validator is not None:
+                    validator.feed(chunk)
+                digest.update(chunk)
+                await out.write(chunk)
+    except BaseException:
+        destination.unlink(missing_ok=True)
+        raise
+    return written, digest.hexdigest()
+
+
+def commit_content_addressed(
+    temp_path: Path,
+    storage: StorageBackend,
+    content_hash: str,
+    extension: str,
+) -> str:
+    """Переносит временный файл в хранилище по адресу его содержимого
+
+    Если файл с таким содержимым уже есть, временный файл удаляется и
+    возвращается ключ существующего.
+    """
+    key = original_key(content_hash, extension)
+    if storage.exists(key):
+        temp_path.unlink(missing_ok=True)
+    else:
+        storage.put_file(key, temp_path)
+    return key
+
+
+async def store_content_addressed(
+    upload: UploadFile,
+    temp_dir: Path,
+    storage: StorageBackend,
+    extension: str,
+    max_size: int,
+    chunk_size: int,
+    validator: Optional[StreamValidator] = None,
+) -> Tuple[str, str]:
+    """Потоково сохраняет загрузку в хранилище по хешу содержимого
+
+    Загрузка пишется во временный файл в temp_dir и попадает в
+    хранилище только после validator.finish().
+
+    Returns:
+        Ключ файла в хранилище и SHA-256 содержимого
+    """
+    temp_path = temp_dir / uuid4().hex
+    _, content_hash = await save_upload_file(
+        upload, temp_path,
+        max_size=max_size, chunk_size=chunk_size, validator=validator,
+    )
+    try:
+        if validator is not None:
+            validator.finish()
+        key = await asyncio.to_thread(
+            commit_content_addressed,
+            temp_path, storage, content_hash, extension,
+        )
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return key, content_hash
+
+
+def upload_part_path(upload_dir: Path, upload_id: UUID) -> Path:
+    """Файл с уже принятыми байтами возобновляемой загрузки"""
+    return upload_dir / f"{upload_id}.part"
+
+
+def restore_upload_part(storage: StorageBackend, key: str,
+                        part_path: Path) -> None:
+    """Возвращает перенесенный в хранилище файл обратно в .part
+
+    Нужен, если запись изображения не сохранилась: загрузку можно
+    завершить повторно. Сам оригинал адресуется по содержимому и может
+    принадлежать другим записям, поэтому из хранилища он не удаляется.
+    """
+    with storage.local_copy(key) as path:
+        temp_path = part_path.with_suffix(".restore")
+        shutil.copyfile(path, temp_path)
+        os.replace(temp_path, part_path)
+
+
+async def append_stream(
+    path: Path,
+    stream: AsyncIterator[bytes],
+    start: int,
+    max_size: int,
+    chunk_size: int,
+    validator: Optional[StreamValidator] = None,
+) -> int:
+    """Дописывает поток байт в конец файла возобновляемой загрузки
+
+    Запись возможна, только если start совпадает с текущим размером
+    файла. Файл блокируется на время записи, поэтому параллельные
+    запросы к одной загрузке не перемешивают данные. Байты, принятые
+    до обрыва соединения, остаются в файле, и клиент продолжает с них.
+    Каждый блок передается в validator.feed до записи.
+
+    Returns:
+        Новое смещение (размер файла)
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadLockedError()
+
+        offset = os.fstat(fd).st_size
+        if start != offset:
+            raise UploadOffsetMismatchError(offset)
+
+        buffer = bytearray()
+        try:
+            async for data in stream:
+                if offset + len(buffer) + len(data) > max_size:
+                    raise UploadTooLargeError(max_size)
+                if validator is not None:
+                    validator.feed(data)
+                buffer += data
+                if len(buffer) >= chunk_size:
+                    await asyncio.to_thread(os.write, fd, bytes(buffer))
+                    offset += len(buffer)
+                    buffer.clear()
+        finally:
+            if buffer:
+                await asyncio.to_thread(os.write, fd, bytes(buffer))
+                offset += len(buffer)
+        return offset
+    finally:
+        os.close(fd)
+
+
+def hash_file(path: Path, chunk_size: int) -> str:
+    """SHA-256 файла, прочитанного блоками"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,298 @@
+"""Хранилища файлов изображений
+
+API и worker обращаются к файлам по ключам вида
+"original/ab/cd/<hash>.jpg" и "thumbs/100x100/ab/cd/<id>_100x100.jpg";
+ключи хранятся в БД, а где лежат байты, решает хранилище. Ключ,
+являющийся абсолютным путем (записи до перехода на хранилища),
+локальное хранилище читает как есть.
+"""
+import errno
+import mimetypes
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import ContextManager, Iterator, Optional, Protocol, Set, Tuple
+
+from app.core.config import settings
+
+
+def original_key(content_hash: str, extension: str) -> str:
+    """Ключ оригинала по хешу содержимого: original/ab/cd/abcd...<ext>"""
+    return (
+        f"original/{content_hash[:2]}/{content_hash[2:4]}/"
+        f"{content_hash}{extension}"
+    )
+
+
+def thumbnail_storage_key(image_id: str, width: int, height: int,
+                          extension: str) -> str:
+    """Ключ миниатюры, разложенный по префиксу UUID
+
+    Тысячи файлов в одном каталоге замедляют поиск и листинг, поэтому
+    каталог размера делится на 256 * 256 подкаталогов.
+    """
+    image_id = str(image_id)
+    return (
+        f"thumbs/{width}x{height}/{image_id[:2]}/{image_id[2:4]}/"
+        f"{image_id}_{width}x{height}{extension}"
+    )
+
+
+def guess_content_type(key: str) -> str:
+    return mimetypes.guess_type(key)[0] or "application/octet-stream"
+
+
+class StorageBackend(Protocol):
+    """Хранилище байт по ключу"""
+
+    def put_file(self, key: str, source: Path, move: bool = True) -> None:
+        """Сохраняет файл source под ключом key (при move source удаляется)"""
+        ...
+
+    def put_bytes(self, key: str, data: bytes) -> None:
+        ...
+
+    def exists(self, key: str) -> bool:
+        ...
+
+    def local_path(self, key: str) -> Optional[Path]:
+        """Путь к файлу на диске или None, если хранилище не локальное"""
+        ...
+
+    def local_copy(self, key: str) -> ContextManager[Path]:
+        """Контекст с локальным путем к файлу на время чтения
+
+        Отсутствующий файл - FileNotFoundError.
+        """
+        ...
+
+    def url(self, key: str, filename: str, attachment: bool = False
+            ) -> Optional[str]:
+        """Временная ссылка для прямого скачивания или None"""
+        ...
+
+    def delete(self, key: str) -> None:
+        ...
+
+
+class LocalStorage:
+    """Файлы в каталоге root
+
+    Запись идет во временный файл в целевом каталоге и атомарно
+    переименовывается, так что читатели не видят недописанных файлов.
+    Созданные каталоги запоминаются, чтобы не вызывать mkdir на каждую
+    запись.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self._dirs: Set[Path] = set()
+
+    def path(self, key: str) -> Path:
+        # Абсолютный ключ (старые записи) Path оставляет как есть
+        return self.root / key
+
+    def _ensure_dir(self, directory: Path) -> None:
+        if directory not in self._dirs:
+            directory.mkdir(parents=True, exist_ok=True)
+            self._dirs.add(directory)
+
+    def _temp_file(self, directory: Path) -> Tuple[int, str]:
+        self._ensure_dir(directory)
+        try:
+            return tempfile.mkstemp(dir=directory, suffix=".tmp")
+        except FileNotFoundError:
+            # Каталог удалили после того, как он попал в кеш
+            self._dirs.discard(directory)
+            self._ensure_dir(directory)
+            return tempfile.mkstemp(dir=directory, suffix=".tmp")
+
+    def put_bytes(self, key: str, data: bytes) -> None:
+        destination = self.path(key)
+        fd, temp = self._temp_file(destination.parent)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp, destination)
+        except BaseException:
+            Path(temp).unlink(missing_ok=True)
+            raise
+
+    def put_file(self, key: str, source: Path, move: bool = True) -> None:
+        destination = self.path(key)
+        if move:
+            self._ensure_dir(destination.parent)
+            try:
+                os.replace(source, destination)
+                return
+            except FileNotFoundError:
+                self._dirs.discard(destination.parent)
+                self._ensure_dir(destination.parent)
+                os.replace(source, destination)
+                return
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # Другая файловая система: копируем, как ниже
+        fd, temp = self._temp_file(destination.parent)
+        try:
+            with os.fdopen(fd, "wb") as out, open(source, "rb") as src:
+                shutil.copyfileobj(src, out)
+            os.replace(temp, destination)
+        except BaseException:
+            Path(temp).unlink(missing_ok=True)
+            raise
+        if move:
+            Path(source).unlink(missing_ok=True)
+
+    def exists(self, key: str) -> bool:
+        return self.path(key).is_file()
+
+    def local_path(self, key: str) -> Optional[Path]:
+        return self.path(key)
+
+    @contextmanager
+    def local_copy(self, key: str) -> Iterator[Path]:
+        path = self.path(key)
+        if not path.is_file():
+            raise FileNotFoundError(key)
+        yield path
+
+    def url(self, key: str, filename: str, attachment: bool = False
+            ) -> Optional[str]:
+        return None
+
+    def delete(self, key: str) -> None:
+        self.path(key).unlink(missing_ok=True)
+
+
+class S3Storage:
+    """Файлы в бакете S3-совместимого хранилища (AWS S3, MinIO)
+
+    Файлы отдаются клиентам по временным подписанным ссылкам, минуя
+    API. Для обработки файл скачивается во временный файл.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        endpoint_url: Optional[str] = None,
+        access_key: Optional[str] = None,
+        secret_key: Optional[str] = None,
+        region: Optional[str] = None,
+        presign_expires: int = 3600,
+        client=None,
+    ):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError(
+                    "S3 storage backend requires boto3: pip install boto3"
+                )
+            client = boto3.client(
+                "s3",
+                endpoint_url=endpoint_url or None,
+                aws_access_key_id=access_key or None,
+                aws_secret_access_key=secret_key or None,
+                region_name=region or None,
+            )
+        self.client = client
+        self.bucket = bucket
+        self.presign_expires = presign_expires
+
+    @staticmethod
+    def _key(key: str) -> str:
+        return key.lstrip("/")
+
+    def _is_missing(self, error) -> bool:
+        code = error.response.get("Error", {}).get("Code")
+        return code in ("404", "NoSuchKey", "NotFound")
+
+    def put_bytes(self, key: str, data: bytes) -> None:
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self._key(key),
+            Body=data,
+            ContentType=guess_content_type(key),
+        )
+
+    def put_file(self, key: str, source: Path, move: bool = True) -> None:
+        # upload_file сам делит большие файлы на части (multipart)
+        self.client.upload_file(
+            str(source),
+            self.bucket,
+            self._key(key),
+            ExtraArgs={"ContentType": guess_content_type(key)},
+        )
+        if move:
+            Path(source).unlink(missing_ok=True)
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except self.client.exceptions.ClientError as e:
+            if self._is_missing(e):
+                return False
+            raise
+        return True
+
+    def local_path(self, key: str) -> Optional[Path]:
+        return None
+
+    @contextmanager
+    def local_copy(self, key: str) -> Iterator[Path]:
+        fd, temp = tempfile.mkstemp(suffix=Path(key).suffix)
+        os.close(fd)
+        try:
+            try:
+                self.client.download_file(self.bucket, self._key(key), temp)
+            except self.client.exceptions.ClientError as e:
+                if self._is_missing(e):
+                    raise FileNotFoundError(key)
+                raise
+            yield Path(temp)
+        finally:
+            Path(temp).unlink(missing_ok=True)
+
+    def url(self, key: str, filename: str, attachment: bool = False
+            ) -> Optional[str]:
+        disposition = "attachment" if attachment else "inline"
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": self.bucket,
+                "Key": self._key(key),
+                "ResponseContentDisposition":
+                    f"{disposition}; filename={filename}",
+            },
+            ExpiresIn=self.presign_expires,
+        )
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+def create_storage(backend: str) -> StorageBackend:
+    """Хранилище по имени (local или s3) с параметрами из настроек"""
+    if backend == "local":
+        return LocalStorage(Path(settings.STORAGE_PATH))
+    if backend == "s3":
+        return S3Storage(
+            settings.S3_BUCKET,
+            endpoint_url=settings.S3_ENDPOINT_URL,
+            access_key=settings.S3_ACCESS_KEY,
+            secret_key=settings.S3_SECRET_KEY,
+            region=settings.S3_REGION,
+            presign_expires=settings.S3_PRESIGN_EXPIRES,
+        )
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+@lru_cache(maxsize=None)
+def default_storage() -> StorageBackend:
+    """Хранилище из STORAGE_BACKEND, одно на процесс"""
+    return create_storage(settings.STORAGE_BACKEND)
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+from PIL import Image
+
+from app.imaging import DEFAULT_ENCODING, ENCODINGS, save_image
+
+logger = logging.getLogger(__name__)
+
+
+class ThumbnailCache:
+    """Дисковый кеш миниатюр по запросу с LRU-вытеснением
+
+    Общий размер файлов ограничен max_bytes; при переполнении удаляются
+    давно не запрашивавшиеся миниатюры. Каталог кеша общий для всех
+    реплик API, а каждая знает только о своих записях, поэтому при
+    переполнении и после записи каждой десятой части max_bytes размер и
+    порядок использования берутся заново из каталога (по времени
+    доступа файлов). Одновременные запросы одной миниатюры в пределах
+    процесса ждут единственной отрисовки.
+    """
+
+    # Доля max_bytes, после записи которой каталог пересчитывается
+    RESCAN_FRACTION = 10
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._total = 0
+        self._written = 0
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._evicting = False
+
+    def path_for(self, key: str, encoding: str = DEFAULT_ENCODING) -> Path:
+        return self._path(f"{key}{ENCODINGS[encoding].extension}")
+
+    def _path(self, name: str) -> Path:
+        return self.root / name[:2] / name
+
+    def load(self) -> None:
+        """Восстановить состояние кеша с диска (вызывается при старте)"""
+        self._restore(self._scan())
+        self._unlink(self._pop_victims())
+
+    def _scan(self) -> List[Tuple[float, str, int]]:
+        """Файлы кеша (время доступа, имя, размер) от старых к новым"""
+        files = []
+        for path in self.root.glob("*/*"):
+            if path.suffix == ".tmp":
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_atime, path.name, stat.st_size))
+        return sorted(files)
+
+    def _restore(self, files: List[Tuple[float, str, int]]) -> None:
+        self._entries = OrderedDict((name, size) for _, name, size in files)
+        self._total = sum(self._entries.values())
+
+    async def get_or_render(
+        self,
+        key: str,
+        render: Callable[[], Image.Image],
+        encoding: str = DEFAULT_ENCODING,
+    ) -> Path:
+        """Путь к миниатюре key в формате encoding
+
+        При промахе миниатюра строится функцией render в отдельном
+        потоке, не блокируя event loop.
+        """
+        path = self.path_for(key, encoding)
+        name = path.name
+        if name in self._entries and path.exists():
+            self._touch(name, path)
+            return path
+
+        # Отрисовка идет отдельной задачей: отмена одного из запросов
+        # не прерывает ее для остальных
+        task = self._inflight.get(name)
+        if task is None:
+            task = asyncio.create_task(
+                self._fill(name, path, render, encoding)
+            )
+            self._inflight[name] = task
+        return await asyncio.shield(task)
+
+    async def _fill(
+        self,
+        name: str,
+        path: Path,
+        render: Callable[[], Image.Image],
+        encoding: str,
+    ) -> Path:
+        try:
+            size = await asyncio.to_thread(
+                self._render_to, path, render, encoding
+            )
+            self._add(name, size)
+            if (self._total > self.max_bytes or self._written
+                    >= self.max_bytes // self.RESCAN_FRACTION):
+                await self._evict()
+            return path
+        finally:
+            del self._inflight[name]
+
+    def _render_to(
+        self, path: Path, render: Callable[[], Image.Image], encoding: str
+    ) -> int:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        thumbnail = render()
+        # Пишем во временный файл рядом и атомарно переименовываем, чтобы
+        # читатели не увидели недописанную миниатюру
+        fd, temp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                save_image(thumbnail, f, encoding)
+            os.replace(temp, path)
+        except BaseException:
+            Path(temp).unlink(missing_ok=True)
+            raise
+        return path.stat().st_size
+
+    def _touch(self, name: str, path: Path) -> None:
+        self._entries.move_to_end(name)
+        try:
+            # atime может не обновляться (noatime), поэтому явно
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def _add(self, name: str, size: int) -> None:
+        self._total += size - self._entries.pop(name, 0)
+        self._entries[name] = size
+        self._written += size
+
+    async def _evict(self) -> None:
+        """Вытеснение по фактическому содержимому каталога"""
+        if self._evicting:
+            return
+        self._evicting = True
+        self._written = 0
+        try:
+            self._restore(await asyncio.to_thread(self._scan))
+            await asyncio.to_thread(self._unlink, self._pop_victims())
+        finally:
+            self._evicting = False
+
+    def _pop_victims(self) -> List[str]:
+        victims = []
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._total -= size
+            victims.append(name)
+        return victims
+
+    def _unlink(self, names: List[str]) -> None:
+        for name in names:
+            self._path(name).unlink(missing_ok=True)
+            logger.debug(f"Evicted thumbnail {name} from cache")
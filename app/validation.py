@@ -0,0 +1,135 @@
+import io
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from PIL import Image, UnidentifiedImageError
+
+from app.core.config import settings
+
+# Сигнатуры (magic bytes) допустимых форматов
+SIGNATURES = {
+    "image/jpeg": b"\xff\xd8\xff",
+    "image/png": b"\x89PNG\r\n\x1a\n",
+}
+SNIFF_SIZE = max(len(signature) for signature in SIGNATURES.values())
+
+
+class InvalidImageError(Exception):
+    """Файл не является допустимым изображением"""
+
+
+class ImageInfo(NamedTuple):
+    content_type: str
+    width: int
+    height: int
+    frames: int
+
+
+def sniff_content_type(head: bytes) -> str:
+    """Определяет тип файла по первым байтам"""
+    for content_type, signature in SIGNATURES.items():
+        if head.startswith(signature):
+            return content_type
+    raise InvalidImageError("Only JPEG/PNG allowed")
+
+
+class ImageHeaderValidator:
+    """Проверяет изображение по первым байтам потока
+
+    Формат определяется по сигнатуре первого блока, затем заголовок
+    разбирается ленивым PIL.Image.open, который читает только
+    метаданные и не декодирует пиксели. Неподходящий файл отклоняется
+    до того, как будет прочитан и сохранен остаток тела.
+    """
+
+    def __init__(
+        self,
+        expected_content_type: Optional[str] = None,
+        max_header_size: Optional[int] = None,
+        max_pixels: Optional[int] = None,
+        max_dimension: Optional[int] = None,
+        max_frames: Optional[int] = None,
+    ):
+        self.expected_content_type = expected_content_type
+        self.max_header_size = max_header_size or settings.MAX_IMAGE_HEADER_SIZE
+        self.max_pixels = max_pixels or settings.MAX_IMAGE_PIXELS
+        self.max_dimension = max_dimension or settings.MAX_IMAGE_DIMENSION
+        self.max_frames = max_frames or settings.MAX_IMAGE_FRAMES
+        self.info: Optional[ImageInfo] = None
+        self._content_type: Optional[str] = None
+        self._head = bytearray()
+
+    def feed(self, chunk: bytes) -> None:
+        if self.info is not None:
+            return
+
+        self._head += chunk[:self.max_header_size - len(self._head)]
+        if self._content_type is None:
+            if len(self._head) < SNIFF_SIZE:
+                return
+            self._sniff()
+
+        info = self._parse()
+        if info is None:
+            if len(self._head) >= self.max_header_size:
+                raise InvalidImageError("Invalid or corrupt image header")
+            return
+        self._check_limits(info)
+        self.info = info
+        self._head = bytearray()
+
+    def finish(self) -> ImageInfo:
+        """Результат проверки после того, как поток закончился"""
+        if self.info is None:
+            if self._content_type is None:
+                self._sniff()
+            raise InvalidImageError("Invalid or corrupt image header")
+        return self.info
+
+    def _sniff(self) -> None:
+        content_type = sniff_content_type(bytes(self._head))
+        if (self.expected_content_type
+                and content_type != self.expected_content_type):
+            raise InvalidImageError(
+                "Content-Type does not match file contents"
+            )
+        self._content_type = content_type
+
+    def _parse(self) -> Optional[ImageInfo]:
+        try:
+            with Image.open(io.BytesIO(self._head)) as img:
+                width, height = img.size
+                frames = getattr(img, "n_frames", 1)
+        except Image.DecompressionBombError as e:
+            raise InvalidImageError(str(e))
+        except (UnidentifiedImageError, OSError, SyntaxError):
+            return None
+        assert self._content_type is not None
+        return ImageInfo(self._content_type, width, height, frames)
+
+    def _check_limits(self, info: ImageInfo) -> None:
+        if info.width <= 0 or info.height <= 0:
+            raise InvalidImageError("Invalid image dimensions")
+        if max(info.width, info.height) > self.max_dimension:
+            raise InvalidImageError(
+                f"Image dimensions {info.width}x{info.height} exceed "
+                f"maximum of {self.max_dimension}px"
+            )
+        if info.width * info.height > self.max_pixels:
+            raise InvalidImageError(
+                f"Image exceeds maximum of {self.max_pixels} pixels"
+            )
+        if info.frames > self.max_frames:
+            raise InvalidImageError(
+                f"Image has more than {self.max_frames} frames"
+            )
+
+
+def validate_image_file(
+    path: Path, validator: ImageHeaderValidator, chunk_size: int
+) -> ImageInfo:
+    """Проверяет уже записанный файл, читая только его начало"""
+    with open(path, "rb") as f:
+        while validator.info is None and (chunk := f.read(chunk_size)):
+            validator.feed(chunk)
+    return validator.finish()
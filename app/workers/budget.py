@@ -0,0 +1,52 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+
+class PixelBudget:
+    """Ограничение суммарного числа пикселей в одновременно обрабатываемых задачах
+
+    Число сообщений в работе ограничено prefetch, но одно 100-мегапиксельное
+    изображение занимает в памяти столько же, сколько сотня маленьких.
+    Задача резервирует пиксели своего оригинала и ждет, пока они не
+    освободятся. Изображение больше всего бюджета занимает его целиком
+    и обрабатывается в одиночку.
+
+    Массовые задачи (bulk) уступают очередь: пока бюджета ждет хотя бы
+    одна интерактивная задача, массовые не стартуют.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self.interactive_waiting = 0
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reserve(
+        self, pixels: int, bulk: bool = False
+    ) -> AsyncIterator[None]:
+        pixels = max(0, min(pixels, self.limit))
+        async with self._condition:
+            if bulk:
+                await self._condition.wait_for(
+                    lambda: self.in_use + pixels <= self.limit
+                    and not self.interactive_waiting
+                )
+            else:
+                self.interactive_waiting += 1
+                try:
+                    await self._condition.wait_for(
+                        lambda: self.in_use + pixels <= self.limit
+                    )
+                finally:
+                    self.interactive_waiting -= 1
+                    # Массовые задачи ждут, пока очередь не опустеет
+                    self._condition.notify_all()
+            self.in_use += pixels
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.in_use -= pixels
+                self._condition.notify_all()
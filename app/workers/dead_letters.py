@@ -0,0 +1,126 @@
+"""Просмотр и повторный запуск задач из dead-letter очереди
+
+    python -m app.workers.dead_letters list [--limit 50]
+    python -m app.workers.dead_letters replay --all
+    python -m app.workers.dead_letters replay IMAGE_ID [IMAGE_ID ...]
+"""
+import argparse
+import asyncio
+import json
+from typing import List, Optional, Set
+from uuid import UUID
+
+import aio_pika
+from aio_pika.abc import AbstractIncomingMessage, AbstractQueue
+
+from app.broker import ATTEMPT_HEADER, DEAD_LETTER_QUEUE, queue_for
+from app.core.config import settings
+from app.crud import update_image_status
+from app.dependencies import AsyncSessionLocal
+
+
+async def fetch_messages(
+    queue: AbstractQueue, limit: Optional[int]
+) -> List[AbstractIncomingMessage]:
+    """Забирает сообщения без подтверждения, чтобы не получить их повторно"""
+    messages = []
+    while limit is None or len(messages) < limit:
+        message = await queue.get(no_ack=False, fail=False)
+        if message is None:
+            break
+        messages.append(message)
+    return messages
+
+
+def describe(message: AbstractIncomingMessage) -> str:
+    data = json.loads(message.body.decode())
+    headers = message.headers or {}
+    return (
+        f"{data.get('image_id')}  attempts={headers.get(ATTEMPT_HEADER)}  "
+        f"error={headers.get('x-error')}"
+    )
+
+
+async def list_dead_letters(queue: AbstractQueue, limit: int) -> None:
+    messages = await fetch_messages(queue, limit)
+    for message in messages:
+        print(describe(message))
+    print(f"Shown: {len(messages)}")
+    # Сообщения остаются в очереди
+    for message in messages:
+        await message.reject(requeue=True)
+
+
+async def replay_dead_letters(
+    channel: aio_pika.abc.AbstractChannel,
+    queue: AbstractQueue,
+    image_ids: Optional[Set[str]],
+) -> None:
+    """Возвращает задачи в их очереди со сброшенным счетчиком попыток
+
+    Переигрываются только задачи, изображение которых все еще в ERROR;
+    сообщения об уже переобработанных или удаленных изображениях
+    подтверждаются без публикации.
+    """
+    replayed = 0
+    for message in await fetch_messages(queue, None):
+        data = json.loads(message.body.decode())
+        if image_ids is not None and data.get("image_id") not in image_ids:
+            await message.reject(requeue=True)
+            continue
+
+        async with AsyncSessionLocal() as db:
+            image = await update_image_status(
+                db, UUID(data["image_id"]), "QUEUED", expected_status="ERROR"
+            )
+        if image is None:
+            await message.ack()
+            print(f"Skipped {data['image_id']}: not in ERROR")
+            continue
+        await channel.default_exchange.publish(
+            aio_pika.Message(
+                body=message.body,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            ),
+            routing_key=queue_for(data.get("priority")),
+        )
+        await message.ack()
+        replayed += 1
+        print(f"Replayed {data['image_id']}")
+    print(f"Replayed: {replayed}")
+
+
+async def main(args: argparse.Namespace) -> None:
+    connection = await aio_pika.connect_robust(settings.RABBITMQ_URL)
+    async with connection:
+        channel = await connection.channel()
+        queue = await channel.declare_queue(DEAD_LETTER_QUEUE, durable=True)
+        if args.command == "list":
+            await list_dead_letters(queue, args.limit)
+        else:
+            image_ids = None if args.all else set(args.image_ids)
+            await replay_dead_letters(channel, queue, image_ids)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = commands.add_parser("list", help="show dead-lettered jobs")
+    list_parser.add_argument("--limit", type=int, default=50)
+
+    replay_parser = commands.add_parser("replay", help="requeue jobs")
+    replay_parser.add_argument("image_ids", nargs="*")
+    replay_parser.add_argument("--all", action="store_true")
+
+    args = parser.parse_args()
+    if args.command == "replay" and not (args.all or args.image_ids):
+        parser.error("replay requires IMAGE_ID arguments or --all")
+    return args
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
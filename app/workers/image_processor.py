@@ -1,21 +1,51 @@
 import asyncio
 import aio_pika
 import json
+import multiprocessing
+import os
+import queue
 import sys
 import logging
-from pathlib import Path
-from PIL import Image
-from PIL.Image import Resampling
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from functools import lru_cache, partial
+from multiprocessing.managers import SyncManager
+from aio_pika.abc import AbstractExchange, AbstractIncomingMessage
+from PIL import UnidentifiedImageError
 from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional, Tuple
 from uuid import UUID
 import time
 
 # Add project root to path
 sys.path.append('/app')
 
+from app.broker import (  # noqa: E402
+    ATTEMPT_HEADER,
+    BULK_QUEUE,
+    DEAD_LETTER_QUEUE,
+    IMAGES_QUEUE,
+    declare_topology,
+    queue_for,
+    retry_delay,
+    retry_queue_name,
+)
 from app.core.config import settings  # noqa: E402
 from app.dependencies import AsyncSessionLocal  # noqa: E402
-from app.crud import update_image_status  # noqa: E402
+from app.crud import (  # noqa: E402
+    add_thumbnails,
+    claim_image,
+    extend_lease,
+    release_image,
+    update_image_status,
+)
+from app.imaging import THUMBNAIL_SIZES, encoding_available  # noqa: E402
+from app.storage_backends import default_storage  # noqa: E402
+from app.workers.budget import PixelBudget  # noqa: E402
+from app.workers.thumbnails import (  # noqa: E402
+    ProgressQueue, Thumbnails, build_thumbnails
+)
 
 # Настройка логирования
 logging.basicConfig(
@@ -24,40 +54,182 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Ошибки, которые повтор не исправит: битое сообщение, нет файла,
+# файл не является изображением
+PERMANENT_ERRORS = (
+    json.JSONDecodeError,
+    KeyError,
+    ValueError,
+    FileNotFoundError,
+    UnidentifiedImageError,
+)
+
+
+class JobLease:
+    """Аренда задачи, полученная этим worker'ом
+
+    Срок аренды из БД служит маркером владения: им проверяются
+    продление и освобождение задачи после неудачной попытки.
+    """
+
+    def __init__(self):
+        self.expires_at: Optional[datetime] = None
+
+
+# Как часто проверяется, не завершилась ли задача в пуле без результата
+PROGRESS_POLL_INTERVAL = 1.0
+
+
+async def keep_lease(image_id: str, lease: JobLease):
+    """Периодически продлевает аренду задачи, пока идет обработка
+
+    Ошибка продления (например, недоступна БД) не останавливает цикл:
+    следующая попытка будет через тот же интервал, пока аренда не
+    истекла.
+    """
+    interval = settings.WORKER_LEASE_SECONDS / 3
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with AsyncSessionLocal() as db:
+                expires_at = await extend_lease(
+                    db, UUID(image_id), lease.expires_at,
+                    settings.WORKER_LEASE_SECONDS,
+                )
+        except Exception as e:
+            logger.error(f"Failed to extend lease of image {image_id}: {e}")
+            continue
+        if expires_at is None:
+            logger.warning(f"Lease of image {image_id} is lost")
+            return
+        lease.expires_at = expires_at
+
 
-async def process_image(image_id: str, original_path: str, db: AsyncSession):
+@lru_cache(maxsize=None)
+def extra_encodings() -> Tuple[str, ...]:
+    """Дополнительные форматы миниатюр из THUMBNAIL_EXTRA_FORMATS
+
+    Форматы, которые не поддерживает установленный Pillow, пропускаются.
+    """
+    names = [
+        name.strip().lower()
+        for name in settings.THUMBNAIL_EXTRA_FORMATS.split(",")
+        if name.strip()
+    ]
+    available = []
+    for name in names:
+        if encoding_available(name):
+            available.append(name)
+        else:
+            logger.warning(
+                f"Thumbnail format {name} is not available, skipping"
+            )
+    return tuple(available)
+
+
+async def process_image(
+    image_id: str,
+    original_path: str,
+    db: AsyncSession,
+    executor: Executor,
+    lease: Optional[JobLease] = None,
+):
+    # Повторная доставка уже обработанной или занятой задачи
+    # обходится одним UPDATE без декодирования
+    image = await claim_image(db, UUID(image_id), settings.WORKER_LEASE_SECONDS)
+    if image is None:
+        logger.info(f"Image {image_id} is already processed or claimed, skipping")
+        return
+
+    if lease is None:
+        lease = JobLease()
+    lease.expires_at = image.lease_expires_at
     logger.info(f"Processing image {image_id} from {original_path}")
+    heartbeat = asyncio.create_task(keep_lease(image_id, lease))
+    build = None
+    # Из удаленного хранилища оригинал скачивается один раз на все размеры
+    source = default_storage().local_copy(original_path)
     try:
-        await update_image_status(db, UUID(image_id), "PROCESSING")
+        local_path = await asyncio.to_thread(source.__enter__)
+        try:
+            # Декодирование, ресемплинг и кодирование выполняются одной
+            # задачей в пуле процессов, event loop в это время
+            # обслуживает брокер и БД. Оригинал декодируется один раз,
+            # размеры сохраняются от меньшего к большему и каждый
+            # публикуется в запись сразу по готовности (PARTIAL),
+            # последний переводит в DONE
+            progress = progress_queue(executor)
+            build = asyncio.get_running_loop().run_in_executor(
+                executor,
+                build_thumbnails,
+                image_id,
+                str(local_path),
+                THUMBNAIL_SIZES,
+                extra_encodings(),
+                progress,
+            )
+            remaining = len(THUMBNAIL_SIZES)
+            while remaining:
+                rendition = await next_rendition(progress, build)
+                if rendition is None:
+                    # Ошибка задачи в пуле поднимается здесь
+                    await build
+                    raise RuntimeError("Thumbnail build finished early")
+                remaining -= 1
+                for size, thumb_key in rendition.paths.items():
+                    meta = rendition.meta[size]
+                    logger.info(
+                        f"Created thumbnail {size}: {thumb_key} "
+                        f"(quality {meta['quality']}, {meta['bytes']} bytes)"
+                    )
 
-        # Загрузить оригинал
-        with Image.open(original_path) as orig_img:
-            logger.info(f"Original image size: {orig_img.size}")
-            thumbnails = {}
-            sizes = [(100, 100), (300, 300), (1200, 1200)]
+                status = "PARTIAL" if remaining else "DONE"
+                image = await add_thumbnails(
+                    db, UUID(image_id), rendition.paths, rendition.meta,
+                    status,
+                )
+                if image is None:
+                    # Задачу забрал reaper или другой worker
+                    logger.warning(f"Image {image_id} is no longer claimed")
+                    return
+        finally:
+            if build is not None:
+                build.cancel()
+            await asyncio.to_thread(source.__exit__, None, None, None)
+    finally:
+        heartbeat.cancel()
+    logger.info(f"Successfully processed image {image_id}")
 
-            for width, height in sizes:
-                thumb = orig_img.copy()
-                thumb.thumbnail((width, height), resample=Resampling.LANCZOS)
 
-                thumb_dir = (Path(settings.STORAGE_PATH) / "thumbs" /
-                             f"{width}x{height}")
-                thumb_dir.mkdir(parents=True, exist_ok=True)
-                thumb_filename = f"{image_id}_{width}x{height}.jpg"
-                thumb_path = thumb_dir / thumb_filename
+@lru_cache(maxsize=None)
+def progress_manager() -> SyncManager:
+    """Процесс-посредник для очередей прогресса задач в пуле процессов"""
+    return multiprocessing.get_context("spawn").Manager()
 
-                thumb.save(thumb_path, "JPEG", quality=85, optimize=True)
-                thumbnails[f"{width}x{height}"] = str(thumb_path)
-                thumb_info = f"Created thumbnail {width}x{height}: {thumb_path}"
-                logger.info(thumb_info)
 
-        await update_image_status(db, UUID(image_id), "DONE", thumbnails)
-        logger.info(f"Successfully processed image {image_id}")
+def progress_queue(executor: Executor) -> ProgressQueue:
+    """Очередь, в которую задача в executor кладет готовые размеры"""
+    if isinstance(executor, ProcessPoolExecutor):
+        return progress_manager().Queue()
+    return queue.Queue()
 
-    except Exception as e:
-        logger.error(f"Error processing image {image_id}: {e}")
-        await update_image_status(db, UUID(image_id), "ERROR", error=str(e))
-        raise
+
+async def next_rendition(
+    progress, build: asyncio.Future
+) -> Optional[Thumbnails]:
+    """Следующий сохраненный размер; None, когда задача завершилась
+
+    Очередь опрашивается с таймаутом, чтобы не зависнуть, если процесс
+    пула упал, не успев положить в нее завершающий None.
+    """
+    while True:
+        try:
+            return await asyncio.to_thread(
+                progress.get, True, PROGRESS_POLL_INTERVAL
+            )
+        except queue.Empty:
+            if build.done():
+                return None
 
 
 async def connect_to_rabbitmq_with_retry(max_retries=10, retry_delay=5):
@@ -78,39 +250,256 @@ async def connect_to_rabbitmq_with_retry(max_retries=10, retry_delay=5):
                 raise
 
 
+def worker_processes() -> int:
+    return settings.WORKER_PROCESSES or os.cpu_count() or 1
+
+
+def create_executor() -> ProcessPoolExecutor:
+    """Пул процессов для CPU-стадии обработки изображений
+
+    Используется spawn: дочерние процессы не наследуют event loop,
+    соединения и потоки родителя.
+    """
+    max_workers = worker_processes()
+    logger.info(f"Starting process pool with {max_workers} workers")
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+
+class RenderPool:
+    """Пул процессов CPU-стадии, пересоздаваемый после падения процесса
+
+    Если дочерний процесс умер (например, его убил OOM killer на большом
+    оригинале), ProcessPoolExecutor остается сломанным навсегда, и все
+    следующие задачи падали бы с BrokenProcessPool. Такой пул
+    заменяется новым вместе с процессом-посредником очередей прогресса.
+    """
+
+    def __init__(self, factory=create_executor):
+        self._factory = factory
+        self.executor: Executor = factory()
+        self.restarts = 0
+
+    def rebuild(self, broken: Executor) -> None:
+        """Заменяет пул broken; повторный вызов для старого пула ничего
+        не делает, так что задачи, упавшие вместе, пересоздают его один раз
+        """
+        if broken is not self.executor:
+            return
+        logger.error("Process pool is broken, starting a new one")
+        broken.shutdown(wait=False, cancel_futures=True)
+        if progress_manager.cache_info().currsize:
+            try:
+                progress_manager().shutdown()
+            except Exception as e:
+                logger.warning(f"Failed to stop progress manager: {e}")
+            progress_manager.cache_clear()
+        self.executor = self._factory()
+        self.restarts += 1
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        if progress_manager.cache_info().currsize:
+            progress_manager().shutdown()
+
+
+def worker_prefetch() -> int:
+    return settings.WORKER_PREFETCH or 2 * worker_processes()
+
+
+def worker_bulk_prefetch() -> int:
+    """Сколько массовых задач worker берет в работу одновременно
+
+    По умолчанию по одной на процесс: при пустой интерактивной очереди
+    массовые задачи занимают все процессы, а интерактивная очередь
+    получает вдвое больший prefetch и приоритет в бюджете пикселей.
+    """
+    return settings.WORKER_BULK_PREFETCH or worker_processes()
+
+
+def job_pixels(data: dict) -> int:
+    """Оценка памяти задачи в пикселях по размерам из сообщения
+
+    Для сообщений без размеров резервируется доля бюджета, как если бы
+    все prefetch-задачи были одинаковыми.
+    """
+    if data.get("width") and data.get("height"):
+        return data["width"] * data["height"]
+    return settings.WORKER_MAX_INFLIGHT_PIXELS // worker_prefetch()
+
+
+async def retry_or_dead_letter(
+    exchange: AbstractExchange,
+    message: AbstractIncomingMessage,
+    data: Optional[dict],
+    error: Exception,
+    lease: Optional[JobLease] = None,
+):
+    """Откладывает повтор неудачной задачи или отправляет ее в dead-letter
+
+    Номер попытки хранится в заголовке сообщения. Пока попытки не
+    исчерпаны, копия сообщения уходит в очередь повтора с экспоненциально
+    растущей задержкой. Последняя попытка и заведомо неисправимые ошибки
+    отправляют сообщение в dead-letter очередь, а запись - в ERROR.
+
+    Запись меняется только под арендой lease этой попытки; если задача
+    не была забрана, в ERROR переводится лишь еще не взятая в работу.
+    """
+    attempt = int((message.headers or {}).get(ATTEMPT_HEADER, 0)) + 1
+    headers = {ATTEMPT_HEADER: attempt, "x-error": str(error)[:1000]}
+    permanent = isinstance(error, PERMANENT_ERRORS)
+
+    if not permanent and attempt < settings.WORKER_MAX_ATTEMPTS:
+        delay = retry_delay(attempt, settings.WORKER_RETRY_BASE_DELAY)
+        logger.warning(
+            f"Attempt {attempt} failed, retrying in {delay:.0f}s: {error}"
+        )
+        # Повтор возвращается в очередь того же приоритета
+        queue = queue_for(data.get("priority")) if data else IMAGES_QUEUE
+        routing_key = retry_queue_name(delay, queue)
+    else:
+        logger.error(f"Moving message to {DEAD_LETTER_QUEUE}: {error}")
+        routing_key = DEAD_LETTER_QUEUE
+
+    await exchange.publish(
+        aio_pika.Message(
+            body=message.body,
+            headers=headers,
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+        ),
+        routing_key=routing_key,
+    )
+
+    if not data or "image_id" not in data:
+        return
+    image_id = UUID(data["image_id"])
+    status = "ERROR" if routing_key == DEAD_LETTER_QUEUE else "QUEUED"
+    async with AsyncSessionLocal() as db:
+        if lease is not None and lease.expires_at is not None:
+            # При повторе задача освобождается, чтобы следующая попытка
+            # смогла ее забрать, не дожидаясь истечения аренды
+            image = await release_image(
+                db, image_id, lease.expires_at, status, error=str(error)
+            )
+            if image is None:
+                logger.warning(f"Image {image_id} is no longer claimed")
+        elif status == "ERROR":
+            await update_image_status(
+                db, image_id, status, error=str(error),
+                expected_status="QUEUED",
+            )
+
+
+async def handle_message(
+    message: AbstractIncomingMessage,
+    exchange: AbstractExchange,
+    pool: RenderPool,
+    budget: PixelBudget,
+    bulk: bool = False,
+):
+    """Обработка одного сообщения; подтверждается по своему завершению
+
+    Ошибка обработки не возвращает сообщение в очередь сразу, а
+    откладывает повтор. Если не удалось опубликовать и повтор, сообщение
+    отклоняется с requeue и будет доставлено снова. Сообщения из
+    массовой очереди (bulk) пропускают интерактивные вперед.
+
+    Падение процесса пула - не ошибка задачи: пул пересоздается, задача
+    освобождается, а сообщение возвращается в очередь без учета попытки.
+    """
+    try:
+        async with message.process(requeue=True):
+            data = None
+            lease = JobLease()
+            executor = pool.executor
+            try:
+                data = json.loads(message.body.decode())
+                logger.info(f"Received message: {data}")
+
+                async with budget.reserve(job_pixels(data), bulk=bulk):
+                    async with AsyncSessionLocal() as db:
+                        await process_image(
+                            data["image_id"],
+                            data["original_path"],
+                            db,
+                            executor,
+                            lease,
+                        )
+            except BrokenProcessPool:
+                pool.rebuild(executor)
+                await release_for_requeue(data, lease)
+                raise
+            except Exception as e:
+                logger.error(f"Error processing message: {e}")
+                await retry_or_dead_letter(exchange, message, data, e, lease)
+    except BrokenProcessPool:
+        # Сообщение уже отклонено с requeue
+        logger.warning("Message requeued after process pool failure")
+
+
+async def release_for_requeue(data: Optional[dict], lease: JobLease):
+    """Возвращает задачу в QUEUED, чтобы повторная доставка того же
+    сообщения смогла ее забрать, не дожидаясь истечения аренды"""
+    if not data or "image_id" not in data or lease.expires_at is None:
+        return
+    async with AsyncSessionLocal() as db:
+        await release_image(
+            db, UUID(data["image_id"]), lease.expires_at, "QUEUED"
+        )
+
+
 async def main():
     logger.info("Starting image processing worker...")
     
     connection = await connect_to_rabbitmq_with_retry()
+    pool = RenderPool()
+    progress_manager()
+    budget = PixelBudget(settings.WORKER_MAX_INFLIGHT_PIXELS)
     
     try:
         async with connection:
+            # Берем в работу до prefetch сообщений, каждое обрабатывается
+            # в своей задаче, а память ограничивает бюджет пикселей.
+            # У каждой очереди свой канал, чтобы prefetch считался
+            # отдельно: массовые задачи не занимают места интерактивных
+            prefetch = worker_prefetch()
+            bulk_prefetch = worker_bulk_prefetch()
             channel = await connection.channel()
+            await channel.set_qos(prefetch_count=prefetch)
+            bulk_channel = await connection.channel()
+            await bulk_channel.set_qos(prefetch_count=bulk_prefetch)
             
-            # Устанавливаем QoS для обработки по одному сообщению за раз
-            await channel.set_qos(prefetch_count=1)
-            
-            queue = await channel.declare_queue("images", durable=True)
-            logger.info("Worker is ready to process messages")
-
-            async with queue.iterator() as queue_iter:
-                async for message in queue_iter:
-                    async with message.process():
-                        try:
-                            data = json.loads(message.body.decode())
-                            logger.info(f"Received message: {data}")
-                            
-                            async with AsyncSessionLocal() as db:
-                                await process_image(
-                                    data["image_id"], data["original_path"], db
-                                )
-                        except Exception as e:
-                            logger.error(f"Error processing message: {e}")
-                            # Сообщение будет отклонено и может быть обработано повторно
-                            raise
+            await declare_topology(
+                channel,
+                settings.WORKER_MAX_ATTEMPTS,
+                settings.WORKER_RETRY_BASE_DELAY,
+            )
+            for queue_name, queue_channel, bulk in (
+                (IMAGES_QUEUE, channel, False),
+                (BULK_QUEUE, bulk_channel, True),
+            ):
+                queue = await queue_channel.get_queue(queue_name)
+                await queue.consume(partial(
+                    handle_message,
+                    exchange=queue_channel.default_exchange,
+                    pool=pool,
+                    budget=budget,
+                    bulk=bulk,
+                ))
+            logger.info(
+                f"Worker is ready to process messages "
+                f"(prefetch={prefetch}, bulk prefetch={bulk_prefetch})"
+            )
+
+            # Сообщения обрабатываются в задачах, созданных consume
+            await asyncio.Future()
     except Exception as e:
         logger.error(f"Fatal error in worker: {e}")
         raise
+    finally:
+        pool.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+"""CPU-стадия обработки изображения
+
+Функции модуля выполняются в процессах ProcessPoolExecutor, поэтому они
+синхронные, не трогают БД и брокер и возвращают только данные, которые
+можно передать между процессами. Миниатюры сохраняются в хранилище
+процесса (default_storage).
+"""
+from typing import Dict, Iterable, List, NamedTuple, Optional, Protocol
+
+from PIL import Image
+
+from app.imaging import (
+    DEFAULT_ENCODING, ENCODINGS, Size, encode_adaptive, quality_policy,
+    render_thumbnails, thumbnail_key,
+)
+from app.storage_backends import default_storage, thumbnail_storage_key
+
+
+class Thumbnails(NamedTuple):
+    # {"WxH" или "WxH.<формат>": ключ миниатюры в хранилище}
+    paths: Dict[str, str]
+    # {тот же ключ: {"quality": качество, "bytes": размер файла}}
+    meta: Dict[str, Dict[str, int]]
+
+
+class ProgressQueue(Protocol):
+    def put(self, item: Optional[Thumbnails]) -> None:
+        ...
+
+
+def build_thumbnails(
+    image_id: str,
+    original_path: str,
+    sizes: Iterable[Size],
+    extra_encodings: Iterable[str] = (),
+    progress: Optional[ProgressQueue] = None,
+) -> List[Thumbnails]:
+    """Строит и сохраняет миниатюры всех размеров за одно декодирование
+
+    original_path - локальный путь к оригиналу.
+
+    Оригинал декодируется один раз и уменьшается каскадом
+    (render_thumbnails), затем размеры кодируются и сохраняются от
+    меньшего к большему. Каждый сохраненный размер сразу кладется в
+    progress, чтобы его можно было опубликовать, не дожидаясь больших;
+    в конце, в том числе при ошибке, туда кладется None.
+    """
+    try:
+        thumbnails = render_thumbnails(original_path, sizes)
+        renditions = []
+        for box in sorted(thumbnails, key=lambda box: box[0] * box[1]):
+            rendition = _save_rendition(
+                image_id, box, thumbnails.pop(box), extra_encodings
+            )
+            renditions.append(rendition)
+            if progress is not None:
+                progress.put(rendition)
+        return renditions
+    finally:
+        if progress is not None:
+            progress.put(None)
+
+
+def _save_rendition(
+    image_id: str,
+    box: Size,
+    thumbnail: Image.Image,
+    extra_encodings: Iterable[str],
+) -> Thumbnails:
+    """Сохраняет миниатюру одного размера в JPEG и форматах
+    extra_encodings (например, webp, avif); качество подбирается по
+    QUALITY_POLICIES своего формата"""
+    encodings = [DEFAULT_ENCODING]
+    encodings += [name for name in extra_encodings if name != DEFAULT_ENCODING]
+
+    width, height = box
+    storage = default_storage()
+
+    rendition = Thumbnails({}, {})
+    for encoding in encodings:
+        storage_key = thumbnail_storage_key(
+            image_id, width, height, ENCODINGS[encoding].extension
+        )
+        encoded = encode_adaptive(
+            thumbnail, encoding, quality_policy(encoding, box)
+        )
+        storage.put_bytes(storage_key, encoded.data)
+
+        key = thumbnail_key(box, encoding)
+        rendition.paths[key] = storage_key
+        rendition.meta[key] = {
+            "quality": encoded.quality,
+            "bytes": len(encoded.data),
+        }
+    return rendition
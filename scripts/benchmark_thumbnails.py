@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк построения миниатюр: прежний способ (копия полного кадра и
+LANCZOS с полного разрешения на каждый размер) против каскада с
+однократным декодированием через Image.draft.
+
+Тестовое изображение создается и каждый вариант запускается в
+отдельном процессе: на Linux ru_maxrss родителя наследуется дочерним
+процессом, поэтому пик памяти родителя, построившего большой кадр,
+попал бы в базовую линию замера. Внутри процесса пик (VmHWM)
+дополнительно сбрасывается перед замером, где это поддерживается.
+
+    python scripts/benchmark_thumbnails.py [--width 6000 --height 4000]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from PIL import Image, ImageDraw  # noqa: E402
+from PIL.Image import Resampling  # noqa: E402
+
+from app.imaging import THUMBNAIL_SIZES, render_thumbnails  # noqa: E402
+
+
+def legacy_thumbnails(path):
+    """Прежняя реализация из image_processor.process_image"""
+    thumbnails = {}
+    with Image.open(path) as orig_img:
+        for width, height in THUMBNAIL_SIZES:
+            thumb = orig_img.copy()
+            thumb.thumbnail((width, height), resample=Resampling.LANCZOS)
+            thumbnails[(width, height)] = thumb
+    return thumbnails
+
+
+PIPELINES = {
+    "legacy": legacy_thumbnails,
+    "cascade": render_thumbnails,
+}
+
+
+def create_test_image(path, width, height, image_format):
+    """Синтетическое фото: градиент с деталями, чтобы кодек не выродился"""
+    img = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    step = max(width, height) // 60
+    for i in range(0, max(width, height), step):
+        draw.line([(i, 0), (0, i)], fill=(i % 256, 90, 200), width=3)
+    img.save(path, image_format, quality=92)
+
+
+def reset_peak_rss() -> bool:
+    """Сбрасывает VmHWM процесса (Linux 4.0+); False, если не удалось"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_kb() -> int:
+    """Пиковый RSS процесса в KB: VmHWM, иначе ru_maxrss"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_single(pipeline, path, iterations):
+    """Выполняется в дочернем процессе, печатает JSON с результатом"""
+    reset_peak_rss()
+    baseline = peak_rss_kb()
+    func = PIPELINES[pipeline]
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func(path)
+        timings.append(time.perf_counter() - started)
+    peak = peak_rss_kb()
+    print(json.dumps({
+        "mean_ms": sum(timings) / len(timings) * 1000,
+        "best_ms": min(timings) * 1000,
+        "peak_rss_mb": peak / 1024,
+        "delta_rss_mb": (peak - baseline) / 1024,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--width", type=int, default=6000)
+    parser.add_argument("--height", type=int, default=4000)
+    parser.add_argument("--format", default="JPEG", choices=["JPEG", "PNG"])
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument("--create", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_single(args.child[0], args.child[1], args.iterations)
+        return
+    if args.create:
+        create_test_image(args.create, args.width, args.height, args.format)
+        return
+
+    suffix = ".jpg" if args.format == "JPEG" else ".png"
+    with tempfile.NamedTemporaryFile(suffix=suffix) as tmp:
+        # Кадр строится в отдельном процессе, чтобы родитель оставался
+        # маленьким и не завышал базовую линию замеров
+        subprocess.check_call([
+            sys.executable, __file__,
+            "--width", str(args.width), "--height", str(args.height),
+            "--format", args.format, "--create", tmp.name,
+        ])
+        print(f"Оригинал: {args.width}x{args.height} {args.format}, "
+              f"{os.path.getsize(tmp.name) / 1024 / 1024:.1f} MB, "
+              f"итераций: {args.iterations}")
+
+        results = {}
+        for pipeline in PIPELINES:
+            output = subprocess.check_output([
+                sys.executable, __file__,
+                "--iterations", str(args.iterations),
+                "--child", pipeline, tmp.name,
+            ])
+            results[pipeline] = json.loads(output)
+
+    for pipeline, result in results.items():
+        print(f"{pipeline:>8}: {result['mean_ms']:8.1f} ms/изобр. "
+              f"(лучшее {result['best_ms']:.1f}), "
+              f"пик RSS +{result['delta_rss_mb']:.0f} MB")
+
+    legacy, cascade = results["legacy"], results["cascade"]
+    print(f"Ускорение: x{legacy['mean_ms'] / cascade['mean_ms']:.1f}, "
+          f"экономия памяти: "
+          f"{legacy['delta_rss_mb'] - cascade['delta_rss_mb']:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
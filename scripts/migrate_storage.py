@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Перенос файлов изображений в раскладку хранилищ (app/storage_backends.py).
+
+Оригиналы и миниатюры, записанные абсолютными путями в STORAGE_PATH,
+копируются в целевое хранилище (local или s3) под ключами новой
+раскладки: миниатюры раскладываются по префиксу UUID, оригиналы - по
+хешу содержимого. Записи в БД переписываются на ключи пачками, каждая
+пачка - отдельный commit. Повторный запуск продолжает с того же места:
+уже перенесенные файлы не копируются заново. С --delete-source исходные
+файлы удаляются в самом конце, когда переписаны все записи: после
+дедупликации на один файл могут ссылаться несколько записей.
+
+    python scripts/migrate_storage.py [--target s3] [--dry-run]
+                                      [--delete-source]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from pathlib import Path
+from typing import Optional, Set, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import select, update  # noqa: E402
+
+from app.core.config import settings  # noqa: E402
+from app.dependencies import AsyncSessionLocal  # noqa: E402
+from app.imaging import parse_thumbnail_key  # noqa: E402
+from app.models import Image  # noqa: E402
+from app.storage_backends import (  # noqa: E402
+    LocalStorage,
+    StorageBackend,
+    create_storage,
+    original_key,
+    thumbnail_storage_key,
+)
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+logger = logging.getLogger("migrate_storage")
+
+
+def relative_key(value: str, root: Path) -> Optional[str]:
+    """Ключ относительно root; None, если файл вне root"""
+    path = Path(value)
+    if not path.is_absolute():
+        return value
+    try:
+        return path.relative_to(root).as_posix()
+    except ValueError:
+        return None
+
+
+def target_original_key(image: Image, root: Path) -> Optional[str]:
+    if image.content_hash:
+        return original_key(
+            image.content_hash, Path(image.original_url).suffix
+        )
+    return relative_key(image.original_url, root)
+
+
+def target_thumbnail_key(image: Image, key: str, value: str) -> Optional[str]:
+    parsed = parse_thumbnail_key(key)
+    if parsed is None:
+        return None
+    width, height = parsed[0]
+    return thumbnail_storage_key(
+        str(image.id), width, height, Path(value).suffix
+    )
+
+
+class Migration:
+    """Перенос файлов по уникальным исходным путям
+
+    Дедуплицированные записи ссылаются на одни и те же файлы, поэтому
+    каждый исходный файл копируется под каждый нужный ключ один раз, а
+    удаляется (--delete-source) только после того, как переписаны все
+    записи.
+    """
+
+    def __init__(
+        self,
+        source: LocalStorage,
+        target: StorageBackend,
+        same_storage: bool,
+        dry_run: bool,
+        delete_source: bool,
+    ):
+        self.source = source
+        self.target = target
+        self.same_storage = same_storage
+        self.dry_run = dry_run
+        self.delete_source = delete_source
+        self.copied = 0
+        self.missing = 0
+        # Уже перенесенные пары (исходный путь, ключ)
+        self._transferred: Set[Tuple[str, str]] = set()
+        # Перенесенные исходные файлы и ключи, под которые они записаны
+        self.sources: Set[str] = set()
+        self.keys: Set[str] = set()
+
+    def transfer(self, current: str, key: Optional[str]) -> str:
+        """Копирует файл current под ключ key и возвращает новое значение
+
+        Если перенести нельзя (файл вне хранилища или отсутствует),
+        возвращается прежнее значение.
+        """
+        if key is None:
+            logger.warning(f"Skipping {current}: outside of storage root")
+            return current
+        if self.same_storage and self.source.path(current) == \
+                self.source.path(key):
+            return key
+        if (current, key) in self._transferred:
+            return key
+
+        # Ключ уже есть: дубликат по содержимому или прошлый запуск
+        if not self.target.exists(key):
+            source_path = self.source.local_path(current)
+            if not source_path.is_file():
+                logger.warning(f"Skipping {current}: file not found")
+                self.missing += 1
+                return current
+
+            logger.info(f"{current} -> {key}")
+            if not self.dry_run:
+                self.target.put_file(key, source_path, move=False)
+            self.copied += 1
+
+        self._transferred.add((current, key))
+        self.sources.add(current)
+        self.keys.add(key)
+        return key
+
+    def delete_sources(self) -> int:
+        """Удаляет перенесенные исходные файлы; вызывается после commit
+        всех записей"""
+        kept = set()
+        if self.same_storage:
+            kept = {self.source.path(key) for key in self.keys}
+        deleted = 0
+        for current in self.sources:
+            if self.source.path(current) in kept:
+                continue
+            self.source.delete(current)
+            deleted += 1
+        return deleted
+
+    def migrate_image(self, image: Image) -> dict:
+        values = {}
+        original = self.transfer(
+            image.original_url,
+            target_original_key(image, self.source.root),
+        )
+        if original != image.original_url:
+            values["original_url"] = original
+
+        thumbnails = {
+            key: self.transfer(value, target_thumbnail_key(image, key, value))
+            for key, value in (image.thumbnails or {}).items()
+        }
+        if thumbnails != (image.thumbnails or {}):
+            values["thumbnails"] = thumbnails
+        return values
+
+
+async def migrate(migration: Migration, batch_size: int) -> int:
+    """Проходит по записям пачками по id и возвращает число измененных"""
+    changed = 0
+    last_id = None
+    while True:
+        async with AsyncSessionLocal() as db:
+            query = select(Image).order_by(Image.id).limit(batch_size)
+            if last_id is not None:
+                query = query.where(Image.id > last_id)
+            images = (await db.execute(query)).scalars().all()
+            if not images:
+                break
+
+            for image in images:
+                # Файлы копируются в потоке, чтобы не держать event loop
+                values = await asyncio.to_thread(
+                    migration.migrate_image, image
+                )
+                if values:
+                    changed += 1
+                    await db.execute(
+                        update(Image)
+                        .where(Image.id == image.id)
+                        .values(**values)
+                    )
+            last_id = images[-1].id
+            if migration.dry_run:
+                await db.rollback()
+            else:
+                await db.commit()
+            logger.info(
+                f"Processed batch up to {last_id}: {changed} records changed"
+            )
+
+    if migration.delete_source and not migration.dry_run:
+        deleted = await asyncio.to_thread(migration.delete_sources)
+        logger.info(f"Deleted {deleted} source files")
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--source-root", default=settings.STORAGE_PATH,
+        help="Каталог, в котором лежат существующие файлы",
+    )
+    parser.add_argument(
+        "--target", choices=["local", "s3"], default=settings.STORAGE_BACKEND,
+        help="Целевое хранилище (по умолчанию STORAGE_BACKEND)",
+    )
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="Только показать, что будет перенесено",
+    )
+    parser.add_argument(
+        "--delete-source", action="store_true",
+        help="Удалить исходные файлы после переноса всех записей",
+    )
+    args = parser.parse_args()
+
+    source = LocalStorage(Path(args.source_root))
+    same_storage = args.target == "local" and \
+        Path(args.source_root) == Path(settings.STORAGE_PATH)
+    target = source if same_storage else create_storage(args.target)
+    migration = Migration(
+        source, target, same_storage, args.dry_run, args.delete_source
+    )
+
+    changed = asyncio.run(migrate(migration, args.batch_size))
+    logger.info(
+        f"Done: {changed} records changed, {migration.copied} files "
+        f"copied, {migration.missing} missing"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,78 @@
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import AsyncMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 from uuid import uuid4
+from datetime import datetime, timezone
+from pathlib import Path
+from PIL import Image
+import io
+import tempfile
+import time
 
+from app.core.config import settings
+from app.dependencies import get_image_events, get_outbox_relay
+from app.image_events import ImageEventListener
 from app.main import app
+from app.models import Image as ImageRecord
 
 client = TestClient(app)
 
 
+def make_image_bytes(size=(64, 48), image_format="JPEG"):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color=(100, 150, 200)).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def mock_relay():
+    relay = MagicMock()
+    app.dependency_overrides[get_outbox_relay] = lambda: relay
+    yield relay
+    app.dependency_overrides.pop(get_outbox_relay, None)
+
+
+@pytest.fixture
+def image_events():
+    events = ImageEventListener("postgresql://unused")
+    app.dependency_overrides[get_image_events] = lambda: events
+    yield events
+    app.dependency_overrides.pop(get_image_events, None)
+
+
 @pytest.mark.asyncio
-async def test_upload_image():
-    create_patch = 'app.api.v1.endpoints.images.create_image'
-    status_patch = 'app.api.v1.endpoints.images.update_image_status'
+async def test_upload_image(mock_relay):
+    create_patch = 'app.api.v1.endpoints.images.create_image_with_job'
     
     with patch(create_patch, new_callable=AsyncMock) as mock_create:
         # Создаем мок объекта изображения с UUID id
         mock_image = AsyncMock()
         mock_image.id = uuid4()
+        mock_image.status = "QUEUED"
         mock_create.return_value = mock_image
         
-        with patch(status_patch, new_callable=AsyncMock):
-            with patch('aio_pika.connect_robust', new_callable=AsyncMock):
-                with patch('app.api.v1.endpoints.images.uuid4') as mock_uuid:
-                    mock_uuid.return_value = uuid4()
-                    response = client.post(
-                        "/api/v1/images",
-                        files={
-                            "file": (
-                                "test.jpg",
-                                b"fake image data",
-                                "image/jpeg"
-                            )
-                        }
-                    )
-                    assert response.status_code == 200
-                    data = response.json()
-                    assert "task_id" in data
-                    assert data["status"] == "PROCESSING"
+        response = client.post(
+            "/api/v1/images",
+            files={
+                "file": (
+                    "test.jpg",
+                    make_image_bytes(),
+                    "image/jpeg"
+                )
+            }
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert "task_id" in data
+        assert data["status"] == "QUEUED"
+        mock_create.assert_awaited_once()
+        original = mock_create.await_args.args[1]
+        assert (original.width, original.height) == (64, 48)
+        mock_relay.notify.assert_called_once()
 
 
 @pytest.mark.asyncio
-async def test_get_image_not_found():
+async def test_get_image_not_found(image_events):
     image_id = str(uuid4())
     get_patch = 'app.api.v1.endpoints.images.get_image'
     with patch(get_patch, new_callable=AsyncMock) as mock_get:
@@ -49,6 +81,43 @@ async def test_get_image_not_found():
         assert response.status_code == 404
 
 
+@pytest.mark.asyncio
+async def test_get_image_waits_for_change(image_events):
+    """Изменение, пришедшее сразу после чтения записи, не теряется
+
+    Уведомление приходит между чтением и ожиданием: ответ отдается сразу,
+    а не по истечении wait.
+    """
+    image_id = uuid4()
+    now = datetime.now(timezone.utc)
+    processing, done = (
+        ImageRecord(
+            id=image_id, status=status, original_url="original/a.jpg",
+            thumbnails={}, created_at=now, updated_at=now,
+        )
+        for status in ("PROCESSING", "DONE")
+    )
+
+    async def read_then_notify(db, uuid_image_id):
+        if uuid_image_id in image_events._waiters and not reads:
+            image_events.dispatch(uuid_image_id, "DONE")
+        reads.append(uuid_image_id)
+        return processing if len(reads) == 1 else done
+
+    reads = []
+    get_patch = 'app.api.v1.endpoints.images.get_image'
+    with patch(get_patch, new_callable=AsyncMock) as mock_get:
+        mock_get.side_effect = read_then_notify
+        started = time.monotonic()
+        response = client.get(f"/api/v1/images/{image_id}?wait=5")
+
+    assert time.monotonic() - started < 5
+    assert response.status_code == 200
+    assert response.json()["status"] == "DONE"
+    assert reads == [image_id, image_id]
+    assert image_events._waiters == {}
+
+
 def test_root_endpoint():
     response = client.get("/")
     assert response.status_code == 200
@@ -69,3 +138,135 @@ async def test_health_endpoint():
     assert "status" in data
     assert "db" in data
     assert "rabbitmq" in data
+
+
+@pytest.mark.asyncio
+async def test_upload_image_too_large(mock_relay):
+    """Файл больше MAX_UPLOAD_SIZE отклоняется с 413 и не остается на диске"""
+    create_patch = 'app.api.v1.endpoints.images.create_image_with_job'
+    settings_patch = 'app.api.v1.endpoints.images.settings'
+
+    with tempfile.TemporaryDirectory() as storage, \
+            patch(create_patch, new_callable=AsyncMock) as mock_create, \
+            patch(settings_patch) as mock_settings:
+        mock_settings.STORAGE_PATH = storage
+        mock_settings.MAX_UPLOAD_SIZE = 10
+        mock_settings.UPLOAD_CHUNK_SIZE = 4
+
+        response = client.post(
+            "/api/v1/images",
+            files={"file": ("big.jpg", make_image_bytes(), "image/jpeg")}
+        )
+        assert response.status_code == 413
+        mock_create.assert_not_called()
+        assert list(Path(storage).rglob("*.jpg")) == []
+
+
+def test_request_body_too_large():
+    """Тело запроса больше MAX_REQUEST_SIZE отклоняется до разбора формы"""
+    response = client.post(
+        "/api/v1/images",
+        content=b"x" * 16,
+        headers={
+            "Content-Type": "multipart/form-data; boundary=x",
+            "Content-Length": str(settings.MAX_REQUEST_SIZE + 1),
+        }
+    )
+    assert response.status_code == 413
+
+
+@pytest.mark.asyncio
+async def test_upload_images_batch(mock_relay):
+    """Пакетная загрузка создает все записи одним вызовом CRUD"""
+    create_patch = 'app.api.v1.endpoints.images.create_images_with_jobs'
+
+    with patch(create_patch, new_callable=AsyncMock) as mock_create:
+        mock_images = []
+        for _ in range(3):
+            mock_image = MagicMock()
+            mock_image.id = uuid4()
+            mock_image.status = "QUEUED"
+            mock_images.append(mock_image)
+        mock_create.return_value = mock_images
+
+        response = client.post(
+            "/api/v1/images/batch",
+            files=[
+                ("files", (f"test{i}.jpg", make_image_bytes(), "image/jpeg"))
+                for i in range(3)
+            ]
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert [item["task_id"] for item in data] == [
+            str(image.id) for image in mock_images
+        ]
+        assert len(mock_create.await_args.args[1]) == 3
+        assert mock_create.await_args.kwargs["priority"] == "interactive"
+        mock_create.assert_awaited_once()
+        mock_relay.notify.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_upload_images_batch_bulk_priority(mock_relay):
+    """Бэкфилл загружается с priority=bulk; неизвестный приоритет - 422"""
+    create_patch = 'app.api.v1.endpoints.images.create_images_with_jobs'
+    files = [("files", ("a.jpg", make_image_bytes(), "image/jpeg"))]
+
+    with patch(create_patch, new_callable=AsyncMock) as mock_create:
+        mock_image = MagicMock()
+        mock_image.id = uuid4()
+        mock_image.status = "QUEUED"
+        mock_create.return_value = [mock_image]
+
+        response = client.post(
+            "/api/v1/images/batch?priority=bulk", files=files
+        )
+        assert response.status_code == 200
+        assert mock_create.await_args.kwargs["priority"] == "bulk"
+
+        response = client.post(
+            "/api/v1/images/batch?priority=urgent", files=files
+        )
+        assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_upload_images_batch_rejects_invalid_type(mock_relay):
+    """Один недопустимый файл отклоняет весь пакет до записи на диск"""
+    create_patch = 'app.api.v1.endpoints.images.create_images_with_jobs'
+
+    with patch(create_patch, new_callable=AsyncMock) as mock_create:
+        response = client.post(
+            "/api/v1/images/batch",
+            files=[
+                ("files", ("a.jpg", make_image_bytes(), "image/jpeg")),
+                ("files", ("b.txt", b"text", "text/plain")),
+            ]
+        )
+        assert response.status_code == 400
+        mock_create.assert_not_called()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("content, content_type, detail", [
+    (b"fake image data", "image/jpeg", "Only JPEG/PNG allowed"),
+    (make_image_bytes(image_format="PNG"), "image/jpeg", "does not match"),
+    (make_image_bytes()[:40], "image/jpeg", "Invalid or corrupt"),
+    (make_image_bytes(size=(2000, 10)), "image/jpeg", "exceed maximum"),
+])
+async def test_upload_image_rejected_by_header(
+    mock_relay, content, content_type, detail
+):
+    """Не-изображения и слишком большие картинки отклоняются до записи в БД"""
+    create_patch = 'app.api.v1.endpoints.images.create_image_with_job'
+
+    with patch(create_patch, new_callable=AsyncMock) as mock_create, \
+            patch.object(settings, "MAX_IMAGE_DIMENSION", 1000):
+        response = client.post(
+            "/api/v1/images",
+            files={"file": ("test.jpg", content, content_type)}
+        )
+        assert response.status_code == 400
+        assert detail in response.json()["detail"]
+        mock_create.assert_not_called()
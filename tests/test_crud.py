@@ -0,0 +1,181 @@
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock
+from uuid import uuid4
+from sqlalchemy.dialects import postgresql
+
+from app.crud import (
+    NewImage, add_thumbnails, claim_image, create_image_with_job, create_images_with_jobs,
+    release_image, requeue_stale_images, update_image_status,
+)
+
+
+def compiled(statement):
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+def make_db(row):
+    db = AsyncMock()
+    result = MagicMock()
+    result.scalar_one.return_value = row
+    result.scalar_one_or_none.return_value = row
+    db.execute.return_value = result
+    return db
+
+
+@pytest.mark.asyncio
+async def test_update_image_status_single_statement():
+    """Смена статуса - один UPDATE ... RETURNING и commit, без SELECT"""
+    image = MagicMock()
+    db = make_db(image)
+
+    result = await update_image_status(
+        db, uuid4(), "DONE", thumbnails={"100x100": "/t.jpg"}
+    )
+
+    assert result is image
+    assert db.execute.await_count == 1
+    sql = compiled(db.execute.await_args.args[0])
+    assert sql.startswith("UPDATE images SET")
+    assert "thumbnails" in sql
+    assert "RETURNING" in sql
+    db.commit.assert_awaited_once()
+    db.refresh.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_add_thumbnails_merges_into_stored_map():
+    """Миниатюры дописываются к сохраненным на стороне БД"""
+    db = make_db(MagicMock())
+
+    await add_thumbnails(
+        db, uuid4(), {"100x100": "/t.jpg"}, {"100x100": {"quality": 80}}
+    )
+
+    sql = compiled(db.execute.await_args.args[0])
+    assert "CAST(images.thumbnails AS JSONB)" in sql
+    assert "||" in sql
+    assert "images.status IN" in sql
+    db.commit.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_claim_image_is_conditional_update():
+    """Захват задачи - один условный UPDATE с арендой, без SELECT"""
+    db = make_db(None)
+
+    result = await claim_image(db, uuid4(), 300)
+
+    assert result is None
+    assert db.execute.await_count == 1
+    sql = compiled(db.execute.await_args.args[0])
+    assert sql.startswith("UPDATE images SET")
+    assert "lease_expires_at" in sql
+    assert "images.status IN" in sql
+    assert "RETURNING" in sql
+
+
+@pytest.mark.asyncio
+async def test_release_image_checks_lease():
+    """Неудачная попытка освобождает задачу только под своей арендой"""
+    db = make_db(None)
+
+    result = await release_image(
+        db, uuid4(), datetime.now(timezone.utc), "QUEUED", error="db"
+    )
+
+    assert result is None
+    sql = compiled(db.execute.await_args.args[0])
+    assert "images.status IN" in sql
+    assert "images.lease_expires_at =" in sql
+    db.commit.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_requeue_stale_images_writes_outbox_jobs():
+    """Зависшие записи возвращаются в QUEUED вместе с задачами в outbox"""
+    images = [make_image("QUEUED"), make_image("QUEUED")]
+    db = AsyncMock()
+    result = MagicMock()
+    result.scalars.return_value.all.return_value = images
+    db.execute.side_effect = [result, MagicMock()]
+
+    assert await requeue_stale_images(db, 100) == images
+
+    update_sql = compiled(db.execute.await_args_list[0].args[0])
+    assert update_sql.startswith("UPDATE images SET")
+    assert "FOR UPDATE SKIP LOCKED" in update_sql
+    jobs = db.execute.await_args_list[1].args[1]
+    assert [job["payload"]["image_id"] for job in jobs] == [
+        str(image.id) for image in images
+    ]
+    db.commit.assert_awaited_once()
+
+
+def make_insert_db(done_rows, inserted):
+    """Сессия для create_images_with_jobs: поиск дублей, INSERT, outbox"""
+    db = AsyncMock()
+    insert_result = MagicMock()
+    insert_result.scalars.return_value.all.return_value = inserted
+    db.execute.side_effect = [done_rows, insert_result, MagicMock()]
+    return db
+
+
+def make_image(status):
+    image = MagicMock()
+    image.id = uuid4()
+    image.status = status
+    return image
+
+
+@pytest.mark.asyncio
+async def test_create_image_with_job_single_commit():
+    """INSERT ... RETURNING изображения и запись outbox в одной транзакции"""
+    image = make_image("QUEUED")
+    db = make_insert_db([], [image])
+
+    result = await create_image_with_job(
+        db, NewImage("/storage/original/a.jpg", "a" * 64, 640, 480)
+    )
+
+    assert result is image
+    statements = [compiled(call.args[0]) for call in db.execute.await_args_list]
+    assert statements[0].startswith("SELECT")
+    assert statements[1].startswith("INSERT INTO images")
+    assert "RETURNING" in statements[1]
+    assert statements[2].startswith("INSERT INTO outbox")
+    db.commit.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_bulk_images_routed_to_bulk_queue():
+    image = make_image("QUEUED")
+    image.priority = "bulk"
+    db = make_insert_db([], [image])
+
+    await create_images_with_jobs(
+        db, [NewImage("/storage/original/c.jpg", "c" * 64)], priority="bulk"
+    )
+
+    rows = db.execute.await_args_list[1].args[1]
+    assert rows[0]["priority"] == "bulk"
+    jobs = db.execute.await_args_list[2].args[1]
+    assert jobs[0]["routing_key"] == "images.bulk"
+
+
+@pytest.mark.asyncio
+async def test_create_images_with_jobs_reuses_done_thumbnails():
+    """Содержимое, которое уже обработано, не создает задачу на обработку"""
+    thumbnails = {"100x100": "/storage/thumbs/100x100/x.jpg"}
+    image = make_image("DONE")
+    db = make_insert_db([("b" * 64, thumbnails, None)], [image])
+
+    await create_images_with_jobs(
+        db, [NewImage("/storage/original/b.jpg", "b" * 64)]
+    )
+
+    rows = db.execute.await_args_list[1].args[1]
+    assert rows[0]["status"] == "DONE"
+    assert rows[0]["thumbnails"] == thumbnails
+    assert db.execute.await_count == 2
+    db.commit.assert_awaited_once()
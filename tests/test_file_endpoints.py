@@ -3,13 +3,28 @@ from fastapi.testclient import TestClient
 from unittest.mock import AsyncMock, patch, MagicMock
 from uuid import uuid4
 import tempfile
+import io
 import os
 
+from PIL import Image
+
+from app.core.config import settings
+from app.dependencies import get_storage, get_thumbnail_cache
 from app.main import app
+from app.storage_backends import LocalStorage, thumbnail_storage_key
+from app.thumbnail_cache import ThumbnailCache
 
 client = TestClient(app)
 
 
+@pytest.fixture(autouse=True)
+def thumbnail_cache(tmp_path):
+    cache = ThumbnailCache(tmp_path / "cache", 10 * 1024 * 1024)
+    app.dependency_overrides[get_thumbnail_cache] = lambda: cache
+    yield cache
+    app.dependency_overrides.pop(get_thumbnail_cache, None)
+
+
 @pytest.mark.asyncio
 async def test_view_image_file_not_found():
     """Тест просмотра несуществующего изображения"""
@@ -200,6 +215,7 @@ async def test_download_image_file_success():
             assert response.status_code == 200
             assert (response.headers["content-type"] == 
                     "application/octet-stream")
+            assert response.headers["cache-control"] == "public, no-cache"
             
             # Тест скачивания оригинала
             response = client.get(
@@ -208,6 +224,8 @@ async def test_download_image_file_success():
             assert response.status_code == 200
             assert (response.headers["content-type"] == 
                     "application/octet-stream")
+            # Оригинал адресуется хешем содержимого и не меняется
+            assert "immutable" in response.headers["cache-control"]
             
     finally:
         if os.path.exists(tmp_path):
@@ -249,4 +267,318 @@ async def test_view_file_not_on_disk():
         
         response = client.get(f"/api/v1/images/{image_id}/file")
         assert response.status_code == 404
-        assert "File not found on disk" in response.json()["detail"]
\ No newline at end of file
+        assert "File not found on disk" in response.json()["detail"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("width", [150, 101])
+async def test_view_on_demand_size_from_nearest_rendition(tmp_path, width):
+    """Произвольный размер строится из ближайшей большей миниатюры
+
+    Ширина округляется вверх до THUMBNAIL_SIZE_STEP.
+    """
+    image_id = uuid4()
+    thumb_path = tmp_path / "thumb_300x300.jpg"
+    Image.new("RGB", (300, 200)).save(thumb_path, "JPEG")
+
+    mock_image = MagicMock()
+    mock_image.id = image_id
+    mock_image.status = "DONE"
+    mock_image.content_hash = "ab" * 32
+    mock_image.width, mock_image.height = 3000, 2000
+    mock_image.original_url = str(tmp_path / "missing_original.jpg")
+    mock_image.thumbnails = {
+        "300x300": str(thumb_path),
+        "1200x1200": str(tmp_path / "missing_1200.jpg"),
+    }
+
+    get_patch = 'app.api.v1.endpoints.images.get_image'
+    with patch(get_patch, new_callable=AsyncMock) as mock_get:
+        mock_get.return_value = mock_image
+        response = client.get(f"/api/v1/images/{image_id}/file?w={width}")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+    with Image.open(io.BytesIO(response.content)) as thumb:
+        assert thumb.size == (150, 100)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("query", [
+    "w=0", "w=100000", "w=1250", "w=100&fit=stretch", "w=100&fit=cover",
+    "w=100&size=100x100",
+])
+async def test_view_on_demand_invalid_params(query):
+    mock_image = MagicMock()
+    mock_image.status = "DONE"
+
+    get_patch = 'app.api.v1.endpoints.images.get_image'
+    # Рамки больше наибольшей сохраненной миниатюры отклоняются, даже если
+    # THUMBNAIL_MAX_DIMENSION их допускает
+    with patch(get_patch, new_callable=AsyncMock) as mock_get, \
+            patch.object(settings, "THUMBNAIL_MAX_DIMENSION", 2000):
+        mock_get.return_value = mock_image
+        response = client.get(f"/api/v1/images/{uuid4()}/file?{query}")
+
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("accept, content_type", [
+    ("image/avif,image/webp,*/*", "image/webp"),
+    ("image/webp;q=0.5,image/jpeg", "image/jpeg"),
+    ("*/*", "image/jpeg"),
+    (None, "image/jpeg"),
+])
+async def test_view_thumbnail_negotiates_encoding(
+    tmp_path, accept, content_type
+):
+    """Формат миниатюры выбирается по Accept среди сохраненных"""
+    jpeg_path = tmp_path / "thumb_100x100.jpg"
+    webp_path = tmp_path / "thumb_100x100.webp"
+    Image.new("RGB", (100, 75)).save(jpeg_path, "JPEG")
+    Image.new("RGB", (100, 75)).save(webp_path, "WEBP")
+
+    mock_image = MagicMock()
+    mock_image.status = "DONE"
+    mock_image.thumbnails = {
+        "100x100": str(jpeg_path),
+        "100x100.webp": str(webp_path),
+    }
+
+    headers = {"Accept": accept} if accept else {}
+    get_patch = 'app.api.v1.endpoints.images.get_image'
+    with patch(get_patch, new_callable=AsyncMock) as mock_get:
+        mock_get.return_value = mock_image
+        response = client.get(
+            f"/api/v1/images/{uuid4()}/file?size=100x100", headers=headers
+        )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == content_type
+    assert response.headers["vary"] == "Accept"
+
+
+@pytest.mark.asyncio
+async def test_view_partial_image_serves_ready_sizes(tmp_path):
+    """Готовые размеры отдаются до окончания обработки, остальные - 409"""
+    thumb_path = tmp_path / "thumb_100x100.jpg"
+    Image.new("RGB", (100, 75)).save(thumb_path, "JPEG")
+
+    mock_image = MagicMock()
+    mock_image.status = "PARTIAL"
+    mock_image.thumbnails = {"100x100": str(thumb_path)}
+
+    get_patch = 'app.api.v1.endpoints.images.get_image'
+    with patch(get_patch, new_callable=AsyncMock) as mock_get:
+        mock_get.return_value = mock_image
+        ready = client.get(f"/api/v1/images/{uuid4()}/file?size=100x100")
+        pending = client.get(
+            f"/api/v1/images/{uuid4()}/file?size=1200x1200"
+        )
+
+    assert ready.status_code == 200
+    assert pending.status_code == 409
+    assert "not ready" in pending.json()["detail"]
+
+
+@pytest.mark.asyncio
+async def test_view_thumbnail_conditional_get(tmp_path):
+    """Повторный запрос с ETag получает 304 без обращения к файлу"""
+    thumb_path = tmp_path / "thumb_100x100.jpg"
+    Image.new("RGB", (100, 75)).save(thumb_path, "JPEG")
+
+    mock_image = MagicMock()
+    mock_image.id = uuid4()
+    mock_image.status = "DONE"
+    mock_image.content_hash = "ab" * 32
+    mock_image.thumbnails = {"100x100": str(thumb_path)}
+    mock_image.thumbnail_meta = {"100x100": {"quality": 80, "bytes": 1}}
+
+    url = f"/api/v1/images/{mock_image.id}/file?size=100x100"
+    get_patch = 'app.api.v1.endpoints.images.get_image'
+    with patch(get_patch, new_callable=AsyncMock) as mock_get:
+        mock_get.return_value = mock_image
+        response = client.get(url)
+        etag = response.headers["etag"]
+        assert response.status_code == 200
+        # Миниатюра перезаписывается при повторной обработке
+        assert response.headers["cache-control"] == "public, no-cache"
+
+        thumb_path.unlink()
+        cached = client.get(url, headers={"If-None-Match": f"W/{etag}"})
+        assert cached.status_code == 304
+        assert cached.headers["etag"] == etag
+        assert cached.headers["vary"] == "Accept"
+
+        # WebP не сохранен, поэтому отдается тот же JPEG-вариант
+        webp = client.get(
+            url, headers={"If-None-Match": etag, "Accept": "image/webp"}
+        )
+        assert webp.status_code == 304
+
+        # Перекодированная миниатюра получает новый ETag
+        mock_image.thumbnail_meta = {"100x100": {"quality": 70, "bytes": 1}}
+        changed = client.get(url, headers={"If-None-Match": etag})
+        assert changed.status_code == 404
+
+
+@pytest.fixture
+def original_image(tmp_path):
+    data = bytes(range(256)) * 4
+    path = tmp_path / "original.jpg"
+    path.write_bytes(data)
+
+    mock_image = MagicMock()
+    mock_image.id = uuid4()
+    mock_image.status = "DONE"
+    mock_image.content_hash = "cd" * 32
+    mock_image.original_url = str(path)
+
+    get_patch = 'app.api.v1.endpoints.images.get_image'
+    with patch(get_patch, new_callable=AsyncMock) as mock_get:
+        mock_get.return_value = mock_image
+        yield f"/api/v1/images/{mock_image.id}/download", data
+
+
+@pytest.mark.asyncio
+async def test_download_single_range(original_image):
+    url, data = original_image
+    full = client.get(url)
+    assert full.headers["accept-ranges"] == "bytes"
+
+    response = client.get(url, headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 100-199/{len(data)}"
+    assert response.content == data[100:200]
+
+    # Файл изменился: If-Range не совпал, отдается целиком
+    response = client.get(
+        url, headers={"Range": "bytes=100-199", "If-Range": '"stale"'}
+    )
+    assert response.status_code == 200
+    assert response.content == data
+
+    response = client.get(
+        url,
+        headers={"Range": "bytes=-24", "If-Range": full.headers["etag"]},
+    )
+    assert response.status_code == 206
+    assert response.content == data[-24:]
+
+
+@pytest.mark.asyncio
+async def test_download_multiple_ranges(original_image):
+    url, data = original_image
+    response = client.get(url, headers={"Range": "bytes=0-9,500-509"})
+
+    assert response.status_code == 206
+    content_type = response.headers["content-type"]
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    boundary = content_type.split("boundary=")[1].encode()
+    assert int(response.headers["content-length"]) == len(response.content)
+
+    parts = response.content.split(b"--" + boundary)
+    assert parts[-1] == b"--\r\n"
+    bodies = [part.split(b"\r\n\r\n", 1)[1][:-2] for part in parts[1:-1]]
+    assert bodies == [data[0:10], data[500:510]]
+    assert f"Content-Range: bytes 500-509/{len(data)}".encode() in parts[2]
+
+
+@pytest.mark.asyncio
+async def test_download_range_not_satisfiable(original_image):
+    url, data = original_image
+    response = client.get(url, headers={"Range": f"bytes={len(data)}-"})
+
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(data)}"
+    assert "cache-control" not in response.headers
+
+
+@pytest.fixture
+def local_storage(tmp_path):
+    storage = LocalStorage(tmp_path / "storage")
+    app.dependency_overrides[get_storage] = lambda: storage
+    yield storage
+    app.dependency_overrides.pop(get_storage, None)
+
+
+@pytest.mark.asyncio
+async def test_view_thumbnail_without_database(local_storage):
+    """Готовая миниатюра отдается по id и размеру без запроса к БД"""
+    image_id = uuid4()
+    for extension, image_format in ((".jpg", "JPEG"), (".webp", "WEBP")):
+        buffer = io.BytesIO()
+        Image.new("RGB", (100, 75)).save(buffer, image_format)
+        local_storage.put_bytes(
+            thumbnail_storage_key(image_id, 100, 100, extension),
+            buffer.getvalue(),
+        )
+
+    url = f"/api/v1/images/{image_id}/thumbnails/100x100"
+    get_patch = 'app.api.v1.endpoints.images.get_image'
+    with patch(get_patch, new_callable=AsyncMock) as mock_get:
+        jpeg = client.get(url)
+        webp = client.get(url, headers={"Accept": "image/avif,image/webp"})
+        cached = client.get(
+            url, headers={"If-None-Match": jpeg.headers["etag"]}
+        )
+
+    mock_get.assert_not_awaited()
+    assert jpeg.status_code == 200
+    assert jpeg.headers["content-type"] == "image/jpeg"
+    assert webp.headers["content-type"] == "image/webp"
+    assert webp.headers["etag"] != jpeg.headers["etag"]
+    assert cached.status_code == 304
+    # Файл по этому URL меняется при повторной обработке
+    assert jpeg.headers["cache-control"] == "public, no-cache"
+
+
+@pytest.mark.asyncio
+async def test_view_thumbnail_falls_back_to_database(local_storage):
+    """При промахе по пути статус берется из БД: 409, 404 или файл"""
+    mock_image = MagicMock()
+    mock_image.status = "PARTIAL"
+    mock_image.thumbnails = {}
+
+    get_patch = 'app.api.v1.endpoints.images.get_image'
+    with patch(get_patch, new_callable=AsyncMock) as mock_get:
+        mock_get.return_value = mock_image
+        pending = client.get(f"/api/v1/images/{uuid4()}/thumbnails/300x300")
+        mock_get.return_value = None
+        missing = client.get(f"/api/v1/images/{uuid4()}/thumbnails/300x300")
+        invalid = client.get(f"/api/v1/images/{uuid4()}/thumbnails/50x50")
+
+    assert pending.status_code == 409
+    assert missing.status_code == 404
+    assert invalid.status_code == 400
+    assert mock_get.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_view_thumbnail_of_duplicate_reads_database(local_storage):
+    """Дубликат ссылается на миниатюры исходного изображения: быстрый
+    путь промахивается, и файл находится по записи из БД"""
+    source_id = uuid4()
+    key = thumbnail_storage_key(source_id, 100, 100, ".jpg")
+    buffer = io.BytesIO()
+    Image.new("RGB", (100, 75)).save(buffer, "JPEG")
+    local_storage.put_bytes(key, buffer.getvalue())
+
+    duplicate = MagicMock()
+    duplicate.id = uuid4()
+    duplicate.status = "DONE"
+    duplicate.content_hash = "cd" * 32
+    duplicate.thumbnails = {"100x100": key}
+    duplicate.thumbnail_meta = {}
+
+    get_patch = 'app.api.v1.endpoints.images.get_image'
+    with patch(get_patch, new_callable=AsyncMock) as mock_get:
+        mock_get.return_value = duplicate
+        response = client.get(
+            f"/api/v1/images/{duplicate.id}/thumbnails/100x100"
+        )
+
+    mock_get.assert_awaited_once()
+    assert response.status_code == 200
+    assert response.content == buffer.getvalue()
@@ -0,0 +1,81 @@
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from uuid import uuid4
+
+from app.crud import get_image, update_image_status
+from app.image_cache import ImageCache
+from app.models import Image
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_db(row):
+    db = AsyncMock()
+    result = MagicMock()
+    result.scalar_one_or_none.return_value = row
+    db.execute.return_value = result
+    return db
+
+
+def make_image(status):
+    return Image(id=uuid4(), status=status, original_url="original/a.jpg")
+
+
+def test_ttl_depends_on_status():
+    """Готовые записи живут done_ttl, обрабатываемые - active_ttl"""
+    clock = FakeClock()
+    cache = ImageCache(10, done_ttl=60, active_ttl=1, clock=clock)
+    done, processing = make_image("DONE"), make_image("PROCESSING")
+    cache.put(done)
+    cache.put(processing)
+
+    clock.now = 5
+    assert cache.get(done.id).status == "DONE"
+    assert cache.get(processing.id) is None
+    clock.now = 61
+    assert cache.get(done.id) is None
+    assert cache.stats() == {
+        "size": 0, "hits": 1, "misses": 2, "invalidations": 0
+    }
+
+
+def test_lru_eviction_and_invalidation():
+    cache = ImageCache(2, done_ttl=60, active_ttl=60)
+    images = [make_image("DONE") for _ in range(3)]
+    cache.put(images[0])
+    cache.put(images[1])
+    cache.get(images[0].id)
+    cache.put(images[2])
+
+    # Вытесняется давно не запрашивавшаяся запись
+    assert cache.get(images[1].id) is None
+    assert cache.get(images[0].id) is not None
+
+    cache.invalidate(images[0].id)
+    assert cache.get(images[0].id) is None
+    assert cache.invalidations == 1
+
+
+@pytest.mark.asyncio
+async def test_get_image_uses_cache_until_status_changes():
+    cache = ImageCache(10, done_ttl=60, active_ttl=60)
+    image = make_image("DONE")
+    db = make_db(image)
+
+    with patch('app.crud.image_cache', cache):
+        assert await get_image(db, image.id) is image
+        cached = await get_image(db, image.id)
+        assert db.execute.await_count == 1
+        # Из кеша отдается копия, не привязанная к сессии запроса
+        assert cached is not image
+        assert cached.original_url == image.original_url
+
+        await update_image_status(db, image.id, "ERROR")
+        await get_image(db, image.id)
+        assert db.execute.await_count == 3
@@ -0,0 +1,72 @@
+import asyncio
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from uuid import uuid4
+
+from app.image_events import (
+    ImageEventListener, asyncpg_dsn, wait_changed,
+)
+
+
+def test_asyncpg_dsn():
+    assert asyncpg_dsn("postgresql+asyncpg://u:p@db:5432/images") == (
+        "postgresql://u:p@db:5432/images"
+    )
+
+
+@pytest.mark.asyncio
+async def test_notification_fans_out_to_subscribers_and_waiters():
+    listener = ImageEventListener("postgresql://unused")
+    events = []
+    listener.subscribe(lambda image_id, status: events.append((image_id,
+                                                               status)))
+    image_id, other_id = uuid4(), uuid4()
+
+    with listener.watch(image_id) as changed, \
+            listener.watch(other_id) as other_changed:
+        payload = json.dumps({"id": str(image_id), "status": "DONE"})
+        listener._on_notification(None, 0, "image_events", payload)
+
+        assert await wait_changed(changed, 5) == "DONE"
+        assert await wait_changed(other_changed, 0.05) is None
+    assert events == [(image_id, "DONE")]
+    assert listener._waiters == {}
+
+
+def test_malformed_notification_is_ignored():
+    listener = ImageEventListener("postgresql://unused")
+    events = []
+    listener.subscribe(lambda image_id, status: events.append(image_id))
+
+    listener._on_notification(None, 0, "image_events", "not json")
+    listener._on_notification(None, 0, "image_events", '{"id": "x"}')
+
+    assert events == []
+    assert listener.events_total == 0
+
+
+@pytest.mark.asyncio
+async def test_unresponsive_connection_is_dropped():
+    """Соединение без ответа на проверку закрывается, а кеши сбрасываются"""
+    listener = ImageEventListener(
+        "postgresql://unused", liveness_interval=0.01, liveness_timeout=0.01
+    )
+    resets = []
+    listener.subscribe(lambda image_id, status: None,
+                       reset=lambda: resets.append(listener.connected))
+    connection = MagicMock()
+    connection.add_listener = AsyncMock()
+    connection.fetchval = AsyncMock(side_effect=[1, asyncio.TimeoutError()])
+    connection.is_closed.return_value = False
+
+    with patch("app.image_events.asyncpg.connect",
+               AsyncMock(return_value=connection)):
+        with pytest.raises(asyncio.TimeoutError):
+            await listener.listen_once()
+
+    assert connection.fetchval.await_count == 2
+    connection.terminate.assert_called_once()
+    assert not listener.connected
+    # Сброс после подписки и после разрыва
+    assert resets == [False, False]
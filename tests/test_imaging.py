@@ -0,0 +1,154 @@
+import io
+
+from PIL import Image, ImageDraw
+
+from app.imaging import (
+    THUMBNAIL_SIZES, QualityPolicy, encode_adaptive, fit_size,
+    nearest_rendition, psnr, quality_policy, render_fit, render_thumbnails,
+)
+
+
+def save_temp_image(directory, size, mode="RGB", image_format="JPEG"):
+    path = directory / f"original.{image_format.lower()}"
+    Image.new(mode, size, color=(120, 60, 30, 255)[:len(mode)]).save(
+        path, image_format
+    )
+    return str(path)
+
+
+def test_fit_size_preserves_aspect_and_never_upscales():
+    assert fit_size((6000, 4000), (1200, 1200)) == (1200, 800)
+    assert fit_size((4000, 6000), (300, 300)) == (200, 300)
+    assert fit_size((80, 50), (100, 100)) == (80, 50)
+
+
+def test_render_thumbnails_all_sizes_from_jpeg(tmp_path):
+    """Все размеры строятся за одно открытие и вписаны в свои рамки"""
+    path = save_temp_image(tmp_path, (3000, 2000))
+    thumbnails = render_thumbnails(path, THUMBNAIL_SIZES)
+
+    assert set(thumbnails) == set(THUMBNAIL_SIZES)
+    assert thumbnails[(1200, 1200)].size == (1200, 800)
+    assert thumbnails[(300, 300)].size == (300, 200)
+    assert thumbnails[(100, 100)].size == (100, 67)
+    assert all(thumb.mode == "RGB" for thumb in thumbnails.values())
+
+
+def test_render_thumbnails_converts_rgba_png(tmp_path):
+    """PNG с альфа-каналом приводится к RGB, чтобы его можно было сохранить в JPEG"""
+    path = save_temp_image(tmp_path, (500, 500), mode="RGBA",
+                           image_format="PNG")
+    thumbnails = render_thumbnails(path, [(100, 100), (1200, 1200)])
+
+    assert thumbnails[(1200, 1200)].size == (500, 500)
+    assert thumbnails[(100, 100)].size == (100, 100)
+    assert thumbnails[(100, 100)].mode == "RGB"
+
+
+def test_nearest_rendition_picks_smallest_sufficient():
+    """Берется наименьшая сохраненная миниатюра не меньше нужного размера"""
+    size = (3000, 2000)
+    stored = THUMBNAIL_SIZES
+    assert nearest_rendition(size, stored, (64, 64)) == (100, 100)
+    assert nearest_rendition(size, stored, (640, 640)) == (1200, 1200)
+    # cover 300x300 требует 450x300, а миниатюра 300x300 - только 300x200
+    assert nearest_rendition(
+        size, THUMBNAIL_SIZES, (300, 300), "cover"
+    ) == (1200, 1200)
+    assert nearest_rendition(size, THUMBNAIL_SIZES, (1600, 1600)) is None
+
+
+def test_render_fit_contain_and_cover(tmp_path):
+    path = save_temp_image(tmp_path, (1200, 800))
+
+    assert render_fit(path, (640, 640)).size == (640, 427)
+    assert render_fit(path, (64, 64), "cover").size == (64, 64)
+    # Увеличение не выполняется
+    assert render_fit(path, (2000, 2000)).size == (1200, 800)
+
+
+def make_gradient_image(size=(400, 300)):
+    image = Image.linear_gradient("L").resize(size).convert("RGB")
+    ImageDraw.Draw(image).ellipse((50, 50, 250, 200), fill=(200, 80, 40))
+    return image
+
+
+def encode_jpeg(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def test_encode_adaptive_meets_psnr_target_with_lowest_quality():
+    image = make_gradient_image()
+    policy = QualityPolicy(
+        min_psnr=38.0, min_quality=20, max_quality=95, max_steps=8
+    )
+
+    encoded = encode_adaptive(image, "jpeg", policy)
+
+    assert 20 < encoded.quality < 95
+    assert psnr(image, encoded.data) >= 38.0
+    # Качеством ниже цель уже не достигается
+    assert psnr(image, encode_jpeg(image, encoded.quality - 1)) < 38.0
+
+
+def test_encode_adaptive_byte_budget_wins_over_psnr():
+    image = make_gradient_image()
+    unbounded = encode_adaptive(image, "jpeg", QualityPolicy(min_psnr=60.0))
+    budget = len(unbounded.data) // 2
+
+    encoded = encode_adaptive(
+        image, "jpeg",
+        QualityPolicy(max_bytes=budget, min_psnr=60.0, max_steps=8),
+    )
+
+    assert len(encoded.data) <= budget
+    assert len(encode_jpeg(image, encoded.quality + 1)) > budget
+
+
+def test_encode_adaptive_search_is_bounded_and_optimizes_once(monkeypatch):
+    """Поиск делает не больше max_steps кодирований без optimize;
+    с optimize кодируется только выбранное качество"""
+    image = make_gradient_image()
+    saves = []
+    original_save = Image.Image.save
+
+    def counting_save(self, fp, format=None, **params):
+        saves.append(params)
+        return original_save(self, fp, format, **params)
+
+    monkeypatch.setattr(Image.Image, "save", counting_save)
+    policy = QualityPolicy(min_psnr=38.0, min_quality=20, max_quality=95)
+    encoded = encode_adaptive(image, "jpeg", policy)
+
+    search, final = saves[:-1], saves[-1]
+    # Проверка верхней границы и max_steps шагов бинарного поиска
+    assert len(search) <= policy.max_steps + 1
+    assert not any(params["optimize"] for params in search)
+    assert final == {"quality": encoded.quality, "optimize": True}
+    assert psnr(image, encoded.data) >= 38.0
+
+
+def test_encode_adaptive_unreachable_psnr_encodes_ceiling_once(monkeypatch):
+    image = make_gradient_image()
+    saves = []
+    original_save = Image.Image.save
+
+    def counting_save(self, fp, format=None, **params):
+        saves.append(params["quality"])
+        return original_save(self, fp, format, **params)
+
+    monkeypatch.setattr(Image.Image, "save", counting_save)
+    encoded = encode_adaptive(image, "jpeg", QualityPolicy(min_psnr=99.0))
+
+    assert encoded.quality == 90
+    assert saves == [90, 90]
+
+
+def test_quality_policies_differ_per_encoding():
+    box = (1200, 1200)
+    jpeg, avif = quality_policy("jpeg", box), quality_policy("avif", box)
+    assert avif.max_bytes < jpeg.max_bytes
+    assert avif.max_quality < jpeg.max_quality
+    assert quality_policy("jpeg", (640, 480)) == QualityPolicy()
@@ -10,6 +10,13 @@ from app.main import app
 client = TestClient(app)
 
 
+@pytest.fixture(scope="module", autouse=True)
+def app_lifespan():
+    """Запускает lifespan приложения (соединение с RabbitMQ) на время модуля"""
+    with client:
+        yield
+
+
 @pytest.mark.integration
 def test_full_image_processing_workflow():
     """
@@ -29,7 +36,7 @@ def test_full_image_processing_workflow():
     assert response.status_code == 200
     data = response.json()
     task_id = data['task_id']
-    assert data['status'] == 'PROCESSING'
+    assert data['status'] == 'QUEUED'
     
     # 2. Ожидаем обработки (максимум 30 секунд)
     max_attempts = 30
@@ -0,0 +1,89 @@
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+from app.outbox import OutboxRelay
+
+
+def make_session_factory(messages):
+    """Фабрика сессий, чей SELECT возвращает переданные сообщения"""
+    db = AsyncMock()
+    result = MagicMock()
+    result.scalars.return_value.all.return_value = messages
+    db.execute.return_value = result
+
+    factory = MagicMock()
+    factory.return_value.__aenter__.return_value = db
+    return factory, db
+
+
+def make_message(message_id):
+    message = MagicMock()
+    message.id = message_id
+    message.routing_key = "images"
+    message.payload = {"image_id": str(message_id)}
+    return message
+
+
+@pytest.mark.asyncio
+async def test_drain_once_publishes_and_deletes_batch():
+    """Пачка отправляется одним вызовом и удаляется после подтверждения"""
+    messages = [make_message(1), make_message(2)]
+    factory, db = make_session_factory(messages)
+    publisher = AsyncMock()
+
+    relay = OutboxRelay(factory, publisher, batch_size=10)
+    assert await relay.drain_once() == 2
+
+    published = list(publisher.publish_batch.await_args.args[0])
+    assert published == [
+        ("images", {"image_id": "1"}),
+        ("images", {"image_id": "2"}),
+    ]
+    assert db.execute.await_count == 2
+    db.commit.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_drain_once_keeps_messages_when_broker_fails():
+    """Если брокер не подтвердил пачку, строки outbox не удаляются"""
+    factory, db = make_session_factory([make_message(1)])
+    publisher = AsyncMock()
+    publisher.publish_batch.side_effect = ConnectionError("broker down")
+
+    relay = OutboxRelay(factory, publisher, batch_size=10)
+    with pytest.raises(ConnectionError):
+        await relay.drain_once()
+
+    assert db.execute.await_count == 1
+    db.commit.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_drain_once_empty_outbox():
+    factory, db = make_session_factory([])
+    publisher = AsyncMock()
+
+    relay = OutboxRelay(factory, publisher)
+    assert await relay.drain_once() == 0
+    publisher.publish_batch.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_connect_retries_until_broker_is_up():
+    """Недоступный брокер не мешает старту: релей подключается сам"""
+    publisher = MagicMock()
+    publisher.started = False
+
+    async def start():
+        if publisher.start.await_count < 3:
+            raise ConnectionError("broker down")
+        publisher.started = True
+
+    publisher.start = AsyncMock(side_effect=start)
+    relay = OutboxRelay(
+        MagicMock(), publisher, poll_interval=0.001, max_connect_delay=0.002
+    )
+    await relay.connect()
+
+    assert publisher.start.await_count == 3
+    assert publisher.started
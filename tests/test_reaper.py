@@ -0,0 +1,69 @@
+import os
+import time
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from uuid import uuid4
+
+from app.reaper import StaleJobReaper
+
+
+def make_factory():
+    factory = MagicMock()
+    factory.return_value.__aenter__.return_value = AsyncMock()
+    return factory
+
+
+@pytest.mark.asyncio
+async def test_sweep_requeues_in_batches_and_counts():
+    """Пачки забираются, пока не придет неполная; счетчики обновляются"""
+    relay = MagicMock()
+    reaper = StaleJobReaper(make_factory(), relay, batch_size=2)
+    batches = [[MagicMock(), MagicMock()], [MagicMock()]]
+
+    with patch('app.reaper.requeue_stale_images',
+               new_callable=AsyncMock) as mock_requeue:
+        mock_requeue.side_effect = batches
+        assert await reaper.sweep() == 3
+
+    assert mock_requeue.await_count == 2
+    assert reaper.recovered_total == 3
+    assert reaper.last_recovered == 3
+    assert relay.notify.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_sweep_without_stale_jobs_does_not_wake_relay():
+    relay = MagicMock()
+    reaper = StaleJobReaper(make_factory(), relay, batch_size=2)
+
+    with patch('app.reaper.requeue_stale_images',
+               new_callable=AsyncMock, return_value=[]):
+        assert await reaper.sweep() == 0
+
+    relay.notify.assert_not_called()
+    assert reaper.recovered_total == 0
+
+
+@pytest.mark.asyncio
+async def test_expire_uploads_skips_recently_written(tmp_path):
+    """Старая сессия, в которую недавно писали, не удаляется"""
+    reaper = StaleJobReaper(
+        make_factory(), MagicMock(), batch_size=10,
+        upload_dir=tmp_path, upload_ttl=60,
+    )
+    stale, active = uuid4(), uuid4()
+    for upload_id in (stale, active):
+        (tmp_path / f"{upload_id}.part").write_bytes(b"x")
+    old = time.time() - 120
+    os.utime(tmp_path / f"{stale}.part", (old, old))
+
+    with patch('app.reaper.find_old_upload_sessions',
+               new_callable=AsyncMock, return_value=[stale, active]), \
+            patch('app.reaper.delete_upload_sessions',
+                  new_callable=AsyncMock) as mock_delete:
+        assert await reaper.expire_uploads() == 1
+
+    assert mock_delete.await_args.args[1] == [stale]
+    assert not (tmp_path / f"{stale}.part").exists()
+    assert (tmp_path / f"{active}.part").exists()
+    assert reaper.expired_uploads_total == 1
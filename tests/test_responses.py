@@ -0,0 +1,42 @@
+import pytest
+
+from app.responses import RangeNotSatisfiable, if_range_matches, parse_range
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-9", [(0, 9)]),
+    ("bytes=90-", [(90, 99)]),
+    ("bytes=-10", [(90, 99)]),
+    ("bytes=-500", [(0, 99)]),
+    ("bytes=95-200", [(95, 99)]),
+    # Пересекающиеся и смежные диапазоны объединяются
+    ("bytes=20-29, 0-9, 5-14, 15-16", [(0, 16), (20, 29)]),
+    # Диапазоны за концом файла пропускаются
+    ("bytes=0-0,500-600", [(0, 0)]),
+    # Некорректный заголовок игнорируется: отдается весь файл
+    ("items=0-9", None),
+    ("bytes=9-0", None),
+    ("bytes=a-b", None),
+    ("bytes=" + ",".join(["0-1"] * 17), None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=100-", "bytes=-0", "bytes=200-300"])
+def test_parse_range_not_satisfiable(header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, 100)
+
+
+def test_if_range_matches():
+    etag = '"abc"'
+    modified = "Wed, 21 Oct 2026 07:28:00 GMT"
+    assert if_range_matches('"abc"', etag, modified)
+    assert not if_range_matches('"other"', etag, modified)
+    # Слабый ETag не подходит для If-Range
+    assert not if_range_matches('W/"abc"', etag, modified)
+    assert if_range_matches(modified, etag, modified)
+    assert not if_range_matches("Thu, 22 Oct 2026 07:28:00 GMT", etag,
+                                modified)
+    assert not if_range_matches("garbage", etag, modified)
@@ -0,0 +1,47 @@
+import pytest
+from io import BytesIO
+from pathlib import Path
+import hashlib
+import tempfile
+
+from fastapi import UploadFile
+
+from app.storage import UploadTooLargeError, store_content_addressed
+from app.storage_backends import LocalStorage, original_key
+
+
+@pytest.mark.asyncio
+async def test_store_content_addressed_deduplicates():
+    """Одинаковое содержимое сохраняется в один файл по его хешу"""
+    data = b"same image bytes"
+    expected_hash = hashlib.sha256(data).hexdigest()
+
+    with tempfile.TemporaryDirectory() as storage:
+        root = Path(storage)
+        backend = LocalStorage(root)
+        keys = []
+        for _ in range(2):
+            key, content_hash = await store_content_addressed(
+                UploadFile(BytesIO(data)), root / ".tmp", backend, ".jpg",
+                max_size=1024, chunk_size=4,
+            )
+            assert content_hash == expected_hash
+            keys.append(key)
+
+        assert keys[0] == keys[1]
+        assert keys[0] == original_key(expected_hash, ".jpg")
+        assert (root / keys[0]).read_bytes() == data
+        assert list((root / ".tmp").iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_store_content_addressed_too_large():
+    with tempfile.TemporaryDirectory() as storage:
+        root = Path(storage)
+        with pytest.raises(UploadTooLargeError):
+            await store_content_addressed(
+                UploadFile(BytesIO(b"x" * 64)), root / ".tmp",
+                LocalStorage(root), ".jpg",
+                max_size=10, chunk_size=4,
+            )
+        assert list((root / ".tmp").iterdir()) == []
@@ -0,0 +1,117 @@
+import pytest
+from unittest.mock import MagicMock
+
+from app.storage_backends import (
+    LocalStorage, S3Storage, original_key, thumbnail_storage_key
+)
+
+
+def test_storage_keys_are_sharded():
+    image_id = "3f2a9c1e-0000-4000-8000-000000000000"
+    assert thumbnail_storage_key(image_id, 100, 100, ".jpg") == (
+        f"thumbs/100x100/3f/2a/{image_id}_100x100.jpg"
+    )
+    assert original_key("abcdef", ".png") == "original/ab/cd/abcdef.png"
+
+
+def test_local_storage_put_and_read(tmp_path):
+    storage = LocalStorage(tmp_path)
+    storage.put_bytes("thumbs/1x1/ab/cd/a.jpg", b"data")
+
+    assert storage.exists("thumbs/1x1/ab/cd/a.jpg")
+    assert storage.local_path("thumbs/1x1/ab/cd/a.jpg").read_bytes() == b"data"
+    with storage.local_copy("thumbs/1x1/ab/cd/a.jpg") as path:
+        assert path.read_bytes() == b"data"
+    # Временные файлы не остаются рядом с результатом
+    assert [p.name for p in (tmp_path / "thumbs/1x1/ab/cd").iterdir()] == [
+        "a.jpg"
+    ]
+    assert storage.url("thumbs/1x1/ab/cd/a.jpg", "a.jpg") is None
+
+
+def test_local_storage_recreates_removed_directory(tmp_path):
+    """Каталог из кеша созданных, удаленный извне, создается заново"""
+    storage = LocalStorage(tmp_path)
+    storage.put_bytes("a/b/one", b"1")
+    (tmp_path / "a/b/one").unlink()
+    (tmp_path / "a/b").rmdir()
+
+    storage.put_bytes("a/b/two", b"2")
+    source = tmp_path / "source"
+    source.write_bytes(b"3")
+    (tmp_path / "a/b/two").unlink()
+    (tmp_path / "a/b").rmdir()
+    storage.put_file("a/b/three", source)
+
+    assert (tmp_path / "a/b/three").read_bytes() == b"3"
+    assert not source.exists()
+
+
+def test_local_storage_reads_legacy_absolute_paths(tmp_path):
+    legacy = tmp_path / "legacy.jpg"
+    legacy.write_bytes(b"old")
+    storage = LocalStorage(tmp_path / "storage")
+
+    assert storage.exists(str(legacy))
+    assert storage.local_path(str(legacy)) == legacy
+
+
+def test_local_storage_missing_file(tmp_path):
+    storage = LocalStorage(tmp_path)
+    assert not storage.exists("missing.jpg")
+    with pytest.raises(FileNotFoundError):
+        with storage.local_copy("missing.jpg"):
+            pass
+
+
+class FakeClientError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+@pytest.fixture
+def s3_client():
+    client = MagicMock()
+    client.exceptions.ClientError = FakeClientError
+    return client
+
+
+def test_s3_storage_upload_and_presign(tmp_path, s3_client):
+    storage = S3Storage("images", presign_expires=60, client=s3_client)
+    source = tmp_path / "upload"
+    source.write_bytes(b"data")
+
+    storage.put_file("/original/ab/cd/abcd.jpg", source)
+    s3_client.upload_file.assert_called_once_with(
+        str(source), "images", "original/ab/cd/abcd.jpg",
+        ExtraArgs={"ContentType": "image/jpeg"},
+    )
+    assert not source.exists()
+    assert storage.local_path("original/ab/cd/abcd.jpg") is None
+
+    storage.url("original/ab/cd/abcd.jpg", "abcd.jpg", attachment=True)
+    s3_client.generate_presigned_url.assert_called_once_with(
+        "get_object",
+        Params={
+            "Bucket": "images",
+            "Key": "original/ab/cd/abcd.jpg",
+            "ResponseContentDisposition": "attachment; filename=abcd.jpg",
+        },
+        ExpiresIn=60,
+    )
+
+
+def test_s3_storage_missing_object(s3_client):
+    storage = S3Storage("images", client=s3_client)
+    s3_client.head_object.side_effect = FakeClientError("404")
+    s3_client.download_file.side_effect = FakeClientError("404")
+
+    assert not storage.exists("missing.jpg")
+    with pytest.raises(FileNotFoundError):
+        with storage.local_copy("missing.jpg"):
+            pass
+
+    s3_client.head_object.side_effect = FakeClientError("403")
+    with pytest.raises(FakeClientError):
+        storage.exists("forbidden.jpg")
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import threading
+
+import pytest
+from PIL import Image
+
+from app.thumbnail_cache import ThumbnailCache
+
+
+def make_render(calls, size=(32, 32)):
+    def render():
+        calls.append(threading.get_ident())
+        return Image.new("RGB", size, color=(10, 20, 30))
+    return render
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_render_once(tmp_path):
+    """Одновременные запросы одной миниатюры ждут одной отрисовки"""
+    cache = ThumbnailCache(tmp_path, max_bytes=10 * 1024 * 1024)
+    calls = []
+    render = make_render(calls)
+
+    paths = await asyncio.gather(
+        *(cache.get_or_render("abc_64x64_contain", render) for _ in range(5))
+    )
+
+    assert len(calls) == 1
+    assert len(set(paths)) == 1
+    assert paths[0].exists()
+
+    # Повторный запрос берется из кеша
+    await cache.get_or_render("abc_64x64_contain", render)
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_evicted(tmp_path):
+    cache = ThumbnailCache(tmp_path, max_bytes=1)
+    calls = []
+    render = make_render(calls)
+
+    first = await cache.get_or_render("aaa", render)
+    second = await cache.get_or_render("bbb", render)
+
+    assert not first.exists()
+    assert second.exists()
+
+
+@pytest.mark.asyncio
+async def test_eviction_counts_files_of_other_replicas(tmp_path):
+    """Лимит действует на весь общий каталог, а не на записи процесса"""
+    other = tmp_path / "aa" / "aaa.jpg"
+    other.parent.mkdir()
+    other.write_bytes(b"x" * 2048)
+    os.utime(other, (1, 1))
+    cache = ThumbnailCache(tmp_path, max_bytes=2048)
+
+    path = await cache.get_or_render("bbb", make_render([]))
+
+    assert not other.exists()
+    assert path.exists()
+
+
+def test_load_restores_entries(tmp_path):
+    cache = ThumbnailCache(tmp_path, max_bytes=10 * 1024 * 1024)
+    path = cache.path_for("abc")
+    path.parent.mkdir(parents=True)
+    Image.new("RGB", (8, 8)).save(path, "JPEG")
+
+    restored = ThumbnailCache(tmp_path, max_bytes=10 * 1024 * 1024)
+    restored.load()
+
+    assert list(restored._entries) == [path.name]
+    assert restored._total == path.stat().st_size
@@ -0,0 +1,176 @@
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import AsyncMock, MagicMock, patch
+from uuid import uuid4
+from PIL import Image
+import hashlib
+import io
+import tempfile
+
+from app.dependencies import get_db, get_outbox_relay, get_storage
+from app.main import app
+from app.storage_backends import LocalStorage
+
+client = TestClient(app)
+
+
+class FakeSession:
+    """Минимальная замена AsyncSession для сессий загрузки"""
+
+    def __init__(self):
+        self.sessions = {}
+
+    def add(self, obj):
+        obj.id = uuid4()
+        self.sessions[obj.id] = obj
+
+    async def get(self, model, key):
+        return self.sessions.get(key)
+
+    async def delete(self, obj):
+        self.sessions.pop(obj.id, None)
+
+    async def execute(self, statement):
+        return MagicMock()
+
+    async def commit(self):
+        pass
+
+
+@pytest.fixture
+def storage():
+    db = FakeSession()
+    relay = MagicMock()
+    app.dependency_overrides[get_db] = lambda: db
+    app.dependency_overrides[get_outbox_relay] = lambda: relay
+    with tempfile.TemporaryDirectory() as storage_path, \
+            patch('app.api.v1.endpoints.uploads.settings') as mock_settings:
+        mock_settings.STORAGE_PATH = storage_path
+        backend = LocalStorage(storage_path)
+        app.dependency_overrides[get_storage] = lambda: backend
+        mock_settings.MAX_RESUMABLE_UPLOAD_SIZE = 1024
+        mock_settings.UPLOAD_CHUNK_SIZE = 4
+        yield relay
+    app.dependency_overrides.clear()
+
+
+def put_chunk(upload_id, data, start, total):
+    end = start + len(data) - 1
+    return client.put(
+        f"/api/v1/uploads/{upload_id}",
+        content=data,
+        headers={"Content-Range": f"bytes {start}-{end}/{total}"}
+    )
+
+
+def test_resumable_upload_flow(storage):
+    """Загрузка блоками с продолжением после обрыва и завершением"""
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 24), color=(10, 20, 30)).save(buffer, "PNG")
+    data = buffer.getvalue()
+    split = len(data) // 2
+    response = client.post(
+        "/api/v1/uploads",
+        json={"filename": "scan.png", "content_type": "image/png",
+              "size": len(data)}
+    )
+    assert response.status_code == 200
+    upload_id = response.json()["upload_id"]
+    assert response.json()["offset"] == 0
+
+    response = put_chunk(upload_id, data[:split], 0, len(data))
+    assert response.json()["offset"] == split
+
+    # Повторная отправка уже принятого блока отклоняется с текущим смещением
+    response = put_chunk(upload_id, data[:split], 0, len(data))
+    assert response.status_code == 409
+    assert response.headers["Upload-Offset"] == str(split)
+
+    response = client.get(f"/api/v1/uploads/{upload_id}")
+    assert response.headers["Upload-Offset"] == str(split)
+
+    # Завершить незаконченную загрузку нельзя
+    response = client.post(f"/api/v1/uploads/{upload_id}/complete")
+    assert response.status_code == 409
+
+    response = put_chunk(upload_id, data[split:], split, len(data))
+    assert response.json()["offset"] == len(data)
+
+    create_patch = 'app.api.v1.endpoints.uploads.create_image_with_job'
+    with patch(create_patch, new_callable=AsyncMock) as mock_create:
+        mock_image = MagicMock()
+        mock_image.id = uuid4()
+        mock_image.status = "QUEUED"
+        mock_create.return_value = mock_image
+
+        response = client.post(f"/api/v1/uploads/{upload_id}/complete")
+        assert response.status_code == 200
+        assert response.json()["task_id"] == str(mock_image.id)
+
+        original = mock_create.await_args.args[1]
+        assert original.content_hash == hashlib.sha256(data).hexdigest()
+        assert original.original_url.endswith(f"{original.content_hash}.png")
+        assert (original.width, original.height) == (32, 24)
+        backend = app.dependency_overrides[get_storage]()
+        assert backend.local_path(original.original_url).read_bytes() == data
+    storage.notify.assert_called_once()
+
+
+def test_chunk_larger_than_range_rejected(storage):
+    response = client.post(
+        "/api/v1/uploads",
+        json={"content_type": "image/jpeg", "size": 8}
+    )
+    upload_id = response.json()["upload_id"]
+
+    response = client.put(
+        f"/api/v1/uploads/{upload_id}",
+        content=b"x" * 8,
+        headers={"Content-Range": "bytes 0-3/8"}
+    )
+    assert response.status_code == 400
+
+
+def test_create_upload_too_large(storage):
+    response = client.post(
+        "/api/v1/uploads",
+        json={"content_type": "image/jpeg", "size": 4096}
+    )
+    assert response.status_code == 413
+
+
+def test_complete_restores_part_when_commit_fails(storage):
+    """Если запись не сохранилась, байты остаются доступны для повтора"""
+    buffer = io.BytesIO()
+    Image.new("RGB", (8, 8)).save(buffer, "PNG")
+    data = buffer.getvalue()
+    response = client.post(
+        "/api/v1/uploads",
+        json={"content_type": "image/png", "size": len(data)}
+    )
+    upload_id = response.json()["upload_id"]
+    put_chunk(upload_id, data, 0, len(data))
+
+    create_patch = 'app.api.v1.endpoints.uploads.create_image_with_job'
+    with patch(create_patch, new_callable=AsyncMock) as mock_create:
+        mock_create.side_effect = RuntimeError("commit failed")
+        with pytest.raises(RuntimeError):
+            client.post(f"/api/v1/uploads/{upload_id}/complete")
+
+    response = client.get(f"/api/v1/uploads/{upload_id}")
+    assert response.json()["offset"] == len(data)
+
+
+def test_first_chunk_that_is_not_an_image_rejected(storage):
+    """Не-изображение отклоняется по первому блоку, загрузка удаляется"""
+    response = client.post(
+        "/api/v1/uploads",
+        json={"content_type": "image/png", "size": 64}
+    )
+    upload_id = response.json()["upload_id"]
+
+    response = put_chunk(upload_id, b"not an image at all", 0, 64)
+    assert response.status_code == 400
+
+    response = client.get(f"/api/v1/uploads/{upload_id}")
+    assert response.status_code == 404
@@ -0,0 +1,452 @@
+import pytest
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import signal
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
+from uuid import uuid4
+from PIL import Image
+
+from app.broker import (
+    ATTEMPT_HEADER, BULK_QUEUE, DEAD_LETTER_QUEUE, declare_topology,
+    retry_delay,
+    retry_queue_name,
+)
+from app.workers import image_processor
+from app.workers.budget import PixelBudget
+from app.storage_backends import LocalStorage
+from app.workers.thumbnails import build_thumbnails
+
+
+@pytest.fixture
+def original(tmp_path):
+    path = tmp_path / "original.jpg"
+    Image.new("RGB", (1600, 1200), color=(200, 100, 50)).save(path)
+    return str(path)
+
+
+@pytest.fixture
+def storage(tmp_path):
+    backend = LocalStorage(tmp_path / "storage")
+    with patch('app.workers.thumbnails.default_storage',
+               return_value=backend):
+        yield backend
+
+
+@pytest.mark.asyncio
+async def test_process_image_publishes_sizes_incrementally(
+    storage, original
+):
+    """Размеры строятся одной задачей в executor и сохраняются по готовности"""
+    image_id = str(uuid4())
+    claim_patch = 'app.workers.image_processor.claim_image'
+    add_patch = 'app.workers.image_processor.add_thumbnails'
+
+    with patch(claim_patch, new_callable=AsyncMock) as mock_claim, \
+            patch(add_patch, new_callable=AsyncMock) as mock_add, \
+            ThreadPoolExecutor(max_workers=1) as executor:
+        mock_claim.return_value = MagicMock()
+        await image_processor.process_image(
+            image_id, original, AsyncMock(), executor
+        )
+
+    mock_claim.assert_awaited_once()
+    calls = mock_add.await_args_list
+    # Размеры публикуются по порядку, от меньшего
+    assert [list(call.args[2]) for call in calls] == [
+        ["100x100"], ["300x300"], ["1200x1200"]
+    ]
+    assert [call.args[4] for call in calls] == ["PARTIAL", "PARTIAL", "DONE"]
+    thumbnails, meta = calls[1].args[2], calls[1].args[3]
+    # Миниатюры разложены по префиксу UUID
+    assert thumbnails["300x300"] == (
+        f"thumbs/300x300/{image_id[:2]}/{image_id[2:4]}/"
+        f"{image_id}_300x300.jpg"
+    )
+    path = storage.path(thumbnails["300x300"])
+    assert meta["300x300"]["bytes"] == os.path.getsize(path)
+    with Image.open(path) as thumb:
+        assert thumb.size == (300, 225)
+
+
+@pytest.mark.asyncio
+async def test_process_image_stops_when_claim_lost(storage, original):
+    claim_patch = 'app.workers.image_processor.claim_image'
+    add_patch = 'app.workers.image_processor.add_thumbnails'
+
+    with patch(claim_patch, new_callable=AsyncMock) as mock_claim, \
+            patch(add_patch, new_callable=AsyncMock) as mock_add, \
+            ThreadPoolExecutor(max_workers=1) as executor:
+        mock_claim.return_value = MagicMock()
+        mock_add.return_value = None
+        await image_processor.process_image(
+            str(uuid4()), original, AsyncMock(), executor
+        )
+
+    mock_add.assert_awaited_once()
+
+
+def test_build_thumbnails_extra_encodings(storage, original):
+    """Дополнительные форматы сохраняются под ключами WxH.<формат>"""
+    progress = queue.Queue()
+    renditions = build_thumbnails(
+        "img", original, [(300, 300), (100, 100)],
+        extra_encodings=["webp", "avif"], progress=progress,
+    )
+
+    # Размеры приходят от меньшего к большему, в конце - None
+    assert [progress.get_nowait() for _ in range(3)] == renditions + [None]
+    rendition = renditions[1]
+
+    assert set(rendition.paths) == {
+        "300x300", "300x300.webp", "300x300.avif"
+    }
+    assert rendition.paths["300x300"].endswith("img_300x300.jpg")
+    for key, image_format in (("300x300.webp", "WEBP"),
+                              ("300x300.avif", "AVIF")):
+        with Image.open(storage.path(rendition.paths[key])) as thumb:
+            assert thumb.format == image_format
+            assert thumb.size == (300, 225)
+
+
+@pytest.mark.asyncio
+async def test_process_image_skips_unclaimable_job(original):
+    """Уже обработанная или занятая задача пропускается без декодирования"""
+    claim_patch = 'app.workers.image_processor.claim_image'
+    status_patch = 'app.workers.image_processor.update_image_status'
+    executor = MagicMock()
+
+    with patch(claim_patch, new_callable=AsyncMock) as mock_claim, \
+            patch(status_patch, new_callable=AsyncMock) as mock_status:
+        mock_claim.return_value = None
+        await image_processor.process_image(
+            str(uuid4()), original, AsyncMock(), executor
+        )
+
+    executor.submit.assert_not_called()
+    mock_status.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_pixel_budget_limits_inflight_pixels():
+    """Задачи сверх бюджета ждут освобождения пикселей"""
+    budget = PixelBudget(limit=100)
+    running = []
+    peak = 0
+
+    async def job(pixels):
+        nonlocal peak
+        async with budget.reserve(pixels):
+            running.append(min(pixels, budget.limit))
+            peak = max(peak, sum(running))
+            await asyncio.sleep(0.01)
+            running.remove(min(pixels, budget.limit))
+
+    await asyncio.gather(*(job(pixels) for pixels in [60, 30, 50, 20, 500]))
+
+    assert peak <= 100
+    assert budget.in_use == 0
+
+
+@pytest.mark.asyncio
+async def test_pixel_budget_lets_interactive_jobs_overtake_bulk():
+    """Массовая задача не стартует, пока бюджета ждет интерактивная"""
+    budget = PixelBudget(limit=100)
+    started = []
+
+    async def job(name, pixels, bulk):
+        async with budget.reserve(pixels, bulk=bulk):
+            started.append(name)
+            await asyncio.sleep(0.01)
+
+    async with budget.reserve(100):
+        waiting = [
+            asyncio.create_task(job("bulk", 50, True)),
+            asyncio.create_task(job("interactive", 100, False)),
+        ]
+        await asyncio.sleep(0)
+
+    await asyncio.gather(*waiting)
+    assert started == ["interactive", "bulk"]
+
+
+@pytest.mark.asyncio
+async def test_messages_processed_concurrently(tmp_path, original):
+    """Несколько сообщений обрабатываются одновременно, каждое подтверждается само"""
+    active = 0
+    peak = 0
+
+    async def fake_process_image(*args):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+
+    messages = []
+    for _ in range(3):
+        message = MagicMock()
+        message.body = json.dumps({
+            "image_id": str(uuid4()), "original_path": original,
+            "width": 10, "height": 10,
+        }).encode()
+        message.process.return_value = AsyncMock()
+        messages.append(message)
+
+    with patch.object(image_processor, "process_image", fake_process_image), \
+            patch.object(image_processor, "AsyncSessionLocal", MagicMock()):
+        budget = PixelBudget(limit=1000)
+        await asyncio.gather(*(
+            image_processor.handle_message(
+                message, AsyncMock(), MagicMock(), budget
+            )
+            for message in messages
+        ))
+
+    assert peak == 3
+    for message in messages:
+        message.process.return_value.__aexit__.assert_awaited_once()
+
+
+def make_failing_message(attempt=None, priority="interactive"):
+    message = MagicMock()
+    message.body = json.dumps({
+        "image_id": str(uuid4()), "original_path": "/missing.jpg",
+        "priority": priority,
+    }).encode()
+    message.headers = {} if attempt is None else {ATTEMPT_HEADER: attempt}
+    message.process.return_value = AsyncMock()
+    return message
+
+
+async def run_failing(message, error, claimed=True):
+    """handle_message с process_image, падающим с error
+
+    При claimed задача успевает получить аренду до ошибки.
+    """
+    exchange = AsyncMock()
+    lease_expires_at = datetime.now(timezone.utc)
+
+    async def failing_process(*args):
+        if claimed:
+            args[-1].expires_at = lease_expires_at
+        raise error
+
+    status_patch = 'app.workers.image_processor.update_image_status'
+    release_patch = 'app.workers.image_processor.release_image'
+    with patch.object(image_processor, "process_image",
+                      AsyncMock(side_effect=failing_process)), \
+            patch.object(image_processor, "AsyncSessionLocal", MagicMock()), \
+            patch(status_patch, new_callable=AsyncMock) as mock_status, \
+            patch(release_patch, new_callable=AsyncMock) as mock_release:
+        await image_processor.handle_message(
+            message, exchange, MagicMock(), PixelBudget(limit=1000)
+        )
+    if claimed:
+        # Аренда освобождается по сроку, полученному при claim
+        assert mock_release.await_args.args[2] == lease_expires_at
+        mock_status.assert_not_awaited()
+        return exchange, mock_release.await_args.args[3]
+    mock_release.assert_not_awaited()
+    return exchange, mock_status
+
+
+def spawn_pool():
+    return ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+@pytest.mark.asyncio
+async def test_killed_pool_worker_requeues_message():
+    """Гибель процесса пула не считается попыткой: пул пересоздается,
+    задача освобождается, а сообщение возвращается в очередь"""
+    message = make_failing_message(attempt=1)
+    exchange = AsyncMock()
+    pool = image_processor.RenderPool(spawn_pool)
+    broken = pool.executor
+    lease_expires_at = datetime.now(timezone.utc)
+    loop = asyncio.get_running_loop()
+
+    async def dying_process(image_id, path, db, executor, lease):
+        lease.expires_at = lease_expires_at
+        pid = await loop.run_in_executor(executor, os.getpid)
+        os.kill(pid, signal.SIGKILL)
+        await loop.run_in_executor(executor, os.getpid)
+
+    release_patch = 'app.workers.image_processor.release_image'
+    try:
+        with patch.object(image_processor, "process_image", dying_process), \
+                patch.object(image_processor, "AsyncSessionLocal",
+                             MagicMock()), \
+                patch(release_patch, new_callable=AsyncMock) as mock_release:
+            await image_processor.handle_message(
+                message, exchange, pool, PixelBudget(limit=1000)
+            )
+
+        # Ни повтора, ни dead letter: сообщение отклоняется с requeue
+        exchange.publish.assert_not_awaited()
+        exit_args = message.process.return_value.__aexit__.await_args.args
+        assert exit_args[0] is BrokenProcessPool
+        assert mock_release.await_args.args[2:] == (lease_expires_at, "QUEUED")
+
+        assert pool.executor is not broken
+        assert pool.restarts == 1
+        pid = await loop.run_in_executor(pool.executor, os.getpid)
+        assert pid != os.getpid()
+    finally:
+        pool.executor.shutdown(wait=True)
+
+
+@pytest.mark.asyncio
+async def test_failed_job_scheduled_for_delayed_retry():
+    """Временная ошибка откладывает повтор с номером попытки в заголовке"""
+    message = make_failing_message(attempt=1)
+    exchange, status = await run_failing(message, ConnectionError("db"))
+
+    published = exchange.publish.await_args
+    delay = retry_delay(
+        2, image_processor.settings.WORKER_RETRY_BASE_DELAY
+    )
+    assert published.kwargs["routing_key"] == retry_queue_name(delay)
+    assert published.args[0].headers[ATTEMPT_HEADER] == 2
+    # Задача освобождается для следующей попытки
+    assert status == "QUEUED"
+
+
+@pytest.mark.asyncio
+async def test_bulk_job_retried_in_bulk_lane():
+    message = make_failing_message(priority="bulk")
+    exchange, _ = await run_failing(message, ConnectionError("db"))
+
+    routing_key = exchange.publish.await_args.kwargs["routing_key"]
+    delay = retry_delay(
+        1, image_processor.settings.WORKER_RETRY_BASE_DELAY
+    )
+    assert routing_key == retry_queue_name(delay, BULK_QUEUE)
+
+
+@pytest.mark.asyncio
+async def test_exhausted_job_dead_lettered_and_marked_error():
+    """После последней попытки задача уходит в dead-letter, запись - в ERROR"""
+    message = make_failing_message(
+        attempt=image_processor.settings.WORKER_MAX_ATTEMPTS - 1
+    )
+    exchange, status = await run_failing(message, ConnectionError("db"))
+
+    assert exchange.publish.await_args.kwargs["routing_key"] == DEAD_LETTER_QUEUE
+    assert status == "ERROR"
+
+
+@pytest.mark.asyncio
+async def test_permanent_error_dead_lettered_immediately():
+    message = make_failing_message()
+    exchange, status = await run_failing(
+        message, FileNotFoundError("/missing.jpg")
+    )
+
+    assert exchange.publish.await_args.kwargs["routing_key"] == DEAD_LETTER_QUEUE
+    assert status == "ERROR"
+
+
+@pytest.mark.asyncio
+async def test_unclaimed_job_failure_does_not_touch_claimed_record():
+    """Ошибка до claim не освобождает чужую аренду
+
+    Повтор запись не меняет, а в ERROR переводится только задача,
+    которую еще никто не взял в работу.
+    """
+    _, mock_status = await run_failing(
+        make_failing_message(), ConnectionError("db"), claimed=False
+    )
+    mock_status.assert_not_awaited()
+
+    _, mock_status = await run_failing(
+        make_failing_message(), FileNotFoundError("/missing.jpg"),
+        claimed=False,
+    )
+    assert mock_status.await_args.args[2] == "ERROR"
+    assert mock_status.await_args.kwargs["expected_status"] == "QUEUED"
+
+
+@pytest.mark.asyncio
+async def test_keep_lease_survives_db_errors():
+    """Ошибка продления не останавливает heartbeat"""
+    lease = image_processor.JobLease()
+    lease.expires_at = datetime.now(timezone.utc)
+    renewed = lease.expires_at + timedelta(seconds=30)
+    extend_patch = 'app.workers.image_processor.extend_lease'
+    with patch(extend_patch, new_callable=AsyncMock) as mock_extend, \
+            patch.object(image_processor, "AsyncSessionLocal", MagicMock()), \
+            patch.object(image_processor.settings, "WORKER_LEASE_SECONDS",
+                         0.003):
+        mock_extend.side_effect = [ConnectionError("db"), renewed, None]
+        await asyncio.wait_for(
+            image_processor.keep_lease(str(uuid4()), lease), 1
+        )
+
+    assert mock_extend.await_count == 3
+    assert lease.expires_at == renewed
+
+
+def test_retry_delay_grows_exponentially():
+    assert [retry_delay(attempt, 5) for attempt in range(1, 5)] == [
+        5, 10, 20, 40
+    ]
+
+
+@pytest.mark.asyncio
+async def test_retry_queue_name_follows_delay():
+    """Смена базовой задержки не переобъявляет существующие очереди
+    повтора с новым TTL"""
+    async def retry_queues(base_delay):
+        channel = AsyncMock()
+        await declare_topology(channel, 3, base_delay)
+        return {
+            call.args[0]: call.kwargs["arguments"]["x-message-ttl"]
+            for call in channel.declare_queue.await_args_list
+            if call.kwargs.get("arguments")
+        }
+
+    queues = await retry_queues(5)
+    assert queues == {
+        "images.retry.5000ms": 5000, "images.retry.10000ms": 10000,
+        "images.bulk.retry.5000ms": 5000, "images.bulk.retry.10000ms": 10000,
+    }
+    # Одно имя всегда означает один и тот же TTL
+    other = await retry_queues(3)
+    assert "images.retry.3000ms" in other
+    assert all(queues[name] == other[name] for name in set(queues) & set(other))
+
+
+@pytest.mark.asyncio
+async def test_replay_skips_images_no_longer_in_error():
+    """Переигрываются только задачи изображений, оставшихся в ERROR"""
+    from app.workers import dead_letters
+
+    stale, failed = make_failing_message(), make_failing_message()
+    for message in (stale, failed):
+        message.ack = AsyncMock()
+    queue = AsyncMock()
+    queue.get.side_effect = [stale, failed, None]
+    channel = MagicMock()
+    channel.default_exchange.publish = AsyncMock()
+
+    status_patch = 'app.workers.dead_letters.update_image_status'
+    with patch.object(dead_letters, "AsyncSessionLocal", MagicMock()), \
+            patch(status_patch, new_callable=AsyncMock,
+                  side_effect=[None, MagicMock()]) as mock_status:
+        await dead_letters.replay_dead_letters(channel, queue, None)
+
+    assert mock_status.await_args.kwargs["expected_status"] == "ERROR"
+    channel.default_exchange.publish.assert_awaited_once()
+    assert channel.default_exchange.publish.await_args.args[0].body == (
+        failed.body
+    )
+    stale.ack.assert_awaited_once()
+    failed.ack.assert_awaited_once()